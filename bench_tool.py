@@ -0,0 +1,144 @@
+import os
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import typer
+import rich
+from rich.table import Table
+from typing_extensions import Annotated
+from pathlib import Path
+
+
+def time_command(
+    args: list[str], stdin: Path | None, env: dict[str, str] | None = None
+) -> float:
+    start = time.perf_counter()
+    if stdin is not None:
+        with stdin.open("rb") as f:
+            subprocess.run(
+                args,
+                stdin=f,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                check=True,
+                env=env,
+            )
+    else:
+        subprocess.run(
+            args,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+            env=env,
+        )
+    return time.perf_counter() - start
+
+
+def count_symbols(exe: Path) -> int | None:
+    try:
+        result = subprocess.run(
+            ["nm", str(exe)], capture_output=True, text=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        # nm fails on stripped executables
+        return 0 if exe.exists() else None
+    return len(result.stdout.splitlines())
+
+
+# Compiles 1eft files once per variant (a set of compile flags) and times the executables
+def main(
+    files: Annotated[list[Path], typer.Argument(help="The 1eft files to benchmark")],
+    variant: Annotated[
+        list[str],
+        typer.Option(help="Compile flags for one variant, can be repeated"),
+    ] = [""],
+    runs: Annotated[
+        int, typer.Option(help="Number of timed runs per variant, 0 to only compile")
+    ] = 5,
+    stdin: Annotated[
+        Path | None, typer.Option(help="File to feed to the program's stdin")
+    ] = None,
+    output: Annotated[
+        Path | None, typer.Option(help="Also write the results to this file")
+    ] = None,
+    threads: Annotated[
+        list[int],
+        typer.Option(
+            help="Thread count for the qar pool (LEFT_THREADS), can be repeated "
+            "to measure scaling"
+        ),
+    ] = [],
+) -> None:
+    table = Table(title="Benchmark")
+    table.add_column("File")
+    table.add_column("Variant")
+    table.add_column("Compile (s)", justify="right")
+    table.add_column("Size (bytes)", justify="right")
+    table.add_column("Symbols", justify="right")
+    table.add_column("Threads", justify="right")
+    table.add_column("Min (s)", justify="right")
+    table.add_column("Median (s)", justify="right")
+    table.add_column("Speedup", justify="right")
+
+    total_sizes = [0] * len(variant)
+    with tempfile.TemporaryDirectory() as tmp:
+        for file in files:
+            if not file.exists():
+                rich.print(f"[red]File {file} does not exist[/red]")
+                continue
+
+            for i, flags in enumerate(variant):
+                exe = Path(tmp) / f"variant{i}"
+                compile_time = time_command(
+                    [sys.executable, "1eft.py", "compile", str(file), str(exe)]
+                    + shlex.split(flags),
+                    None,
+                )
+                size = exe.stat().st_size
+                total_sizes[i] += size
+                symbols = count_symbols(exe)
+                # Speedup is relative to the first thread count
+                baseline = None
+                for count in threads or [None]:
+                    env = None
+                    if count is not None:
+                        env = dict(os.environ, LEFT_THREADS=str(count))
+                    times = [
+                        time_command([str(exe)], stdin, env) for _ in range(runs)
+                    ]
+                    if times and baseline is None:
+                        baseline = min(times)
+                    table.add_row(
+                        file.name,
+                        flags or "(default)",
+                        f"{compile_time:.3f}",
+                        str(size),
+                        str(symbols),
+                        str(count) if count is not None else "-",
+                        f"{min(times):.4f}" if times else "-",
+                        f"{statistics.median(times):.4f}" if times else "-",
+                        f"{baseline / min(times):.2f}x" if times and baseline else "-",
+                    )
+
+    # Size of each variant over all files, relative to the first variant
+    totals = Table(title="Total size")
+    totals.add_column("Variant")
+    totals.add_column("Size (bytes)", justify="right")
+    totals.add_column("Relative", justify="right")
+    for flags, size in zip(variant, total_sizes):
+        relative = size / total_sizes[0] if total_sizes[0] else 0.0
+        totals.add_row(flags or "(default)", str(size), f"{relative:.0%}")
+
+    rich.print(table)
+    rich.print(totals)
+    if output is not None:
+        with output.open("w") as f:
+            rich.print(table, file=f)
+            rich.print(totals, file=f)
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,180 @@
+from hashlib import sha256
+from importlib import metadata
+import json
+import os
+from pathlib import Path
+import shutil
+import subprocess
+from typing import Any
+
+import llvmlite
+import llvmlite.binding as llvm
+import rich
+
+DEFAULT_CACHE_DIR = Path(
+    os.environ.get("LEFT_CACHE_DIR", Path.home() / ".cache" / "1eft")
+)
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024  # 512 MiB
+
+OBJECTS_DIR = "objects"
+# Prebuilt runtime libraries, shared by all builds using the cache directory
+RUNTIME_DIR = "runtime"
+STATS_FILE = "stats.json"
+
+
+def compiler_fingerprint() -> str:
+    """Version of the compiler itself, including the sources it was built from."""
+    try:
+        version = metadata.version("lang-1eft")
+    except metadata.PackageNotFoundError:
+        version = "unknown"
+
+    digest = sha256(version.encode("utf-8"))
+    package_dir = Path(__file__).parent
+    for source in sorted(package_dir.rglob("*")):
+        if source.suffix in (".py", ".lark"):
+            digest.update(source.relative_to(package_dir).as_posix().encode("utf-8"))
+            digest.update(source.read_bytes())
+    return digest.hexdigest()
+
+
+def toolchain_fingerprint(linker: str = "cc") -> str:
+    """Versions of llvmlite, LLVM and the system linker driver."""
+    llvm_version = ".".join(str(v) for v in llvm.llvm_version_info)
+    try:
+        cc_version = subprocess.run(
+            [linker, "--version"], capture_output=True, text=True, check=True
+        ).stdout.splitlines()[0]
+    except (OSError, subprocess.CalledProcessError, IndexError):
+        cc_version = "unknown"
+    return f"llvmlite {llvmlite.__version__}; llvm {llvm_version}; {cc_version}"
+
+
+class BuildCache:
+    """
+    Whole-build result cache, keyed on everything that influences the final
+    executable or assembly file. Entries, and the runtime libraries next to
+    them, are evicted least recently used first once the cache grows over
+    max_size bytes.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Path = DEFAULT_CACHE_DIR,
+        max_size: int = DEFAULT_MAX_SIZE,
+        hardlink: bool = False,
+        verbose: bool = False,
+    ) -> None:
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hardlink = hardlink
+        self.verbose = verbose
+
+    @property
+    def objects_dir(self) -> Path:
+        return self.cache_dir / OBJECTS_DIR
+
+    @property
+    def runtime_dir(self) -> Path:
+        return self.cache_dir / RUNTIME_DIR
+
+    def key(self, code: bytes, options: dict[str, Any], triple: str) -> str:
+        digest = sha256()
+        digest.update(code)
+        digest.update(json.dumps(options, sort_keys=True, default=str).encode())
+        digest.update(triple.encode("utf-8"))
+        digest.update(toolchain_fingerprint().encode("utf-8"))
+        digest.update(compiler_fingerprint().encode("utf-8"))
+        return digest.hexdigest()
+
+    def entry_path(self, key: str) -> Path:
+        return self.objects_dir / key[:2] / key
+
+    def fetch(self, key: str, output_file: Path) -> bool:
+        entry = self.entry_path(key)
+        if not entry.is_file():
+            self._record("misses")
+            return False
+
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+        output_file.unlink(missing_ok=True)
+        linked = False
+        if self.hardlink:
+            try:
+                os.link(entry, output_file)
+                linked = True
+            except OSError:
+                pass
+        if not linked:
+            shutil.copy2(entry, output_file)
+
+        # Refresh the entry so eviction sees it as recently used
+        os.utime(entry)
+        self._record("hits")
+        if self.verbose:
+            rich.print(f"Build cache hit: {key}")
+        return True
+
+    def store(self, key: str, output_file: Path) -> None:
+        entry = self.entry_path(key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+
+        # Copy next to the entry first so readers never see a partial file
+        tmp = entry.with_suffix(f".tmp{os.getpid()}")
+        shutil.copy2(output_file, tmp)
+        os.replace(tmp, entry)
+        self.evict()
+
+    def entries(self) -> list[Path]:
+        entries = [p for p in self.objects_dir.glob("*/*") if p.is_file()]
+        # Runtime libraries still being written have a .tmp<pid> suffix
+        entries += [
+            p
+            for p in self.runtime_dir.glob("*")
+            if p.is_file() and p.suffix in (".bc", ".o")
+        ]
+        return entries
+
+    def evict(self) -> int:
+        entries = sorted(self.entries(), key=lambda p: p.stat().st_mtime)
+        total = sum(p.stat().st_size for p in entries)
+        removed = 0
+        while entries and total > self.max_size:
+            oldest = entries.pop(0)
+            total -= oldest.stat().st_size
+            oldest.unlink(missing_ok=True)
+            removed += 1
+        if removed:
+            self._record("evictions", removed)
+        return removed
+
+    def stats(self) -> dict[str, int]:
+        entries = self.entries()
+        stats = self._load_stats()
+        return {
+            "entries": len(entries),
+            "size": sum(p.stat().st_size for p in entries),
+            "max_size": self.max_size,
+            "hits": stats.get("hits", 0),
+            "misses": stats.get("misses", 0),
+            "evictions": stats.get("evictions", 0),
+        }
+
+    def clear(self) -> int:
+        removed = len(self.entries())
+        shutil.rmtree(self.objects_dir, ignore_errors=True)
+        shutil.rmtree(self.runtime_dir, ignore_errors=True)
+        (self.cache_dir / STATS_FILE).unlink(missing_ok=True)
+        return removed
+
+    def _load_stats(self) -> dict[str, int]:
+        try:
+            return json.loads((self.cache_dir / STATS_FILE).read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def _record(self, counter: str, amount: int = 1) -> None:
+        stats = self._load_stats()
+        stats[counter] = stats.get(counter, 0) + amount
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        (self.cache_dir / STATS_FILE).write_text(json.dumps(stats))
@@ -5,16 +5,41 @@ from typing_extensions import Annotated
 import rich
 from rich.tree import Tree
 import typer
+import llvmlite.binding as llvm
 
 
 from lang_1eft.pipeline.parser import Parser
 from lang_1eft.pipeline.ast_constructor import ASTConstructor
 from lang_1eft.pipeline.ast_definitions import *
+from lang_1eft.pipeline.ast_util import called_functions, contains_statement
 
 from lang_1eft.codegen.module_builder import ModuleBuilder
-from lang_1eft.codegen.file_emitter import emit_files
+from lang_1eft.codegen.file_emitter import emit_files, artifact_path
+from lang_1eft.codegen.codegen_util import (
+    resolve_target_cpu,
+    BUILD_PROFILES,
+    DEFAULT_STDOUT_BUFFER,
+    MIN_STDOUT_BUFFER,
+    OVERFLOW_MODES,
+)
+from lang_1eft.codegen.remarks import REMARK_FORMATS
+from lang_1eft.codegen.runtime import RUNTIME_MODES
+from lang_1eft.codegen.thread_pool import SPAWN_FUNCTION
+from lang_1eft.codegen.pgo import load_profile
+from lang_1eft.build_cache import (
+    BuildCache,
+    DEFAULT_CACHE_DIR,
+    DEFAULT_MAX_SIZE,
+    RUNTIME_DIR,
+)
+from lang_1eft.phase_timer import PhaseTimer
 
+app = typer.Typer()
+cache_app = typer.Typer(help="Manage the build result cache")
+app.add_typer(cache_app, name="cache")
 
+
+@app.command()
 def compile(
     input_path: Annotated[Path, typer.Argument(help="The 1eft file to compile")],
     output_path: Annotated[
@@ -24,6 +49,145 @@ def compile(
     verbose: Annotated[bool, typer.Option(help="Enable verbose output")] = False,
     build: Annotated[bool, typer.Option(help="Build the project")] = True,
     opt: Annotated[int, typer.Option(help="Optimization level (0-3)")] = 2,
+    cpu: Annotated[
+        str, typer.Option(help="Target CPU name, or 'native' for the host CPU")
+    ] = "generic",
+    features: Annotated[
+        str,
+        typer.Option(
+            help="Target CPU features (e.g. +avx2,+bmi2), or 'native' for the host's"
+        ),
+    ] = "",
+    multiversion: Annotated[
+        bool,
+        typer.Option(
+            help="Emit generic and x86-64-v3 clones of functions with loops, "
+            "dispatched at runtime"
+        ),
+    ] = False,
+    vectorize: Annotated[
+        bool, typer.Option(help="Enable the loop and SLP vectorizers")
+    ] = True,
+    inline_threshold: Annotated[
+        int | None,
+        typer.Option(help="Inliner threshold (defaults to clang's for --opt)"),
+    ] = None,
+    size_level: Annotated[
+        int | None,
+        typer.Option(
+            help="Size optimization level (0-2, like -Os/-Oz), defaults to 2 "
+            "with --profile size and 0 otherwise"
+        ),
+    ] = None,
+    profile: Annotated[
+        str,
+        typer.Option(
+            help="Build profile: default, or size (-Oz, a section per function "
+            "and global, linker garbage collection and stripped symbols)"
+        ),
+    ] = "default",
+    passes: Annotated[
+        str | None,
+        typer.Option(
+            help="Comma separated LLVM passes to run instead of the default "
+            "pipeline (e.g. sroa,instruction_combining,licm)"
+        ),
+    ] = None,
+    new_pm: Annotated[
+        bool, typer.Option(help="Use LLVM's new pass manager pipeline")
+    ] = False,
+    overflow: Annotated[
+        str,
+        typer.Option(
+            help="Signed arithmetic overflow: wrap, nsw (assume it never "
+            "happens) or trap (abort with the source position)"
+        ),
+    ] = "wrap",
+    runtime: Annotated[
+        str,
+        typer.Option(
+            help="How to provide the 1eft runtime: inline (generate it into the "
+            "module), object (link a prebuilt object) or bitcode (link prebuilt "
+            "bitcode before optimizing)"
+        ),
+    ] = "inline",
+    pgo_gen: Annotated[
+        Path | None,
+        typer.Option(
+            help="Instrument branches and function entries, the executable "
+            "writes its profile to this file on exit"
+        ),
+    ] = None,
+    pgo_use: Annotated[
+        list[Path] | None,
+        typer.Option(
+            help="Optimize using a profile written by a --pgo-gen build, can be "
+            "repeated to merge several runs"
+        ),
+    ] = None,
+    remarks: Annotated[
+        Path | None,
+        typer.Option(help="Write a per-function LLVM optimization remarks report"),
+    ] = None,
+    remarks_format: Annotated[
+        str, typer.Option(help="Format of the remarks report (text or json)")
+    ] = "text",
+    cache: Annotated[
+        bool, typer.Option(help="Reuse build results from the build cache")
+    ] = False,
+    cache_dir: Annotated[
+        Path, typer.Option(help="Build cache directory")
+    ] = DEFAULT_CACHE_DIR,
+    cache_max_size: Annotated[
+        int, typer.Option(help="Build cache size limit in bytes")
+    ] = DEFAULT_MAX_SIZE,
+    hardlink: Annotated[
+        bool, typer.Option(help="Hardlink cached results instead of copying")
+    ] = False,
+    debug: Annotated[
+        bool,
+        typer.Option(
+            "--debug",
+            "-g",
+            help="Emit DWARF line tables mapping machine code to 1eft source lines",
+        ),
+    ] = False,
+    debug_wrap: Annotated[
+        int,
+        typer.Option(
+            help="Report debug line numbers as rows of this width (120 for "
+            "sources laid out by epic_tool), 0 to use the real lines"
+        ),
+    ] = 0,
+    frame_pointers: Annotated[
+        bool,
+        typer.Option(help="Keep frame pointers, for profilers that walk the stack"),
+    ] = False,
+    stdout_buffer: Annotated[
+        int,
+        typer.Option(
+            help="Bytes of output the executable collects before writing them "
+            "to stdout, it also writes before reading input and at exit"
+        ),
+    ] = DEFAULT_STDOUT_BUFFER,
+    instrument_functions: Annotated[
+        bool,
+        typer.Option(
+            help="Count the calls and cycles of every function and who calls "
+            "it, the executable reports them on exit. Not for programs "
+            "using qar or sqawz"
+        ),
+    ] = False,
+    instrument_output: Annotated[
+        Path | None,
+        typer.Option(
+            help="Write the --instrument-functions report to this file "
+            "instead of stderr"
+        ),
+    ] = None,
+    timings: Annotated[
+        bool, typer.Option(help="Report the time spent in each compiler phase")
+    ] = False,
 ) -> None:
     """
     Compile a 1eft source file to an executable.
@@ -36,23 +200,218 @@ def compile(
         rich.print(f"[red]Error:[/red] Optimization level must be between 0 and 3")
         raise typer.Exit(code=1)
 
+    if profile not in BUILD_PROFILES:
+        rich.print(
+            f"[red]Error:[/red] Build profile must be one of {', '.join(BUILD_PROFILES)}"
+        )
+        raise typer.Exit(code=1)
+
+    if debug_wrap < 0:
+        rich.print(f"[red]Error:[/red] Debug wrap width can't be negative")
+        raise typer.Exit(code=1)
+
+    if stdout_buffer < MIN_STDOUT_BUFFER:
+        rich.print(
+            f"[red]Error:[/red] Stdout buffer must be at least {MIN_STDOUT_BUFFER} bytes"
+        )
+        raise typer.Exit(code=1)
+
+    if size_level is None:
+        size_level = 2 if profile == "size" else 0
+    if not (0 <= size_level <= 2):
+        rich.print(f"[red]Error:[/red] Size level must be between 0 and 2")
+        raise typer.Exit(code=1)
+
+    # LLVM encodes -Oz as speed level 2, and llvmlite has no -Os pipeline
+    if new_pm and passes is None and size_level > 0 and (opt, size_level) != (2, 2):
+        rich.print(
+            f"[red]Error:[/red] The new pass manager only optimizes for size "
+            f"with --opt 2 --size-level 2"
+        )
+        raise typer.Exit(code=1)
+
+    if overflow not in OVERFLOW_MODES:
+        rich.print(
+            f"[red]Error:[/red] Overflow mode must be one of {', '.join(OVERFLOW_MODES)}"
+        )
+        raise typer.Exit(code=1)
+
+    if runtime not in RUNTIME_MODES:
+        rich.print(
+            f"[red]Error:[/red] Runtime mode must be one of {', '.join(RUNTIME_MODES)}"
+        )
+        raise typer.Exit(code=1)
+
+    if remarks_format not in REMARK_FORMATS:
+        rich.print(
+            f"[red]Error:[/red] Remarks format must be one of {', '.join(REMARK_FORMATS)}"
+        )
+        raise typer.Exit(code=1)
+
+    if pgo_gen is not None and pgo_use:
+        rich.print(f"[red]Error:[/red] --pgo-gen and --pgo-use can't be combined")
+        raise typer.Exit(code=1)
+
+    pgo_profile = None
+    if pgo_use:
+        try:
+            pgo_profile = load_profile(pgo_use)
+        except (OSError, ValueError) as e:
+            rich.print(f"[red]Error:[/red] Could not load profile: {e}")
+            raise typer.Exit(code=1)
+
+    pass_list = None
+    if passes is not None:
+        pass_list = [p.strip() for p in passes.split(",") if p.strip()]
+        for pass_name in pass_list:
+            if not hasattr(
+                llvm.ModulePassManager, f"add_{pass_name.replace('-', '_')}_pass"
+            ):
+                rich.print(f"[red]Error:[/red] Unknown LLVM pass '{pass_name}'")
+                raise typer.Exit(code=1)
+
     with input_path.open("r") as f:
         code = f.read()
 
-    parser = Parser(verbose=verbose)
-    parse_tree = parser.parse(code)
+    build_cache = None
+    cache_key = ""
+    output_file = artifact_path(output_path, asm)
+    # The remarks report is a side effect of optimizing, so it can't be cached
+    if cache and build and remarks is None:
+        build_cache = BuildCache(cache_dir, cache_max_size, hardlink, verbose)
+        target_cpu, target_features = resolve_target_cpu(cpu, features)
+        options = {
+            "asm": asm,
+            "opt": opt,
+            "cpu": target_cpu,
+            "features": target_features,
+            "multiversion": multiversion,
+            "vectorize": vectorize,
+            "inline_threshold": inline_threshold,
+            "size_level": size_level,
+            "passes": pass_list,
+            "new_pm": new_pm,
+            "overflow": overflow,
+            "runtime": runtime,
+            "profile": profile,
+            "frame_pointers": frame_pointers,
+            "stdout_buffer": stdout_buffer,
+            "instrument_functions": instrument_functions,
+            "instrument_output": (
+                instrument_output.resolve() if instrument_output is not None else None
+            ),
+            # The debug info records where the source file is
+            "debug": str(input_path.resolve()) if debug else None,
+            "debug_wrap": debug_wrap,
+            "pgo_gen": pgo_gen.resolve() if pgo_gen is not None else None,
+            "pgo_use": pgo_profile,
+        }
+        cache_key = build_cache.key(
+            code.encode("utf-8"), options, llvm.get_default_triple()
+        )
+        if build_cache.fetch(cache_key, output_file):
+            rich.print(f"[green]Success:[/green] Output written to {output_file}")
+            return
 
-    ast = ASTConstructor().transform(parse_tree)
+    timer = PhaseTimer()
+    with timer.phase("parse"):
+        parser = Parser(verbose=verbose)
+        parse_tree = parser.parse(code)
+
+    with timer.phase("ast"):
+        ast = ASTConstructor().transform(parse_tree)
     assert isinstance(ast, Program)
     if verbose:
         rich.print(make_tree(ast))
 
+    # The profiler keeps one call stack for the whole program
+    if instrument_functions and any(
+        contains_statement(f.body, QarStatement)
+        or SPAWN_FUNCTION in called_functions(f.body)
+        for f in ast.functions
+    ):
+        rich.print(
+            f"[red]Error:[/red] --instrument-functions can't profile programs "
+            f"using qar or {SPAWN_FUNCTION}"
+        )
+        raise typer.Exit(code=1)
+
     if build:
-        module_builder = ModuleBuilder(ast, asm=asm, verbose=verbose, opt=opt)
-        module_builder.build()
+        module_builder = ModuleBuilder(
+            ast,
+            asm=asm,
+            verbose=verbose,
+            opt=opt,
+            cpu=cpu,
+            features=features,
+            multiversion=multiversion,
+            vectorize=vectorize,
+            inline_threshold=inline_threshold,
+            size_level=size_level,
+            passes=pass_list,
+            new_pm=new_pm,
+            remarks=remarks,
+            remarks_format=remarks_format,
+            overflow=overflow,
+            runtime=runtime,
+            runtime_dir=cache_dir / RUNTIME_DIR,
+            pgo_gen=pgo_gen.resolve() if pgo_gen is not None else None,
+            pgo_use=pgo_profile,
+            profile=profile,
+            debug=debug,
+            debug_wrap=debug_wrap,
+            frame_pointers=frame_pointers,
+            stdout_buffer=stdout_buffer,
+            instrument=instrument_functions,
+            instrument_output=(
+                instrument_output.resolve() if instrument_output is not None else None
+            ),
+            source_path=input_path,
+        )
+        with timer.phase("codegen"):
+            module_builder.build()
         assert module_builder.module is not None
 
-        emit_files(module_builder, output_path)
+        emit_files(module_builder, output_path, timer)
+        if build_cache is not None:
+            build_cache.store(cache_key, output_file)
+
+    if timings:
+        timer.report()
+
+
+@cache_app.command("stats")
+def cache_stats(
+    cache_dir: Annotated[
+        Path, typer.Option(help="Build cache directory")
+    ] = DEFAULT_CACHE_DIR,
+    cache_max_size: Annotated[
+        int, typer.Option(help="Build cache size limit in bytes")
+    ] = DEFAULT_MAX_SIZE,
+) -> None:
+    """
+    Show build cache statistics.
+    """
+    stats = BuildCache(cache_dir, cache_max_size).stats()
+    rich.print(f"Cache directory: {cache_dir}")
+    rich.print(f"Entries: {stats['entries']}")
+    rich.print(f"Size: {stats['size']} / {stats['max_size']} bytes")
+    rich.print(f"Hits: {stats['hits']}")
+    rich.print(f"Misses: {stats['misses']}")
+    rich.print(f"Evictions: {stats['evictions']}")
+
+
+@cache_app.command("clear")
+def cache_clear(
+    cache_dir: Annotated[
+        Path, typer.Option(help="Build cache directory")
+    ] = DEFAULT_CACHE_DIR,
+) -> None:
+    """
+    Remove every entry from the build cache.
+    """
+    removed = BuildCache(cache_dir).clear()
+    rich.print(f"[green]Success:[/green] Removed {removed} cache entries")
 
 
 def make_tree(ast: Any) -> Tree:
@@ -74,7 +433,7 @@ def make_tree(ast: Any) -> Tree:
 
 
 def main():
-    typer.run(compile)
+    app()
 
 
 if __name__ == "__main__":
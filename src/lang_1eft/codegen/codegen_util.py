@@ -17,27 +17,157 @@ VOID_PTR = i8ptr
 
 FUNC_PREFIX = "1eft."
 
-string_numbers: dict[str, int] = {}
+STDIN_FD = 0
+STDOUT_FD = 1
+STDERR_FD = 2
+
+# Bytes of stdout the wr1te family collects before writing them out at once
+DEFAULT_STDOUT_BUFFER = 1 << 16
+# Room for the longest formatted value, so one always fits after a flush
+MIN_STDOUT_BUFFER = 64
+
+# Calling convention of user functions, guarantees calls marked tail are
+# compiled as tail calls at every optimization level
+USER_CALLING_CONVENTION = "tailcc"
+
+# default: optimize for speed, size: -Oz, a section per global, linker GC and strip
+BUILD_PROFILES = ("default", "size")
+
+# How signed dect arithmetic behaves on overflow
+OVERFLOW_MODES = ("wrap", "nsw", "trap")
+
+# e1se1f chains with at least this many arms can be lowered to a switch
+SWITCH_MIN_ARMS = 3
+
+# Function hints in 1eft spelling and the LLVM attribute each one adds
+FUNCTION_HINTS = {"fast": "hot", "c@1d": "cold", "1z1ze": "alwaysinline"}
+# Function hint memoizing a pure function, takes an optional table capacity
+MEMOIZE_HINT = "reca11"
+DEFAULT_MEMO_CAPACITY = 1 << 12
+# Predefined functions without side effects, the rest do I/O or keep state
+PURE_PREDEFS = ("barr1er",)
+# Predefined functions qar loops and tasks may call, the rest share buffers
+# or state between threads without locking
+THREAD_SAFE_PREDEFS = PURE_PREDEFS + (
+    "zsec",
+    "rdtsc",
+    "f@qez",
+    "fc1@se",
+    "xadd",
+    "cas",
+    "sqawz",
+    "wa1t",
+)
+# Loop hints, both take an optional unroll count or vector width
+UNROLL_HINT = "vzr@11"
+VECTORIZE_HINT = "vect@r1ze"
+
+NATIVE_CPU = "native"
+# Microarchitecture level of the fast clone of multiversioned functions
+MULTIVERSION_CPU = "x86-64-v3"
+
 # Lists functions that contain void pointers and which arguments will need to bit cast
-functions_with_void_ptrs: dict[str, list[int]] = {}
+functions_with_void_ptrs: dict[str, list[int]] = {FUNC_PREFIX + "wr1tea": [0]}
+
 
+def resolve_target_cpu(cpu: str, features: str) -> tuple[str, str]:
+    """Replace "native" with the CPU name and features of the host."""
+    if cpu == NATIVE_CPU:
+        cpu = llvm.get_host_cpu_name()
+        if features == "":
+            features = NATIVE_CPU
+    if features == NATIVE_CPU:
+        features = llvm.get_host_cpu_features().flatten()
+    return cpu, features
 
-def generate_llvm_machine(triple: str, opt: int) -> llvm.TargetMachine:
+
+def generate_llvm_machine(
+    triple: str, opt: int, cpu: str = "generic", features: str = ""
+) -> llvm.TargetMachine:
+    cpu, features = resolve_target_cpu(cpu, features)
     target = llvm.Target.from_triple(triple)
     target_machine = target.create_target_machine(
-        cpu="generic",
-        features="",
+        cpu=cpu,
+        features=features,
         opt=opt,
     )
     return target_machine
 
 
+def add_string_attribute(func: ir.Function, key: str, value: str) -> None:
+    # llvmlite only accepts the attributes it knows about, so bypass the check
+    set.add(func.attributes, f'"{key}"="{value}"')
+
+
+def add_attribute(func: ir.Function, name: str) -> None:
+    # Same as add_string_attribute, for attributes llvmlite doesn't list
+    set.add(func.attributes, name)
+
+
+def add_loop_metadata(module: ir.Module, properties: list[ir.MDValue]) -> ir.MDValue:
+    """
+    Creates a loop ID for the llvm.loop metadata of a loop's back-edge. LLVM
+    requires its first operand to be itself, which add_metadata can't express
+    """
+    # The placeholder keeps add_metadata from reusing another loop's node
+    loop_id = module.add_metadata([f"loop{len(module.metadata)}"] + properties)
+    loop_id.operands = (loop_id,) + tuple(properties)
+    return loop_id
+
+
+def hoist_allocas(func: ir.Function) -> None:
+    """
+    Moves the allocas of variables declared inside loops to the entry block,
+    so each iteration reuses one slot instead of growing the stack
+    """
+    entry = func.entry_basic_block
+    hoisted = []
+    for block in func.blocks[1:]:
+        allocas = [i for i in block.instructions if isinstance(i, ir.AllocaInstr)]
+        for alloca in allocas:
+            block.instructions.remove(alloca)
+            alloca.parent = entry
+        hoisted.extend(allocas)
+    entry.instructions[:0] = hoisted
+
+
+def place_in_own_sections(module: ir.Module) -> None:
+    """
+    Gives every defined global its own section, like -ffunction-sections and
+    -fdata-sections, so the linker can garbage collect the unused ones
+    """
+    for value in module.global_values:
+        if isinstance(value, ir.Function):
+            if not value.is_declaration:
+                value.section = f".text.{value.name}"
+        elif isinstance(value, ir.GlobalVariable):
+            initializer = getattr(value, "initializer", None)
+            if initializer is None:
+                continue
+            if value.global_constant:
+                value.section = f".rodata.{value.name}"
+            elif initializer.constant is None:
+                value.section = f".bss.{value.name}"
+            else:
+                value.section = f".data.{value.name}"
+
+
+def keep_frame_pointers(module: ir.Module) -> None:
+    """Like -fno-omit-frame-pointer, for profilers that walk the stack"""
+    for func in module.functions:
+        if not func.is_declaration:
+            add_string_attribute(func, "frame-pointer", "all")
+
+
 def get_llvm_type(type_node: Type | type[Type], do_raise: bool = False) -> ir.Type:
     ir_type = None
 
     if isinstance(type_node, PointerOf):
         base_ir_type = get_llvm_type(type_node.base_type, do_raise)
         ir_type = ir.PointerType(base_ir_type)
+    elif isinstance(type_node, ArrayOf):
+        base_ir_type = get_llvm_type(type_node.base_type, do_raise)
+        ir_type = ir.ArrayType(base_ir_type, type_node.size)
     elif isinstance(type_node, VoidType) or type_node is VoidType:
         ir_type = ir.VoidType()
     elif isinstance(type_node, DecimalType) or type_node is DecimalType:
@@ -89,11 +219,9 @@ def create_global_string(
     # Create a global string (array of characters)
     str_const = ir.Constant(ir.ArrayType(i8, len(raw)), raw)
 
-    if allow_dup and name in string_numbers:
-        string_numbers[name] += 1
-        name = f"{name}.{string_numbers[name]}"
-    elif allow_dup:
-        string_numbers[name] = 0
+    # Numbered per module, several modules can be built in one process
+    if allow_dup:
+        name = module.get_unique_name(name)
 
     global_str = ir.GlobalVariable(module, str_const.type, name=name)
     global_str.linkage = "internal"
@@ -122,82 +250,243 @@ def get_printf_function(module: ir.Module) -> ir.Function:
         return printf_func
 
 
-def get_fgets_function(module: ir.Module) -> ir.Function:
+def get_read_function(module: ir.Module) -> ir.Function:
     try:
-        return module.get_global("fgets")
+        return module.get_global("read")
     except KeyError:
-        fgets_type = ir.FunctionType(
-            i8ptr,
-            [
-                i8ptr,
-                i32,
-                VOID_PTR,
-            ],
-        )
-        fgets_func = ir.Function(module, fgets_type, name="fgets")
-        return fgets_func
+        read_type = ir.FunctionType(i64, [i32, i8ptr, i64])
+        read_func = ir.Function(module, read_type, name="read")
+        return read_func
 
 
-def get_fdopen(module: ir.Module):
+def get_time_function(module: ir.Module) -> ir.Function:
     try:
-        return module.get_global("fdopen")
+        return module.get_global("time")
     except KeyError:
-        return ir.Function(
-            module,
-            ir.FunctionType(
-                VOID_PTR,
-                [i32, i8ptr],
-            ),
-            name="fdopen",
+        time_type = ir.FunctionType(
+            i64,
+            [VOID_PTR],
         )
+        time_func = ir.Function(module, time_type, name="time")
+        return time_func
 
 
-def get_atol_function(module: ir.Module) -> ir.Function:
+def get_dprintf_function(module: ir.Module) -> ir.Function:
     try:
-        return module.get_global("atoi")
+        return module.get_global("dprintf")
     except KeyError:
-        atol_type = ir.FunctionType(
-            i64,
-            [i8ptr],
-        )
-        atol_func = ir.Function(module, atol_type, name="atol")
-        return atol_func
+        dprintf_type = ir.FunctionType(i32, [i32, i8ptr], var_arg=True)
+        dprintf_func = ir.Function(module, dprintf_type, name="dprintf")
+        return dprintf_func
 
 
-def get_rand_function(module: ir.Module) -> ir.Function:
+def get_write_function(module: ir.Module) -> ir.Function:
     try:
-        return module.get_global("rand")
+        return module.get_global("write")
     except KeyError:
-        rand_type = ir.FunctionType(
-            i32,
-            [],
-        )
-        rand_func = ir.Function(module, rand_type, name="rand")
-        return rand_func
+        write_type = ir.FunctionType(i64, [i32, i8ptr, i64])
+        write_func = ir.Function(module, write_type, name="write")
+        return write_func
+
+
+def get_open_function(module: ir.Module) -> ir.Function:
+    try:
+        return module.get_global("open")
+    except KeyError:
+        open_type = ir.FunctionType(i32, [i8ptr, i32], var_arg=True)
+        open_func = ir.Function(module, open_type, name="open")
+        return open_func
+
+
+def get_close_function(module: ir.Module) -> ir.Function:
+    try:
+        return module.get_global("close")
+    except KeyError:
+        close_type = ir.FunctionType(i32, [i32])
+        close_func = ir.Function(module, close_type, name="close")
+        return close_func
 
 
-def get_srand_function(module: ir.Module) -> ir.Function:
+def get_lseek_function(module: ir.Module) -> ir.Function:
     try:
-        return module.get_global("srand")
+        return module.get_global("lseek")
     except KeyError:
-        srand_type = ir.FunctionType(
-            ir.VoidType(),
-            [i32],
+        lseek_type = ir.FunctionType(i64, [i32, i64, i32])
+        lseek_func = ir.Function(module, lseek_type, name="lseek")
+        return lseek_func
+
+
+def get_mmap_function(module: ir.Module) -> ir.Function:
+    try:
+        return module.get_global("mmap")
+    except KeyError:
+        mmap_type = ir.FunctionType(VOID_PTR, [VOID_PTR, i64, i32, i32, i32, i64])
+        mmap_func = ir.Function(module, mmap_type, name="mmap")
+        return mmap_func
+
+
+def get_madvise_function(module: ir.Module) -> ir.Function:
+    try:
+        return module.get_global("madvise")
+    except KeyError:
+        madvise_type = ir.FunctionType(i32, [VOID_PTR, i64, i32])
+        madvise_func = ir.Function(module, madvise_type, name="madvise")
+        return madvise_func
+
+
+def get_clock_gettime_function(module: ir.Module) -> ir.Function:
+    try:
+        return module.get_global("clock_gettime")
+    except KeyError:
+        timespec_type = ir.LiteralStructType([i64, i64])
+        clock_gettime_type = ir.FunctionType(i32, [i32, timespec_type.as_pointer()])
+        clock_gettime_func = ir.Function(
+            module, clock_gettime_type, name="clock_gettime"
         )
-        srand_func = ir.Function(module, srand_type, name="srand")
-        return srand_func
+        return clock_gettime_func
 
 
-def get_time_function(module: ir.Module) -> ir.Function:
+def get_getenv_function(module: ir.Module) -> ir.Function:
     try:
-        return module.get_global("time")
+        return module.get_global("getenv")
     except KeyError:
-        time_type = ir.FunctionType(
-            i32,
-            [VOID_PTR],
+        getenv_type = ir.FunctionType(i8ptr, [i8ptr])
+        getenv_func = ir.Function(module, getenv_type, name="getenv")
+        return getenv_func
+
+
+def get_strtol_function(module: ir.Module) -> ir.Function:
+    try:
+        return module.get_global("strtol")
+    except KeyError:
+        strtol_type = ir.FunctionType(i64, [i8ptr, i8ptr.as_pointer(), i32])
+        strtol_func = ir.Function(module, strtol_type, name="strtol")
+        return strtol_func
+
+
+def get_sysconf_function(module: ir.Module) -> ir.Function:
+    try:
+        return module.get_global("sysconf")
+    except KeyError:
+        sysconf_type = ir.FunctionType(i64, [i32])
+        sysconf_func = ir.Function(module, sysconf_type, name="sysconf")
+        return sysconf_func
+
+
+def get_malloc_function(module: ir.Module) -> ir.Function:
+    try:
+        return module.get_global("malloc")
+    except KeyError:
+        malloc_type = ir.FunctionType(VOID_PTR, [i64])
+        malloc_func = ir.Function(module, malloc_type, name="malloc")
+        return malloc_func
+
+
+def get_free_function(module: ir.Module) -> ir.Function:
+    try:
+        return module.get_global("free")
+    except KeyError:
+        free_type = ir.FunctionType(ir.VoidType(), [VOID_PTR])
+        free_func = ir.Function(module, free_type, name="free")
+        return free_func
+
+
+def get_sched_yield_function(module: ir.Module) -> ir.Function:
+    try:
+        return module.get_global("sched_yield")
+    except KeyError:
+        sched_yield_type = ir.FunctionType(i32, [])
+        sched_yield_func = ir.Function(module, sched_yield_type, name="sched_yield")
+        return sched_yield_func
+
+
+def get_pthread_create_function(module: ir.Module) -> ir.Function:
+    try:
+        return module.get_global("pthread_create")
+    except KeyError:
+        start_type = ir.FunctionType(VOID_PTR, [VOID_PTR])
+        pthread_create_type = ir.FunctionType(
+            i32, [i64.as_pointer(), VOID_PTR, start_type.as_pointer(), VOID_PTR]
         )
-        time_func = ir.Function(module, time_type, name="time")
-        return time_func
+        pthread_create_func = ir.Function(
+            module, pthread_create_type, name="pthread_create"
+        )
+        return pthread_create_func
+
+
+def get_pthread_function(module: ir.Module, name: str, arg_count: int) -> ir.Function:
+    """The pthread mutex and condition functions, which take arg_count pointers"""
+    try:
+        return module.get_global(name)
+    except KeyError:
+        pthread_type = ir.FunctionType(i32, [VOID_PTR] * arg_count)
+        pthread_func = ir.Function(module, pthread_type, name=name)
+        return pthread_func
+
+
+def get_strlen_function(module: ir.Module) -> ir.Function:
+    try:
+        return module.get_global("strlen")
+    except KeyError:
+        strlen_type = ir.FunctionType(i64, [i8ptr])
+        strlen_func = ir.Function(module, strlen_type, name="strlen")
+        return strlen_func
+
+
+def get_snprintf_function(module: ir.Module) -> ir.Function:
+    try:
+        return module.get_global("snprintf")
+    except KeyError:
+        snprintf_type = ir.FunctionType(i32, [i8ptr, i64, i8ptr], var_arg=True)
+        snprintf_func = ir.Function(module, snprintf_type, name="snprintf")
+        return snprintf_func
+
+
+def get_fopen_function(module: ir.Module) -> ir.Function:
+    try:
+        return module.get_global("fopen")
+    except KeyError:
+        fopen_type = ir.FunctionType(VOID_PTR, [i8ptr, i8ptr])
+        fopen_func = ir.Function(module, fopen_type, name="fopen")
+        return fopen_func
+
+
+def get_fprintf_function(module: ir.Module) -> ir.Function:
+    try:
+        return module.get_global("fprintf")
+    except KeyError:
+        fprintf_type = ir.FunctionType(i32, [VOID_PTR, i8ptr], var_arg=True)
+        fprintf_func = ir.Function(module, fprintf_type, name="fprintf")
+        return fprintf_func
+
+
+def get_fclose_function(module: ir.Module) -> ir.Function:
+    try:
+        return module.get_global("fclose")
+    except KeyError:
+        fclose_type = ir.FunctionType(i32, [VOID_PTR])
+        fclose_func = ir.Function(module, fclose_type, name="fclose")
+        return fclose_func
+
+
+def get_atexit_function(module: ir.Module) -> ir.Function:
+    try:
+        return module.get_global("atexit")
+    except KeyError:
+        handler_type = ir.FunctionType(ir.VoidType(), [])
+        atexit_type = ir.FunctionType(i32, [handler_type.as_pointer()])
+        atexit_func = ir.Function(module, atexit_type, name="atexit")
+        return atexit_func
+
+
+def get_abort_function(module: ir.Module) -> ir.Function:
+    try:
+        return module.get_global("abort")
+    except KeyError:
+        abort_type = ir.FunctionType(ir.VoidType(), [])
+        abort_func = ir.Function(module, abort_type, name="abort")
+        abort_func.attributes.add("noreturn")
+        return abort_func
 
 
 def error_out(message: str, line: int, col: int, do_raise: bool = False) -> None:
@@ -0,0 +1,95 @@
+from pathlib import Path
+
+import llvmlite.ir as ir
+
+from lang_1eft.codegen.codegen_util import *
+
+DWARF_VERSION = 4
+DEBUG_INFO_VERSION = 3
+# Module flag behavior "Warning": differing values warn when modules are linked
+MODULE_FLAG_WARNING = 2
+
+
+def add_compile_unit(
+    module: ir.Module, source_path: Path, optimized: bool
+) -> tuple[ir.DIValue, ir.DIValue]:
+    """Describes the source file, returns its DIFile and DICompileUnit"""
+    source_path = source_path.resolve()
+    di_file = module.add_debug_info(
+        "DIFile",
+        {"filename": source_path.name, "directory": str(source_path.parent)},
+    )
+    # DWARF has no language code for 1eft, C is the closest for debuggers
+    di_unit = module.add_debug_info(
+        "DICompileUnit",
+        {
+            "language": ir.DIToken("DW_LANG_C"),
+            "file": di_file,
+            "producer": "1eft",
+            "runtimeVersion": 0,
+            "isOptimized": optimized,
+            "emissionKind": ir.DIToken("FullDebug"),
+        },
+        is_distinct=True,
+    )
+    module.add_named_metadata("llvm.dbg.cu", di_unit)
+    for name, value in (
+        ("Dwarf Version", DWARF_VERSION),
+        ("Debug Info Version", DEBUG_INFO_VERSION),
+    ):
+        module.add_named_metadata(
+            "llvm.module.flags",
+            [ir.Constant(i32, MODULE_FLAG_WARNING), name, ir.Constant(i32, value)],
+        )
+    return di_file, di_unit
+
+
+def add_subprogram(
+    module: ir.Module,
+    di_file: ir.DIValue,
+    di_unit: ir.DIValue,
+    func: ir.Function,
+    line: int,
+    local: bool = True,
+) -> ir.DIValue:
+    subroutine_type = module.add_debug_info(
+        "DISubroutineType", {"types": module.add_metadata([None])}
+    )
+    subprogram = module.add_debug_info(
+        "DISubprogram",
+        {
+            "name": func.name.removeprefix(FUNC_PREFIX),
+            "linkageName": func.name,
+            "scope": di_file,
+            "file": di_file,
+            "line": line,
+            "type": subroutine_type,
+            "scopeLine": line,
+            "unit": di_unit,
+            "spFlags": ir.DIToken(
+                "DISPFlagDefinition | DISPFlagLocalToUnit"
+                if local
+                else "DISPFlagDefinition"
+            ),
+        },
+        is_distinct=True,
+    )
+    func.set_metadata("dbg", subprogram)
+    return subprogram
+
+
+def add_entry_debug_info(
+    module: ir.Module, di_file: ir.DIValue, di_unit: ir.DIValue, func: ir.Function
+) -> None:
+    """
+    Gives main, which wraps start, debug info of its own. Without it LLVM
+    drops the source positions of everything inlined into it.
+    """
+    subprogram = add_subprogram(module, di_file, di_unit, func, 1, local=False)
+    location = module.add_debug_info(
+        "DILocation", {"line": 1, "column": 1, "scope": subprogram}
+    )
+    for block in func.blocks:
+        for instr in block.instructions:
+            if "dbg" not in instr.metadata:
+                instr.set_metadata("dbg", location)
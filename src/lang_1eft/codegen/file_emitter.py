@@ -1,10 +1,16 @@
+import os
 from pathlib import Path
 import subprocess
+from typing import Sequence
 
 import rich
 import llvmlite.binding as llvm
+import llvmlite.ir as ir
 
 from lang_1eft.codegen.module_builder import ModuleBuilder
+from lang_1eft.phase_timer import PhaseTimer
+from lang_1eft.codegen.remarks import Remark, parse_remarks, write_remarks_report
+from lang_1eft.codegen.runtime import check_runtime_functions
 
 
 def parse_asm(asm: str) -> llvm.ModuleRef:
@@ -13,61 +19,288 @@ def parse_asm(asm: str) -> llvm.ModuleRef:
     return mod
 
 
+def hand_off_module(module: ir.Module) -> llvm.ModuleRef:
+    """
+    Parses the module into LLVM, consuming it. llvmlite can only do this
+    through IR text, so globals are rendered one at a time and each function
+    drops its instructions once rendered. Instructions cache their own text,
+    so keeping them would hold a second copy of the IR through optimization.
+    """
+    lines = [
+        f'; ModuleID = "{module.name}"',
+        f'target triple = "{module.triple}"',
+        f'target datalayout = "{module.data_layout}"',
+        "",
+    ]
+    lines += [t.get_declaration() for t in module.get_identified_types().values()]
+    for value in module.global_values:
+        lines.append(str(value))
+        if isinstance(value, ir.Function):
+            value.blocks = []
+    for name, named in module.namedmetadata.items():
+        operands = ", ".join(md.get_reference() for md in named.operands)
+        lines.append(f"!{name} = !{{ {operands} }}")
+    lines += [str(md) for md in module.metadata]
+
+    asm = "\n".join(lines)
+    del lines
+    return parse_asm(asm)
+
+
+def inline_threshold(opt: int, size_level: int) -> int:
+    """
+    Default inliner threshold for an optimization level, matching
+    computeThresholdFromOptLevels in LLVM 15, where -O3 wins over size levels.
+    """
+    if opt > 2:
+        return 250
+    if size_level == 1:
+        return 50
+    if size_level == 2:
+        return 5
+    return 225
+
+
 def optimize(llvm_ir: llvm.ModuleRef, module_builder: ModuleBuilder) -> None:
+    remarks: list[Remark] | None = None
+    if module_builder.remarks is not None:
+        remarks = []
+
+    if module_builder.passes is not None:
+        run_pass_list(llvm_ir, module_builder, remarks)
+    elif module_builder.new_pm:
+        run_new_pass_manager(llvm_ir, module_builder, remarks)
+    else:
+        run_pass_manager_builder(llvm_ir, module_builder, remarks)
+
+    if module_builder.remarks is not None and remarks is not None:
+        write_remarks_report(
+            remarks, module_builder.remarks, module_builder.remarks_format
+        )
+
+    if module_builder.verbose:
+        rich.print("LLVM IR:")
+        rich.print(llvm_ir)
+
+
+def run_passes(
+    pm: llvm.ModulePassManager | llvm.FunctionPassManager,
+    target: llvm.ModuleRef | llvm.ValueRef,
+    remarks: list[Remark] | None,
+) -> None:
+    if remarks is None:
+        pm.run(target)
+    else:
+        _, remarks_yaml = pm.run_with_remarks(target)
+        remarks.extend(parse_remarks(remarks_yaml))
+
+
+def run_pass_manager_builder(
+    llvm_ir: llvm.ModuleRef,
+    module_builder: ModuleBuilder,
+    remarks: list[Remark] | None = None,
+) -> None:
     pmb = llvm.create_pass_manager_builder()
     pmb.opt_level = module_builder.opt
+    pmb.size_level = module_builder.size_level
+    pmb.loop_vectorize = module_builder.vectorize
+    pmb.slp_vectorize = module_builder.vectorize
+    if module_builder.opt > 0:
+        pmb.inlining_threshold = (
+            module_builder.inline_threshold
+            if module_builder.inline_threshold is not None
+            else inline_threshold(module_builder.opt, module_builder.size_level)
+        )
 
     pm = llvm.ModulePassManager()
     fpm = llvm.FunctionPassManager(llvm_ir)
 
+    # Target cost model, needed for the vectorizers to pick vector widths
+    module_builder.machine.add_analysis_passes(pm)
+    module_builder.machine.add_analysis_passes(fpm)
+
     pmb.populate(pm)
     pmb.populate(fpm)
 
     fpm.initialize()
     for func in llvm_ir.functions:
-        fpm.run(func)
+        if not func.is_declaration:
+            run_passes(fpm, func, remarks)
     fpm.finalize()
 
-    pm.run(llvm_ir)
+    run_passes(pm, llvm_ir, remarks)
+
+
+def run_new_pass_manager(
+    llvm_ir: llvm.ModuleRef,
+    module_builder: ModuleBuilder,
+    remarks: list[Remark] | None = None,
+) -> None:
+    if module_builder.inline_threshold is not None:
+        rich.print(
+            "[yellow]Warning:[/yellow] The new pass manager does not support "
+            "setting the inline threshold, ignoring it"
+        )
+    if remarks is not None:
+        rich.print(
+            "[yellow]Warning:[/yellow] The new pass manager does not support "
+            "collecting optimization remarks, the report will be empty"
+        )
+
+    pto = llvm.create_pipeline_tuning_options(
+        speed_level=module_builder.opt, size_level=module_builder.size_level
+    )
+    pto.loop_vectorization = module_builder.vectorize
+    pto.slp_vectorization = module_builder.vectorize
+    pb = llvm.create_pass_builder(module_builder.machine, pto)
+
+    pm = pb.getModulePassManager()
+    pm.run(llvm_ir, pb)
+
+
+def run_pass_list(
+    llvm_ir: llvm.ModuleRef,
+    module_builder: ModuleBuilder,
+    remarks: list[Remark] | None = None,
+) -> None:
+    assert module_builder.passes is not None
+    pm = llvm.ModulePassManager()
+    module_builder.machine.add_analysis_passes(pm)
+
+    threshold = (
+        module_builder.inline_threshold
+        if module_builder.inline_threshold is not None
+        else inline_threshold(module_builder.opt, module_builder.size_level)
+    )
+    for pass_name in module_builder.passes:
+        method = f"add_{pass_name.replace('-', '_')}_pass"
+        # The CLI rejects unknown pass names before building
+        assert hasattr(pm, method), f"Unknown LLVM pass '{pass_name}'"
+        add_pass = getattr(pm, method)
+        # The only pass without defaults for all of its arguments
+        if method == "add_function_inlining_pass":
+            add_pass(threshold)
+        else:
+            add_pass()
+
+    run_passes(pm, llvm_ir, remarks)
+
+
+def build_runtime_library(module_builder: ModuleBuilder) -> None:
+    """Compiles the predefined functions once into a cached bitcode and object file"""
+    bitcode_path = module_builder.runtime_library(".bc")
+    object_path = module_builder.runtime_library(".o")
+    if bitcode_path.exists() and object_path.exists():
+        # Refresh them so build cache eviction sees them as recently used
+        os.utime(bitcode_path)
+        os.utime(object_path)
+        return
+
+    runtime_module = module_builder.build_runtime()
+    check_runtime_functions(runtime_module)
+    runtime = parse_asm(str(runtime_module))
+    run_pass_manager_builder(runtime, module_builder)
+
+    # Write next to the final path first so other builds never see partial files
+    bitcode_path.parent.mkdir(parents=True, exist_ok=True)
+    for path, data in (
+        (bitcode_path, runtime.as_bitcode()),
+        (object_path, module_builder.machine.emit_object(runtime)),
+    ):
+        tmp = path.with_suffix(f".tmp{os.getpid()}")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
 
     if module_builder.verbose:
-        rich.print("LLVM IR:")
-        rich.print(llvm_ir)
+        rich.print(f"Built runtime library {object_path}")
+
+
+def link_runtime_bitcode(llvm_ir: llvm.ModuleRef, module_builder: ModuleBuilder) -> None:
+    runtime = llvm.parse_bitcode(module_builder.runtime_library(".bc").read_bytes())
+    names = [f.name for f in runtime.functions if not f.is_declaration]
+    llvm_ir.link_in(runtime)
+
+    # Linked in like the inline runtime, so keep it private to the module
+    for name in names:
+        llvm_ir.get_function(name).linkage = llvm.Linkage.internal
 
 
-def emit_files(module_builder: ModuleBuilder, output_path: Path) -> None:
+def emit_files(
+    module_builder: ModuleBuilder,
+    output_path: Path,
+    timer: PhaseTimer | None = None,
+) -> None:
+    """Optimizes and writes the built module, which is consumed in the process"""
     assert module_builder.module is not None
-    llvm_ir = parse_asm(str(module_builder.module))
+    if timer is None:
+        timer = PhaseTimer()
 
-    optimize(llvm_ir, module_builder)
+    with timer.phase("handoff"):
+        llvm_ir = hand_off_module(module_builder.module)
+        module_builder.module = None
+
+    if module_builder.runtime != "inline":
+        with timer.phase("runtime"):
+            build_runtime_library(module_builder)
+            if module_builder.runtime == "bitcode":
+                link_runtime_bitcode(llvm_ir, module_builder)
+
+    with timer.phase("optimize"):
+        optimize(llvm_ir, module_builder)
 
     # Make sure output directory exists
     output_path.parent.mkdir(parents=True, exist_ok=True)
 
     if module_builder.asm:
-        output_path.with_suffix(".s").write_text(
-            module_builder.machine.emit_assembly(llvm_ir)
-        )
+        with timer.phase("emit"):
+            output_path.with_suffix(".s").write_text(
+                module_builder.machine.emit_assembly(llvm_ir)
+            )
         rich.print(
             f"[green]Success:[/green] Output written to {output_path.with_suffix('.s')}"
         )
     else:
-        output_path.with_suffix(".o").write_bytes(
-            module_builder.machine.emit_object(llvm_ir)
-        )
-        link_files(output_path)
-        remove_linked_object(output_path)
+        with timer.phase("emit"):
+            output_path.with_suffix(".o").write_bytes(
+                module_builder.machine.emit_object(llvm_ir)
+            )
+        with timer.phase("link"):
+            objects = []
+            if module_builder.runtime == "object":
+                objects.append(module_builder.runtime_library(".o"))
+            link_files(output_path, objects, linker_flags(module_builder.profile))
+            remove_linked_object(output_path)
         rich.print(f"[green]Success:[/green] Output written to {output_path}")
 
 
-def link_files(out_path: Path) -> None:
+def artifact_path(output_path: Path, asm: bool) -> Path:
+    """The final file written by emit_files for the given output path."""
+    return output_path.with_suffix(".s") if asm else output_path.with_suffix("")
+
+
+def linker_flags(profile: str) -> list[str]:
+    # The runtime thread pool of qar loops is built on pthreads
+    flags = ["-pthread"]
+    if profile == "size":
+        # Drop the sections nothing references and strip the symbol table
+        flags += ["-Wl,--gc-sections", "-s"]
+    return flags
+
+
+def link_files(
+    out_path: Path, objects: Sequence[Path] = (), flags: Sequence[str] = ()
+) -> None:
     linker = "cc"
-    args = [
-        linker,
-        "-o",
-        str(out_path.with_suffix("")),
-        str(out_path.with_suffix(".o")),
-    ]
+    args = (
+        [
+            linker,
+            "-o",
+            str(out_path.with_suffix("")),
+            str(out_path.with_suffix(".o")),
+        ]
+        + [str(o) for o in objects]
+        + list(flags)
+    )
 
     subprocess.run(args, check=True)
 
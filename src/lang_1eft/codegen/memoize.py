@@ -0,0 +1,77 @@
+import llvmlite.ir as ir
+
+from lang_1eft.codegen.codegen_util import *
+
+# Hash of a call without arguments, and the multiplier mixing in each one
+MEMO_HASH_SEED = 0x9E3779B97F4A7C15
+MEMO_HASH_MULTIPLIER = 0xBF58476D1CE4E5B9
+
+
+def memo_capacity(value: int | None) -> int:
+    """Table capacity for a reca11 hint, rounded up to a power of two"""
+    capacity = DEFAULT_MEMO_CAPACITY if value is None else value
+    return 1 << (capacity - 1).bit_length()
+
+
+def add_memo_table(module: ir.Module, func: ir.Function, capacity: int) -> ir.Value:
+    """
+    Direct mapped table of the results of func. Each slot holds a filled flag,
+    the arguments of the call it caches and its result.
+    """
+    func_type = func.function_type
+    slot_type = ir.LiteralStructType(
+        [i1, ir.LiteralStructType(func_type.args), func_type.return_type]
+    )
+    table_type = ir.ArrayType(slot_type, capacity)
+    table = ir.GlobalVariable(module, table_type, name=func.name + ".memo")
+    table.linkage = "internal"
+    table.initializer = ir.Constant(table_type, None)  # type: ignore
+    return table
+
+
+def build_memo_wrapper(
+    func: ir.Function, body: ir.Function, table: ir.GlobalVariable
+) -> None:
+    """
+    Fills func with a lookup of its arguments in table, calling body on a miss.
+    A miss overwrites whatever the slot held before.
+    """
+    capacity = table.type.pointee.count
+    builder = ir.IRBuilder(func.append_basic_block(name="entry"))
+
+    digest = ir.Constant(i64, MEMO_HASH_SEED)
+    for arg in func.args:
+        digest = builder.xor(digest, builder.zext(arg, i64) if arg.type != i64 else arg)
+        digest = builder.mul(digest, ir.Constant(i64, MEMO_HASH_MULTIPLIER))
+    digest = builder.xor(digest, builder.lshr(digest, ir.Constant(i64, 32)))
+    index = builder.and_(digest, ir.Constant(i64, capacity - 1), name="index")
+
+    slot = builder.gep(table, [ZERO, index], inbounds=True, name="slot")
+    filled_ptr = builder.gep(slot, [ZERO, ir.Constant(i32, 0)], inbounds=True)
+    keys_ptr = builder.gep(slot, [ZERO, ir.Constant(i32, 1)], inbounds=True)
+    result_ptr = builder.gep(slot, [ZERO, ir.Constant(i32, 2)], inbounds=True)
+
+    hit = builder.load(filled_ptr, name="filled")
+    for i, arg in enumerate(func.args):
+        key_ptr = builder.gep(keys_ptr, [ZERO, ir.Constant(i32, i)], inbounds=True)
+        same = builder.icmp_unsigned("==", builder.load(key_ptr), arg)
+        hit = builder.and_(hit, same)
+
+    found = func.append_basic_block(name="found")
+    missing = func.append_basic_block(name="missing")
+    builder.cbranch(hit, found, missing)
+
+    builder.position_at_end(found)
+    builder.ret(builder.load(result_ptr, name="cached"))
+
+    builder.position_at_end(missing)
+    result = builder.call(
+        body, func.args, cconv=USER_CALLING_CONVENTION, name="result"
+    )
+    # The body may have reused the slot for a recursive call, so fill it last
+    for i, arg in enumerate(func.args):
+        key_ptr = builder.gep(keys_ptr, [ZERO, ir.Constant(i32, i)], inbounds=True)
+        builder.store(arg, key_ptr)
+    builder.store(result, result_ptr)
+    builder.store(ir.Constant(i1, True), filled_ptr)
+    builder.ret(result)
@@ -1,10 +1,57 @@
+from pathlib import Path
 from typing import cast
 import llvmlite.binding as llvm
 import llvmlite.ir as ir
 
 from lang_1eft.codegen.codegen_util import *
 from lang_1eft.codegen.predef_functions import *
+from lang_1eft.codegen.debug_info import (
+    add_compile_unit,
+    add_entry_debug_info,
+    add_subprogram,
+)
+from lang_1eft.codegen.memoize import (
+    add_memo_table,
+    build_memo_wrapper,
+    memo_capacity,
+)
+from lang_1eft.codegen.pgo import (
+    Profile,
+    add_pgo_counter,
+    add_pgo_dump_function,
+    add_pgo_dump_init,
+    profile_checksum,
+    scale_weights,
+)
+from lang_1eft.codegen.profiler import (
+    add_exit_hooks,
+    add_profiler_enter_function,
+    add_profiler_exit_function,
+    add_profiler_report_function,
+    add_profiler_report_init,
+    add_profiler_state,
+)
+from lang_1eft.codegen.thread_pool import (
+    QAR_JOB_TYPE,
+    SPAWN_FUNCTION,
+    TASK_HEADER_TYPE,
+    TASK_THUNK_TYPE,
+)
+from lang_1eft.codegen.runtime import (
+    DEFAULT_RUNTIME_DIR,
+    build_runtime_module,
+    declare_runtime_functions,
+    runtime_library_path,
+)
 from lang_1eft.pipeline.ast_definitions import *
+from lang_1eft.pipeline.ast_util import (
+    called_functions,
+    constant_value,
+    contains_expression,
+    contains_statement,
+    identifier_names,
+    same_expression,
+)
 
 
 class ModuleBuilder:
@@ -15,30 +62,178 @@ class ModuleBuilder:
         verbose: bool = False,
         triple: str | None = None,
         opt: int = 2,
+        cpu: str = "generic",
+        features: str = "",
+        multiversion: bool = False,
+        vectorize: bool = True,
+        inline_threshold: int | None = None,
+        size_level: int = 0,
+        passes: list[str] | None = None,
+        new_pm: bool = False,
+        remarks: Path | None = None,
+        remarks_format: str = "text",
+        overflow: str = "wrap",
+        runtime: str = "inline",
+        runtime_dir: Path = DEFAULT_RUNTIME_DIR,
+        pgo_gen: Path | None = None,
+        pgo_use: Profile | None = None,
+        profile: str = "default",
+        debug: bool = False,
+        debug_wrap: int = 0,
+        frame_pointers: bool = False,
+        stdout_buffer: int = DEFAULT_STDOUT_BUFFER,
+        instrument: bool = False,
+        instrument_output: Path | None = None,
+        source_path: Path | None = None,
     ) -> None:
         llvm.initialize()
         llvm.initialize_native_target()
         llvm.initialize_native_asmprinter()
+        llvm.initialize_native_asmparser()
 
         self.ast = ast
         self.asm = asm
         self.verbose = verbose
         self.triple = triple if triple is not None else llvm.get_default_triple()
         self.opt = opt
-        self.machine = generate_llvm_machine(self.triple, self.opt)
+        self.cpu, self.features = resolve_target_cpu(cpu, features)
+        self.multiversion = multiversion
+        self.vectorize = vectorize
+        self.inline_threshold = inline_threshold
+        self.size_level = size_level
+        self.passes = passes
+        self.new_pm = new_pm
+        self.remarks = remarks
+        self.remarks_format = remarks_format
+        self.overflow = overflow
+        self.runtime = runtime
+        self.runtime_dir = runtime_dir
+        self.pgo_gen = pgo_gen
+        self.pgo_use = pgo_use
+        self.profile = profile
+        self.debug = debug
+        self.debug_wrap = debug_wrap
+        self.frame_pointers = frame_pointers
+        self.stdout_buffer = stdout_buffer
+        self.instrument = instrument
+        self.instrument_output = instrument_output
+        self.source_path = source_path
+        self.machine = generate_llvm_machine(
+            self.triple, self.opt, self.cpu, self.features
+        )
+
+        if self.multiversion and not self.triple.startswith("x86_64"):
+            error_out("Function multiversioning requires an x86-64 target", 1, 1)
+            exit(1)
 
         self.module = None
+        # Calls that resolve to a different function than their name, used so
+        # multiversioned clones recurse into themselves instead of the dispatcher
+        self.call_redirects: dict[str, ir.Function] = {}
+        # Profiled sites in codegen order and their counters, see pgo_counts
+        self.pgo_sites: list[str] = []
+        self.pgo_counters: list[ir.GlobalVariable] = []
+        self.pgo_slots = 0
+        # Debug info of the module, and of the function being built
+        self.di_file: ir.DIValue | None = None
+        self.di_unit: ir.DIValue | None = None
+        self.di_scope: ir.DIValue | None = None
 
     def build(self) -> None:
         self.module = ir.Module(name="1eft_module")
+        self.pgo_sites = []
+        self.pgo_counters = []
+        self.pgo_slots = 0
+        self.di_file = self.di_unit = self.di_scope = None
         self.module.triple = self.triple
         self.module.data_layout = str(self.machine.target_data)
 
-        add_all_predef_functions(self.module)
+        if self.debug:
+            source_path = self.source_path or Path(self.module.name)
+            self.di_file, self.di_unit = add_compile_unit(
+                self.module, source_path, self.opt > 0
+            )
+
+        if self.runtime == "inline":
+            add_all_predef_functions(self.module, self.stdout_buffer)
+        else:
+            declare_runtime_functions(self.module)
+        if self.overflow == "trap":
+            add_overflow_function(self.module)
+        if self.instrument:
+            add_profiler_state(
+                self.module, [f.identifier.name for f in self.ast.functions]
+            )
+            add_profiler_enter_function(self.module)
+            add_profiler_exit_function(self.module)
         for func in self.ast.functions:
             self.build_function(func)
 
         wrap_main_function(self.module)
+        if self.multiversion:
+            add_cpu_dispatch_init(self.module)
+        if self.instrument:
+            report = add_profiler_report_function(
+                self.module, len(self.ast.functions), self.instrument_output
+            )
+            add_profiler_report_init(self.module, report)
+
+        if self.di_file is not None and self.di_unit is not None:
+            add_entry_debug_info(
+                self.module, self.di_file, self.di_unit, self.module.get_global("main")
+            )
+
+        checksum = profile_checksum(self.pgo_sites)
+        if self.pgo_gen is not None:
+            dump = add_pgo_dump_function(
+                self.module, self.pgo_counters, self.pgo_gen, checksum
+            )
+            add_pgo_dump_init(self.module, dump)
+        if self.pgo_use is not None and self.pgo_use.checksum != checksum:
+            rich.print(
+                "[yellow]Warning:[/yellow] The profile was generated from a "
+                "different program, ignoring it"
+            )
+            self.pgo_use = None
+            self.build()
+            return
+
+        # Only main is exported, so LLVM is free to inline and drop the rest
+        for func in self.module.functions:
+            if not func.is_declaration and func.name != "main":
+                func.linkage = "internal"
+
+        if self.profile == "size":
+            place_in_own_sections(self.module)
+        if self.frame_pointers:
+            keep_frame_pointers(self.module)
+
+    def build_runtime(self) -> ir.Module:
+        return build_runtime_module(
+            self.triple,
+            str(self.machine.target_data),
+            self.profile == "size",
+            self.frame_pointers,
+            self.stdout_buffer,
+        )
+
+    def runtime_library(self, suffix: str) -> Path:
+        return runtime_library_path(
+            self.runtime_dir,
+            [
+                self.triple,
+                str(self.opt),
+                str(self.size_level),
+                str(self.vectorize),
+                str(self.inline_threshold),
+                self.cpu,
+                self.features,
+                self.profile,
+                str(self.frame_pointers),
+                str(self.stdout_buffer),
+            ],
+            suffix,
+        )
 
     def build_function(self, func_def: FunctionDef) -> None:
         assert self.module is not None
@@ -46,10 +241,216 @@ class ModuleBuilder:
             get_llvm_type(func_def.type),
             [get_llvm_type(p.type) for p in func_def.parameters],
         )
-        func = ir.Function(
-            self.module, func_type, name=FUNC_PREFIX + func_def.identifier.name
+        func_name = FUNC_PREFIX + func_def.identifier.name
+        func = ir.Function(self.module, func_type, name=func_name)
+        func.calling_convention = USER_CALLING_CONVENTION
+
+        # Memoized functions look their arguments up before running the body,
+        # recursive calls go through the lookup too
+        memo_hint = self.memo_hint(func_def)
+        if memo_hint is not None:
+            body = ir.Function(self.module, func_type, name=func_name + ".body")
+            body.calling_convention = USER_CALLING_CONVENTION
+            self.build_function_body(func_def, body)
+            table = add_memo_table(self.module, func, memo_capacity(memo_hint.value))
+            build_memo_wrapper(func, body, table)
+            self.apply_function_hints(func_def, [func, body])
+        # Functions with loops get a generic and a fast clone, picked at runtime
+        elif self.multiversion and contains_statement(func_def.body, AsStatement):
+            generic = ir.Function(self.module, func_type, name=func_name + ".generic")
+            native = ir.Function(self.module, func_type, name=func_name + ".native")
+            add_string_attribute(native, "target-cpu", MULTIVERSION_CPU)
+            generic.calling_convention = USER_CALLING_CONVENTION
+            native.calling_convention = USER_CALLING_CONVENTION
+
+            for clone in (generic, native):
+                self.call_redirects[func_name] = clone
+                self.build_function_body(func_def, clone)
+            del self.call_redirects[func_name]
+
+            self.build_dispatcher(func, generic, native)
+            self.apply_function_hints(func_def, [func, generic, native])
+        else:
+            self.build_function_body(func_def, func)
+            self.apply_function_hints(func_def, [func])
+
+    def apply_function_hints(
+        self, func_def: FunctionDef, funcs: list[ir.Function]
+    ) -> None:
+        names = [hint.name for hint in func_def.hints if hint.name in FUNCTION_HINTS]
+        for hint in func_def.hints:
+            if hint.name == MEMOIZE_HINT:
+                continue
+            if hint.name not in FUNCTION_HINTS or hint.value is not None:
+                error_out(
+                    f"'{hint.name}' is not a function hint",
+                    hint.line,
+                    hint.column,
+                    self.verbose,
+                )
+                exit(1)
+        if "fast" in names and "c@1d" in names:
+            error_out(
+                "A function can't be both fast and c@1d",
+                func_def.line,
+                func_def.column,
+                self.verbose,
+            )
+            exit(1)
+
+        for func in funcs:
+            for name in names:
+                add_attribute(func, FUNCTION_HINTS[name])
+
+    def memo_hint(self, func_def: FunctionDef) -> Hint | None:
+        """
+        The reca11 hint of a function, if it has one. Only functions whose
+        result depends on nothing but their arguments can be memoized.
+        """
+        hint = next((h for h in func_def.hints if h.name == MEMOIZE_HINT), None)
+        if hint is None:
+            return None
+        if hint.value is not None and hint.value < 1:
+            error_out(
+                f"'{hint.name}' needs a capacity of at least 1",
+                hint.line,
+                hint.column,
+                self.verbose,
+            )
+            exit(1)
+        if isinstance(func_def.type, VoidType) or any(
+            isinstance(p.type, PointerOf) for p in func_def.parameters
+        ):
+            error_out(
+                "A reca11 function must return a value and can't take pointers",
+                hint.line,
+                hint.column,
+                self.verbose,
+            )
+            exit(1)
+        impure = self.impure_call(func_def.body, {func_def.identifier.name})
+        if impure is not None:
+            error_out(
+                f"A reca11 function can't call '{impure}', it has side effects",
+                hint.line,
+                hint.column,
+                self.verbose,
+            )
+            exit(1)
+        return hint
+
+    def impure_call(
+        self,
+        node: ASTNode,
+        seen: set[str],
+        allowed: tuple[str, ...] = PURE_PREDEFS,
+        memoized: bool = True,
+    ) -> str | None:
+        """
+        First function node calls, directly or through other functions, that
+        is a predefined one outside allowed or, unless memoized, has a reca11
+        table
+        """
+        functions = {f.identifier.name: f for f in self.ast.functions}
+        for name in sorted(called_functions(node)):
+            if name in functions:
+                if name in seen:
+                    continue
+                seen.add(name)
+                if not memoized and any(
+                    h.name == MEMOIZE_HINT for h in functions[name].hints
+                ):
+                    return name
+                impure = self.impure_call(
+                    functions[name].body, seen, allowed, memoized
+                )
+                if impure is not None:
+                    return impure
+            elif name not in allowed:
+                return name
+        return None
+
+    def check_thread_safe(self, node: ASTNode, where: str, at: ASTNode) -> None:
+        """
+        Errors if node, run on other threads, calls a function keeping state
+        the threads would share without locking
+        """
+        unsafe = self.impure_call(node, set(), THREAD_SAFE_PREDEFS, memoized=False)
+        if unsafe is not None:
+            error_out(
+                f"{where} can't call '{unsafe}', it isn't thread safe",
+                at.line,
+                at.column,
+                self.verbose,
+            )
+            exit(1)
+
+    def loop_metadata(self, stmt: AsStatement) -> ir.MDValue | None:
+        """Turns the hints of an as loop into its llvm.loop metadata"""
+        assert self.module is not None
+        properties = []
+        for hint in stmt.hints:
+            if hint.value is not None and hint.value < 1:
+                error_out(
+                    f"'{hint.name}' needs a count of at least 1",
+                    hint.line,
+                    hint.column,
+                    self.verbose,
+                )
+                exit(1)
+
+            if hint.name == UNROLL_HINT:
+                if hint.value is None:
+                    properties.append(["llvm.loop.unroll.enable"])
+                else:
+                    properties.append(
+                        ["llvm.loop.unroll.count", ir.Constant(i32, hint.value)]
+                    )
+            elif hint.name == VECTORIZE_HINT:
+                properties.append(
+                    ["llvm.loop.vectorize.enable", ir.Constant(i1, True)]
+                )
+                if hint.value is not None:
+                    properties.append(
+                        ["llvm.loop.vectorize.width", ir.Constant(i32, hint.value)]
+                    )
+            else:
+                error_out(
+                    f"'{hint.name}' is not a loop hint",
+                    hint.line,
+                    hint.column,
+                    self.verbose,
+                )
+                exit(1)
+
+        if not properties:
+            return None
+        return add_loop_metadata(
+            self.module, [self.module.add_metadata(p) for p in properties]
+        )
+
+    def build_dispatcher(
+        self, func: ir.Function, generic: ir.Function, native: ir.Function
+    ) -> None:
+        assert self.module is not None
+        block = func.append_basic_block(name="entry")
+        builder = ir.IRBuilder(block)
+
+        level = builder.load(get_cpu_level_global(self.module), name="cpu_level")
+        target = builder.select(level, native, generic, name="clone")
+        result = builder.call(
+            target,
+            func.args,
+            cconv=USER_CALLING_CONVENTION,
+            tail="musttail",
+            name="call_clone",
         )
+        if isinstance(func.function_type.return_type, ir.VoidType):
+            builder.ret_void()
+        else:
+            builder.ret(result)
 
+    def build_function_body(self, func_def: FunctionDef, func: ir.Function) -> None:
         # Block containing function body
         block = func.append_basic_block(name="entry")
 
@@ -57,6 +458,31 @@ class ModuleBuilder:
 
         block_values: dict[str, ir.Value] = {}
 
+        if self.di_file is not None and self.di_unit is not None:
+            self.di_scope = add_subprogram(
+                builder.module,
+                self.di_file,
+                self.di_unit,
+                func,
+                self.source_row(func_def),
+            )
+            self.set_location(builder, func_def)
+
+        counts = self.pgo_counts(builder, "entry", func_def)
+        if counts is not None:
+            func.set_metadata(
+                "prof",
+                builder.module.add_metadata(
+                    ["function_entry_count", ir.Constant(i64, counts[0])]
+                ),
+            )
+
+        if self.instrument:
+            builder.call(
+                builder.module.get_global(FUNC_PREFIX + "prof.enter"),
+                [ir.Constant(i64, self.ast.functions.index(func_def))],
+            )
+
         # Set function parameters
         for i, param in enumerate(func_def.parameters):
             param_var = builder.alloca(
@@ -82,12 +508,123 @@ class ModuleBuilder:
                 )
                 exit(1)
 
+        hoist_allocas(func)
+        self.mark_tail_calls(func)
+        if self.instrument:
+            add_exit_hooks(
+                func,
+                builder.module.get_global(FUNC_PREFIX + "prof.exit"),
+                self.ast.functions.index(func_def),
+            )
+        self.di_scope = None
+
+    def source_row(self, node: ASTNode) -> int:
+        if self.debug_wrap > 0:
+            return (node.column - 1) // self.debug_wrap + 1
+        return node.line
+
+    def set_location(self, builder: ir.IRBuilder, node: ASTNode) -> None:
+        """Attributes the instructions built from here on to node's source position"""
+        if self.di_scope is None:
+            return
+        line, column = node.line, node.column
+        # 1eft sources are a single line, laid out in rows of fixed width
+        if self.debug_wrap > 0:
+            line = self.source_row(node)
+            column = (node.column - 1) % self.debug_wrap + 1
+        builder.debug_metadata = builder.module.add_debug_info(
+            "DILocation", {"line": line, "column": column, "scope": self.di_scope}
+        )
+
+    def pgo_counts(
+        self,
+        builder: ir.IRBuilder,
+        kind: str,
+        node: ASTNode,
+        condition: ir.Value | None = None,
+    ) -> list[int] | None:
+        """
+        Registers a profiled site: a function entry, or a branch on condition.
+        With --pgo-gen a counter is incremented here, with --pgo-use the
+        recorded counts are returned, taken branch first.
+        """
+        slots = 1 if condition is None else 2
+        first = self.pgo_slots
+        self.pgo_slots += slots
+        site = f"{builder.function.name}:{node.line}:{node.column}:{kind}"
+        self.pgo_sites.append(site)
+
+        if self.pgo_gen is not None:
+            counter = add_pgo_counter(builder.module, len(self.pgo_sites) - 1, slots)
+            self.pgo_counters.append(counter)
+            # Branch counters count false in slot 0 and true in slot 1
+            slot = ZERO if condition is None else builder.zext(condition, i32)
+            ptr = builder.gep(counter, [ZERO, slot], inbounds=True)
+            builder.store(builder.add(builder.load(ptr), ir.Constant(i64, 1)), ptr)
+
+        if self.pgo_use is None or first + slots > len(self.pgo_use.counts):
+            return None
+        return self.pgo_use.counts[first : first + slots][::-1]
+
+    def set_branch_weights(self, block: ir.Block, counts: list[int] | None) -> None:
+        if counts is not None and isinstance(block.terminator, ir.ConditionalBranch):
+            block.terminator.set_weights(scale_weights(counts))
+
+    def mark_tail_calls(self, func: ir.Function) -> None:
+        """
+        Marks calls directly followed by a return of their result as tail calls,
+        so recursion runs in constant stack space
+        """
+        for block in func.blocks:
+            if len(block.instructions) < 2:
+                continue
+            call, ret = block.instructions[-2], block.instructions[-1]
+
+            # A branch to a block that only returns void returns just the same,
+            # so fold it into a return that can follow a tail call
+            if (
+                isinstance(call, ir.CallInstr)
+                and isinstance(ret, ir.Branch)
+                and len(ret.operands) == 1
+            ):
+                target = cast(ir.Block, ret.operands[0])
+                if len(target.instructions) == 1 and isinstance(
+                    target.instructions[0], ir.Ret
+                ):
+                    if target.instructions[0].return_value is None:
+                        block.instructions.pop()
+                        block.terminator = None
+                        ret = ir.IRBuilder(block).ret_void()
+            if not (isinstance(call, ir.CallInstr) and isinstance(ret, ir.Ret)):
+                continue
+            callee = call.callee
+            if not isinstance(callee, ir.Function) or callee.is_declaration:
+                continue
+
+            returns_call = (
+                ret.return_value is call
+                if ret.return_value is not None
+                else isinstance(callee.function_type.return_type, ir.VoidType)
+            )
+            # Pointer arguments may point into this frame, which a tail call frees
+            if not returns_call or any(arg.type.is_pointer for arg in call.args):
+                continue
+
+            if (
+                callee.function_type == func.function_type
+                and callee.calling_convention == func.calling_convention
+            ):
+                call.tail = "musttail"
+            else:
+                call.tail = "tail"
+
     def build_statement(
         self, builder: ir.IRBuilder, stmt: Statement, block_values: dict[str, ir.Value]
     ) -> None:
         # DCE
         if cast(ir.Block, builder.block).is_terminated:
             return
+        self.set_location(builder, stmt)
 
         if isinstance(stmt, ExpressionStatement):
             self.build_expression(builder, stmt.expression, block_values)
@@ -112,6 +649,14 @@ class ModuleBuilder:
                 )
                 exit(1)
 
+            if isinstance(stmt.type, ArrayOf) and stmt.type.size < 1:
+                error_out(
+                    "An array needs a size of at least 1",
+                    stmt.type.line,
+                    stmt.type.column,
+                    self.verbose,
+                )
+                exit(1)
             value = builder.alloca(get_llvm_type(stmt.type), name=stmt.identifier.name)
             block_values[stmt.identifier.name] = value
 
@@ -131,8 +676,20 @@ class ModuleBuilder:
                     )
                     exit(1)
                 ass_var = block_values[stmt.lhs.name]
+                if isinstance(ass_var.type.pointee, ir.ArrayType):
+                    error_out(
+                        f"Array '{stmt.lhs.name}' can only be assigned by element",
+                        stmt.lhs.line,
+                        stmt.lhs.column,
+                        self.verbose,
+                    )
+                    exit(1)
+
+            elif isinstance(stmt.lhs, IndexExpr):
+                ass_var = self.element_pointer(builder, stmt.lhs, block_values)
 
-            rich.print(ass_var)
+            if self.verbose:
+                rich.print(ass_var)
 
             if ass_var is None:
                 error_out(
@@ -143,98 +700,27 @@ class ModuleBuilder:
                 )
                 exit(1)
 
-            rich.print(stmt.rhs)
+            if self.verbose:
+                rich.print(stmt.rhs)
             assign_val = self.build_expression(builder, stmt.rhs, block_values)
-            rich.print(assign_val)
+            if self.verbose:
+                rich.print(assign_val)
 
             # We check if pointer to char because alloca is stored as a pointer
             if safe_ir_type(assign_val) == i8ptr and safe_ir_type(ass_var) == i8ptr:
                 # Get first character of string
                 assign_val = builder.load(assign_val)
 
-            rich.print(assign_val)
+            if self.verbose:
+                rich.print(assign_val)
             builder.store(assign_val, ass_var)
 
         elif isinstance(stmt, IfStatement):
-
-            def build_elseif(
-                builder: ir.IRBuilder,
-                if_stmt: IfStatement,
-                index: int,
-                block_values: dict[str, ir.Value],
-            ) -> None:
-                elseif = if_stmt.else_ifs[index]
-                condition = self.build_expression(
-                    builder, elseif.condition, block_values
-                )
-                verify_ir_type(
-                    condition,
-                    get_llvm_type(BooleanType),
-                    elseif.condition.line,
-                    elseif.condition.column,
-                    self.verbose,
-                )
-
-                # This is the last elseif and there is no else
-                if index + 1 >= len(if_stmt.else_ifs) and if_stmt.else_body is None:
-                    with builder.if_then(condition):
-                        scope = block_values.copy()
-                        for statement in elseif.body.statements:
-                            self.build_statement(builder, statement, scope)
-                    return
-
-                with builder.if_else(condition) as (then, otherwise):
-                    with then:
-                        scope = block_values.copy()
-                        for statement in elseif.body.statements:
-                            self.build_statement(builder, statement, scope)
-                    with otherwise:
-                        # Next statement is an elseif
-                        if index + 1 < len(if_stmt.else_ifs):
-                            build_elseif(builder, if_stmt, index + 1, block_values)
-
-                        elif if_stmt.else_body is not None:
-                            scope = block_values.copy()
-                            for statement in if_stmt.else_body.statements:
-                                self.build_statement(builder, statement, scope)
-
-                        else:
-                            error_out("Unreachable state reached", 1, 1, self.verbose)
-                            exit(1)
-
-            condition = self.build_expression(builder, stmt.condition, block_values)
-            verify_ir_type(
-                condition,
-                get_llvm_type(BooleanType),
-                stmt.condition.line,
-                stmt.condition.column,
-                self.verbose,
-            )
-
-            if stmt.else_body is None and len(stmt.else_ifs) == 0:
-                with builder.if_then(condition):
-                    scope = block_values.copy()
-                    for statement in stmt.body.statements:
-                        self.build_statement(builder, statement, scope)
-
+            switch = self.switch_arms(stmt)
+            if switch is not None:
+                self.build_switch(builder, stmt, *switch, block_values)
             else:
-                with builder.if_else(condition) as (then, otherwise):
-                    with then:
-                        scope = block_values.copy()
-                        for statement in stmt.body.statements:
-                            self.build_statement(builder, statement, scope)
-                    with otherwise:
-                        if len(stmt.else_ifs) > 0:
-                            build_elseif(builder, stmt, 0, block_values)
-
-                        elif stmt.else_body is not None:
-                            scope = block_values.copy()
-                            for statement in stmt.else_body.statements:
-                                self.build_statement(builder, statement, scope)
-
-                        else:
-                            error_out("Unreachable state reached", 1, 1, self.verbose)
-                            exit(1)
+                self.build_if(builder, stmt, block_values)
 
         elif isinstance(stmt, AsStatement):
             this_func: ir.Function = builder.function
@@ -252,22 +738,464 @@ class ModuleBuilder:
                 stmt.condition.column,
                 self.verbose,
             )
+            counts = self.pgo_counts(builder, "loop", stmt, condition)
             builder.cbranch(condition, loop_bb, loop_end_bb)
+            self.set_branch_weights(builder.block, counts)
 
             builder.position_at_start(loop_bb)
             scope = block_values.copy()
             for statement in stmt.body.statements:
                 self.build_statement(builder, statement, scope)
-            builder.branch(loop_cond_bb)
+            self.set_location(builder, stmt)
+            back_edge = builder.branch(loop_cond_bb)
+            loop_id = self.loop_metadata(stmt)
+            if loop_id is not None:
+                back_edge.set_metadata("llvm.loop", loop_id)
 
             builder.position_at_start(loop_end_bb)
 
+        elif isinstance(stmt, QarStatement):
+            self.build_qar(builder, stmt, block_values)
+
         else:
             error_out(
                 f"Unknown statement: {type(stmt)}", stmt.line, stmt.column, self.verbose
             )
             exit(1)
 
+    def build_qar(
+        self,
+        builder: ir.IRBuilder,
+        stmt: QarStatement,
+        block_values: dict[str, ir.Value],
+    ) -> None:
+        """
+        Outlines the body of a qar loop into a job the runtime pool runs on
+        chunks of the range. The job reaches the variables it uses through
+        a context of pointers to them.
+        """
+        if stmt.index.name in block_values:
+            error_out(
+                f"Variable '{stmt.index.name}' already declared",
+                stmt.index.line,
+                stmt.index.column,
+                self.verbose,
+            )
+            exit(1)
+        if contains_statement(stmt.body, Return):
+            error_out(
+                "Can't ret from a qar loop, its body runs on other threads",
+                stmt.line,
+                stmt.column,
+                self.verbose,
+            )
+            exit(1)
+        self.check_thread_safe(stmt.body, "A qar loop", stmt)
+        if stmt.reduction is not None:
+            total = block_values.get(stmt.reduction.name)
+            if total is None or total.type != get_llvm_type(DecimalType).as_pointer():
+                error_out(
+                    "The total of a qar loop must be a dect variable",
+                    stmt.reduction.line,
+                    stmt.reduction.column,
+                    self.verbose,
+                )
+                exit(1)
+
+        bounds = []
+        for bound in (stmt.start, stmt.end):
+            value = self.build_expression(builder, bound, block_values)
+            verify_ir_type(
+                value,
+                get_llvm_type(DecimalType),
+                bound.line,
+                bound.column,
+                self.verbose,
+            )
+            bounds.append(value)
+
+        # Only the variables the body names are captured, the rest stay
+        # promotable to registers
+        names = sorted(identifier_names(stmt.body) & block_values.keys())
+        if stmt.reduction is not None and stmt.reduction.name not in names:
+            names.append(stmt.reduction.name)
+        context_type = ir.LiteralStructType([block_values[n].type for n in names])
+        with builder.goto_entry_block():
+            context = builder.alloca(context_type, name="qar.context")
+        for i, name in enumerate(names):
+            builder.store(
+                block_values[name],
+                builder.gep(context, [ZERO, ir.Constant(i32, i)], inbounds=True),
+            )
+
+        job = self.build_qar_job(builder.function, stmt, names, context_type)
+        builder.call(
+            builder.module.get_global(FUNC_PREFIX + "pool.run"),
+            [job, builder.bitcast(context, VOID_PTR), *bounds],
+        )
+
+    def build_qar_job(
+        self,
+        parent: ir.Function,
+        stmt: QarStatement,
+        names: list[str],
+        context_type: ir.LiteralStructType,
+    ) -> ir.Function:
+        """The body of a qar loop as a function running it over [first, last)"""
+        module = parent.module
+        job = ir.Function(
+            module, QAR_JOB_TYPE, name=module.get_unique_name(parent.name + ".qar")
+        )
+        context_arg, first, last = job.args
+        entry = job.append_basic_block(name="entry")
+        cond = job.append_basic_block(name="qarcond")
+        body = job.append_basic_block(name="qarloop")
+        end = job.append_basic_block(name="qarend")
+        builder = ir.IRBuilder(entry)
+
+        parent_scope = self.di_scope
+        if self.di_file is not None and self.di_unit is not None:
+            self.di_scope = add_subprogram(
+                module, self.di_file, self.di_unit, job, self.source_row(stmt)
+            )
+        self.set_location(builder, stmt)
+
+        context = builder.bitcast(context_arg, context_type.as_pointer())
+        scope: dict[str, ir.Value] = {
+            name: builder.load(
+                builder.gep(context, [ZERO, ir.Constant(i32, i)], inbounds=True),
+                name=name,
+            )
+            for i, name in enumerate(names)
+        }
+        # Each job sums into its own total and adds it to the shared one once
+        shared_total = None
+        if stmt.reduction is not None:
+            shared_total = scope[stmt.reduction.name]
+            private_total = builder.alloca(i64, name=stmt.reduction.name)
+            builder.store(ir.Constant(i64, 0), private_total)
+            scope[stmt.reduction.name] = private_total
+        index = builder.alloca(i64, name=stmt.index.name)
+        scope[stmt.index.name] = index
+        counter = builder.alloca(i64, name="qar.i")
+        builder.store(first, counter)
+        builder.branch(cond)
+
+        builder.position_at_start(cond)
+        current = builder.load(counter, name="current")
+        builder.cbranch(builder.icmp_signed("<", current, last), body, end)
+
+        # The body gets a copy of the index, so assigning to it can't derail
+        # the loop
+        builder.position_at_start(body)
+        builder.store(current, index)
+        for statement in stmt.body.statements:
+            self.build_statement(builder, statement, scope)
+        self.set_location(builder, stmt)
+        builder.store(builder.add(current, ir.Constant(i64, 1)), counter)
+        builder.branch(cond)
+
+        builder.position_at_start(end)
+        if shared_total is not None:
+            builder.atomic_rmw(
+                "add", shared_total, builder.load(private_total), "monotonic"
+            )
+        builder.ret_void()
+
+        hoist_allocas(job)
+        self.di_scope = parent_scope
+        return job
+
+    def build_spawn(
+        self,
+        builder: ir.IRBuilder,
+        expr: ExecExpr,
+        block_values: dict[str, ir.Value],
+    ) -> ir.Value:
+        """
+        exec sqawz %e func args !e copies the arguments into a task record
+        and queues it, the result is the handle wa1t takes
+        """
+        module = builder.module
+        target = expr.arguments[0] if expr.arguments else None
+        func = None
+        if isinstance(target, IdentifierExpr) and (
+            target.identifier.name not in block_values
+        ):
+            try:
+                func = module.get_global(FUNC_PREFIX + target.identifier.name)
+            except KeyError:
+                pass
+        if not isinstance(func, ir.Function) or func.function_type.return_type != (
+            get_llvm_type(DecimalType)
+        ):
+            error_out(
+                f"{SPAWN_FUNCTION} takes a function returning dect and its arguments",
+                expr.line,
+                expr.column,
+                self.verbose,
+            )
+            exit(1)
+        if len(expr.arguments) - 1 != len(func.args):
+            error_out(
+                f"Function '{target.identifier.name}' expects {len(func.args)} "
+                f"arguments, got {len(expr.arguments) - 1}",
+                expr.line,
+                expr.column,
+                self.verbose,
+            )
+            exit(1)
+        self.check_thread_safe(
+            ExecExpr(expr.line, expr.column, target.identifier, []),
+            f"A {SPAWN_FUNCTION} task",
+            expr,
+        )
+
+        arg_values = []
+        for arg, param in zip(expr.arguments[1:], func.args):
+            value = self.build_expression(builder, arg, block_values)
+            verify_ir_type(value, param.type, arg.line, arg.column, self.verbose)
+            arg_values.append(value)
+
+        record_type = ir.LiteralStructType(
+            [TASK_HEADER_TYPE, ir.LiteralStructType(func.function_type.args)]
+        )
+        size = builder.ptrtoint(
+            builder.gep(
+                ir.Constant(record_type.as_pointer(), None), [ir.Constant(i32, 1)]
+            ),
+            i64,
+        )
+        task = builder.call(get_malloc_function(module), [size], name="task")
+        record = builder.bitcast(task, record_type.as_pointer())
+        header = [self.task_thunk(func, record_type), ir.Constant(i64, 0)]
+        for i, value in enumerate(header):
+            field = builder.gep(
+                record, [ZERO, ZERO, ir.Constant(i32, i)], inbounds=True
+            )
+            builder.store(value, field)
+        for i, value in enumerate(arg_values):
+            field = builder.gep(
+                record, [ZERO, ir.Constant(i32, 1), ir.Constant(i32, i)], inbounds=True
+            )
+            builder.store(value, field)
+        return builder.call(
+            module.get_global(FUNC_PREFIX + "task.spawn"), [task], name="handle"
+        )
+
+    def task_thunk(
+        self, func: ir.Function, record_type: ir.LiteralStructType
+    ) -> ir.Function:
+        """Calls func with the arguments in a task record, one per function"""
+        module = func.module
+        try:
+            return module.get_global(func.name + ".task")
+        except KeyError:
+            pass
+        thunk = ir.Function(module, TASK_THUNK_TYPE, name=func.name + ".task")
+        builder = ir.IRBuilder(thunk.append_basic_block(name="entry"))
+        record = builder.bitcast(thunk.args[0], record_type.as_pointer())
+        args = [
+            builder.load(
+                builder.gep(
+                    record,
+                    [ZERO, ir.Constant(i32, 1), ir.Constant(i32, i)],
+                    inbounds=True,
+                )
+            )
+            for i in range(len(func.args))
+        ]
+        builder.ret(builder.call(func, args, name="result"))
+        return thunk
+
+    def build_if(
+        self,
+        builder: ir.IRBuilder,
+        stmt: IfStatement,
+        block_values: dict[str, ir.Value],
+    ) -> None:
+        """Builds the 1f and its e1se1f arms as a flat chain of compares"""
+        this_func: ir.Function = builder.function
+        end_bb: ir.Block = this_func.append_basic_block("endif")
+        arms: list[tuple[ASTNode, Expression, Block]] = [
+            (stmt, stmt.condition, stmt.body)
+        ] + [(e, e.condition, e.body) for e in stmt.else_ifs]
+
+        for i, (node, cond, body) in enumerate(arms):
+            self.set_location(builder, node)
+            condition = self.build_expression(builder, cond, block_values)
+            verify_ir_type(
+                condition,
+                get_llvm_type(BooleanType),
+                cond.line,
+                cond.column,
+                self.verbose,
+            )
+            counts = self.pgo_counts(builder, "branch", node, condition)
+
+            then_bb = this_func.append_basic_block("if")
+            if i + 1 == len(arms) and stmt.else_body is None:
+                else_bb = end_bb
+            else:
+                else_bb = this_func.append_basic_block("else")
+            builder.cbranch(condition, then_bb, else_bb)
+            self.set_branch_weights(builder.block, counts)
+
+            builder.position_at_start(then_bb)
+            scope = block_values.copy()
+            for statement in body.statements:
+                self.build_statement(builder, statement, scope)
+            if not cast(ir.Block, builder.block).is_terminated:
+                builder.branch(end_bb)
+
+            builder.position_at_start(else_bb)
+
+        if stmt.else_body is not None:
+            scope = block_values.copy()
+            for statement in stmt.else_body.statements:
+                self.build_statement(builder, statement, scope)
+            if not cast(ir.Block, builder.block).is_terminated:
+                builder.branch(end_bb)
+            builder.position_at_start(end_bb)
+
+    def switch_arms(self, stmt: IfStatement) -> tuple[Expression, list[int]] | None:
+        """
+        Returns the compared expression and the constants when every arm of
+        the chain tests the same expression with eq against a distinct literal
+        """
+        conditions = [stmt.condition] + [e.condition for e in stmt.else_ifs]
+        if len(conditions) < SWITCH_MIN_ARMS:
+            return None
+
+        scrutinee = None
+        values: list[int] = []
+        for cond in conditions:
+            if not isinstance(cond, EqualsExpr):
+                return None
+            if isinstance(cond.rhs, DecimalLiteral):
+                expr, value = cond.lhs, cond.rhs.value
+            elif isinstance(cond.lhs, DecimalLiteral):
+                expr, value = cond.rhs, cond.lhs.value
+            else:
+                return None
+
+            if scrutinee is None:
+                scrutinee = expr
+            elif not same_expression(scrutinee, expr):
+                return None
+            values.append(value)
+
+        # The switch evaluates the expression once, calls could have side effects
+        if scrutinee is None or contains_expression(scrutinee, ExecExpr):
+            return None
+        if len(set(values)) != len(values):
+            return None
+        return scrutinee, values
+
+    def build_switch(
+        self,
+        builder: ir.IRBuilder,
+        stmt: IfStatement,
+        scrutinee: Expression,
+        values: list[int],
+        block_values: dict[str, ir.Value],
+    ) -> None:
+        value = self.build_expression(builder, scrutinee, block_values)
+        verify_ir_type(
+            value,
+            get_llvm_type(DecimalType),
+            scrutinee.line,
+            scrutinee.column,
+            self.verbose,
+        )
+
+        this_func: ir.Function = builder.function
+        default_bb: ir.Block = this_func.append_basic_block("default")
+        switch = builder.switch(value, default_bb)
+        arms: list[tuple[ASTNode, Block | None, ir.Block]] = []
+        for (node, body), case_value in zip(
+            [(stmt, stmt.body)] + [(e, e.body) for e in stmt.else_ifs], values
+        ):
+            case_bb = this_func.append_basic_block("case")
+            switch.add_case(ir.Constant(get_llvm_type(DecimalType), case_value), case_bb)
+            arms.append((node, body, case_bb))
+        arms.insert(0, (stmt, stmt.else_body, default_bb))
+        end_bb: ir.Block = this_func.append_basic_block("endif")
+
+        # Switch weights list the default destination first, like arms
+        weights: list[int] = []
+        for i, (node, body, bb) in enumerate(arms):
+            builder.position_at_start(bb)
+            self.set_location(builder, node)
+            counts = self.pgo_counts(builder, "default" if i == 0 else "case", node)
+            if counts is not None:
+                weights.append(counts[0])
+
+            if body is not None:
+                scope = block_values.copy()
+                for statement in body.statements:
+                    self.build_statement(builder, statement, scope)
+            if not cast(ir.Block, builder.block).is_terminated:
+                builder.branch(end_bb)
+
+        if len(weights) == len(arms):
+            switch.set_weights(scale_weights(weights))
+        builder.position_at_start(end_bb)
+
+    def element_pointer(
+        self,
+        builder: ir.IRBuilder,
+        expr: IndexExpr | AddressOfIndexExpr,
+        block_values: dict[str, ir.Value],
+    ) -> ir.Value:
+        """
+        Pointer to an array element. The inbounds gep on the array type tells
+        LLVM the bounds, indices computed from literals alone are checked here.
+        """
+        name = expr.identifier.name
+        if name not in block_values:
+            error_out(
+                f"Variable '{name}' not declared in this scope",
+                expr.identifier.line,
+                expr.identifier.column,
+                self.verbose,
+            )
+            exit(1)
+        array = block_values[name]
+        array_type = array.type.pointee
+        if not isinstance(array_type, ir.ArrayType):
+            error_out(
+                f"'{name}' is not an array",
+                expr.identifier.line,
+                expr.identifier.column,
+                self.verbose,
+            )
+            exit(1)
+
+        index = self.build_expression(builder, expr.index, block_values)
+        verify_ir_type(
+            index,
+            get_llvm_type(DecimalType),
+            expr.index.line,
+            expr.index.column,
+            self.verbose,
+        )
+        constant = constant_value(expr.index)
+        if constant is None and isinstance(index, ir.Constant):
+            constant = index.constant
+        if constant is not None and not (0 <= constant < array_type.count):
+            error_out(
+                f"Index {constant} is out of bounds of '{name}', "
+                f"which has {array_type.count} elements",
+                expr.index.line,
+                expr.index.column,
+                self.verbose,
+            )
+            exit(1)
+        return builder.gep(
+            array, [ir.Constant(i64, 0), index], inbounds=True, name=name + ".addr"
+        )
+
     def build_expression(
         self, builder: ir.IRBuilder, expr: Expression, block_values: dict[str, ir.Value]
     ) -> ir.Value:
@@ -291,9 +1219,25 @@ class ModuleBuilder:
                 )
                 exit(1)
             var = block_values[expr.identifier.name]
+            if isinstance(var.type.pointee, ir.ArrayType):
+                error_out(
+                    f"Array '{expr.identifier.name}' can't be used as a value, "
+                    "index it with ~ or take its addr",
+                    expr.identifier.line,
+                    expr.identifier.column,
+                    self.verbose,
+                )
+                exit(1)
 
             return builder.load(var, name=expr.identifier.name)
 
+        elif isinstance(expr, IndexExpr):
+            element = self.element_pointer(builder, expr, block_values)
+            return builder.load(element, name=expr.identifier.name + ".elem")
+
+        elif isinstance(expr, AddressOfIndexExpr):
+            return self.element_pointer(builder, expr, block_values)
+
         elif isinstance(expr, AddressOfExpr):
             if expr.identifier.name not in block_values:
                 error_out(
@@ -303,7 +1247,11 @@ class ModuleBuilder:
                     self.verbose,
                 )
                 exit(1)
-            return block_values[expr.identifier.name]
+            var = block_values[expr.identifier.name]
+            # The address of an array is a pointer to its first element
+            if isinstance(var.type.pointee, ir.ArrayType):
+                return builder.gep(var, [ZERO, ZERO], inbounds=True)
+            return var
 
         elif isinstance(expr, DerefExpr):
             value = self.build_expression(builder, expr.value, block_values)
@@ -319,9 +1267,13 @@ class ModuleBuilder:
 
         elif isinstance(expr, ExecExpr):
             func_name = expr.identifier.name
+            if func_name == SPAWN_FUNCTION:
+                return self.build_spawn(builder, expr, block_values)
             call_func_name = FUNC_PREFIX + func_name
             try:
-                func = builder.module.get_global(call_func_name)
+                func = self.call_redirects.get(call_func_name) or (
+                    builder.module.get_global(call_func_name)
+                )
             except KeyError:
                 error_out(
                     f"Function '{func_name}' not found",
@@ -429,8 +1381,9 @@ class ModuleBuilder:
         elif isinstance(expr, AddExpr) or isinstance(expr, SubExpr):
             lhs = self.build_expression(builder, expr.lhs, block_values)
             rhs = self.build_expression(builder, expr.rhs, block_values)
-            rich.print(safe_ir_type(lhs))
-            rich.print(safe_ir_type(rhs))
+            if self.verbose:
+                rich.print(safe_ir_type(lhs))
+                rich.print(safe_ir_type(rhs))
             if safe_ir_type(lhs).is_pointer or (
                 safe_ir_type(rhs).is_pointer and isinstance(expr, AddExpr)
             ):
@@ -486,9 +1439,9 @@ class ModuleBuilder:
                 )
 
             if isinstance(expr, AddExpr):
-                return cast(ir.Instruction, builder.add(lhs, rhs, name=".addtmp"))
+                return self.build_arithmetic(builder, "add", lhs, rhs, expr)
 
-            return cast(ir.Instruction, builder.sub(lhs, rhs, name=".subtmp"))
+            return self.build_arithmetic(builder, "sub", lhs, rhs, expr)
 
         elif isinstance(expr, MulExpr):
             lhs = self.build_expression(builder, expr.lhs, block_values)
@@ -499,7 +1452,7 @@ class ModuleBuilder:
             verify_ir_type(
                 rhs, get_llvm_type(DecimalType), expr.line, expr.column, self.verbose
             )
-            return cast(ir.Instruction, builder.mul(lhs, rhs, name=".multmp"))
+            return self.build_arithmetic(builder, "mul", lhs, rhs, expr)
 
         elif isinstance(expr, DivExpr):
             lhs = self.build_expression(builder, expr.lhs, block_values)
@@ -531,3 +1484,32 @@ class ModuleBuilder:
                 self.verbose,
             )
             exit(1)
+
+    def build_arithmetic(
+        self,
+        builder: ir.IRBuilder,
+        op: str,
+        lhs: ir.Value,
+        rhs: ir.Value,
+        expr: Expression,
+    ) -> ir.Value:
+        """Builds a signed add, sub or mul following the overflow mode"""
+        if self.overflow == "trap":
+            with_overflow = getattr(builder, f"s{op}_with_overflow")
+            result = with_overflow(lhs, rhs, name=f".{op}ovf")
+            with builder.if_then(builder.extract_value(result, 1), likely=False):
+                builder.call(
+                    builder.module.get_global(FUNC_PREFIX + "overflow"),
+                    [
+                        ir.Constant(get_llvm_type(DecimalType), expr.line),
+                        ir.Constant(get_llvm_type(DecimalType), expr.column),
+                    ],
+                )
+                builder.unreachable()
+            return builder.extract_value(result, 0, name=f".{op}tmp")
+
+        flags = ["nsw"] if self.overflow == "nsw" else []
+        return cast(
+            ir.Instruction,
+            getattr(builder, op)(lhs, rhs, name=f".{op}tmp", flags=flags),
+        )
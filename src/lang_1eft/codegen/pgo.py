@@ -0,0 +1,130 @@
+from dataclasses import dataclass
+from hashlib import sha256
+from pathlib import Path
+from typing import cast
+
+import llvmlite.ir as ir
+
+from lang_1eft.pipeline.ast_definitions import *
+from lang_1eft.codegen.codegen_util import *
+
+PROFILE_MAGIC = "1eft-profile"
+MAX_BRANCH_WEIGHT = 2**32 - 1
+
+
+@dataclass(frozen=True)
+class Profile:
+    """Profile holds the summed counters of one or more --pgo-gen runs."""
+
+    checksum: str
+    counts: list[int]
+
+
+def profile_checksum(sites: list[str]) -> str:
+    """Identifies the instrumentation sites of a program, in order"""
+    return sha256("\n".join(sites).encode("utf-8")).hexdigest()[:16]
+
+
+def load_profile(paths: list[Path]) -> Profile:
+    checksum = None
+    counts: list[int] = []
+    for path in paths:
+        fields = path.read_text().split()
+        if len(fields) < 3 or fields[0] != PROFILE_MAGIC:
+            raise ValueError(f"{path} is not a 1eft profile")
+        if checksum is not None and fields[1] != checksum:
+            raise ValueError(f"{path} was generated from a different program")
+        checksum = fields[1]
+
+        run_counts = [int(c) for c in fields[3:]]
+        if len(run_counts) != int(fields[2]):
+            raise ValueError(f"{path} is truncated")
+        counts = [a + b for a, b in zip(counts, run_counts)] if counts else run_counts
+
+    if checksum is None:
+        raise ValueError("No profile given")
+    return Profile(checksum, counts)
+
+
+def scale_weights(weights: list[int]) -> list[int]:
+    """Branch weights are 32-bit, scale larger counts down keeping their ratio"""
+    scale = max(weights) // MAX_BRANCH_WEIGHT + 1
+    return [w // scale for w in weights]
+
+
+def add_pgo_counter(module: ir.Module, index: int, slots: int) -> ir.GlobalVariable:
+    counter_type = ir.ArrayType(i64, slots)
+    counter = ir.GlobalVariable(module, counter_type, name=f"{FUNC_PREFIX}pgo.{index}")
+    counter.linkage = "internal"
+    counter.initializer = ir.Constant(counter_type, None)  # type: ignore
+    return counter
+
+
+def add_pgo_dump_function(
+    module: ir.Module, counters: list[ir.GlobalVariable], path: Path, checksum: str
+) -> ir.Function:
+    """Writes every counter to the profile file, registered with atexit"""
+    fopen_func = get_fopen_function(module)
+    fprintf_func = get_fprintf_function(module)
+    fclose_func = get_fclose_function(module)
+    path_str = create_global_string(module, str(path), name=".pgo.path")
+    mode_str = create_global_string(module, "w", name=".mode.w")
+    header_str = create_global_string(
+        module, f"{PROFILE_MAGIC} {checksum} %ld\n", name=".fmt.pgo.header"
+    )
+    count_str = create_global_string(module, "%ld\n", name=".fmt.pgo.count")
+
+    dump = ir.Function(
+        module,
+        ir.FunctionType(get_llvm_type(VoidType), []),
+        name=FUNC_PREFIX + "pgo.dump",
+    )
+    dump.linkage = "internal"
+    entry = dump.append_basic_block(name="entry")
+    write = dump.append_basic_block(name="write")
+    done = dump.append_basic_block(name="done")
+    builder = ir.IRBuilder(entry)
+
+    file = builder.call(
+        fopen_func,
+        [
+            builder.gep(path_str, [ZERO, ZERO], inbounds=True),
+            builder.gep(mode_str, [ZERO, ZERO], inbounds=True),
+        ],
+    )
+    builder.cbranch(
+        builder.icmp_unsigned("==", file, ir.Constant(VOID_PTR, None)), done, write
+    )
+
+    builder.position_at_start(write)
+    total = sum(cast(ir.ArrayType, c.value_type).count for c in counters)
+    builder.call(
+        fprintf_func,
+        [
+            file,
+            builder.gep(header_str, [ZERO, ZERO], inbounds=True),
+            ir.Constant(i64, total),
+        ],
+    )
+    count_ptr = builder.gep(count_str, [ZERO, ZERO], inbounds=True)
+    for counter in counters:
+        for slot in range(cast(ir.ArrayType, counter.value_type).count):
+            value = builder.load(
+                builder.gep(counter, [ZERO, ir.Constant(i32, slot)], inbounds=True)
+            )
+            builder.call(fprintf_func, [file, count_ptr, value])
+    builder.call(fclose_func, [file])
+    builder.branch(done)
+
+    builder.position_at_start(done)
+    builder.ret_void()
+    return dump
+
+
+def add_pgo_dump_init(module: ir.Module, dump: ir.Function) -> None:
+    atexit_func = get_atexit_function(module)
+
+    main_func = module.get_global("main")
+    builder = ir.IRBuilder()
+    builder.position_at_start(main_func.entry_basic_block)
+    builder.call(atexit_func, [dump])
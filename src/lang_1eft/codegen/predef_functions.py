@@ -1,10 +1,44 @@
+from typing import cast
+
 import llvmlite.binding as llvm
 import llvmlite.ir as ir
 
 from lang_1eft.pipeline.ast_definitions import *
 from lang_1eft.codegen.codegen_util import *
+from lang_1eft.codegen.thread_pool import (
+    add_pool_run_function,
+    add_pool_start_function,
+    add_pool_work_function,
+    add_pool_worker_function,
+    add_task_find_function,
+    add_task_push_function,
+    add_task_run_function,
+    add_task_spawn_function,
+    add_thread_pool,
+    add_wa1t_function,
+)
+
+STDIN_BUFFER_SIZE = 1 << 16
+DECIMAL_TEXT_SIZE = 20  # 64-bit int + sign
+MAX_DECIMAL_DIGITS = 20  # of an unsigned 64-bit int
+POINTER_TEXT_SIZE = 19  # 0x + 16 hex digits + null terminator
+ONE_I64 = ir.Constant(i64, 1)
+RNG_STATE_WORDS = 4
+SPLITMIX_INCREMENT = 0x9E3779B97F4A7C15
+SPLITMIX_MULTIPLIERS = (0xBF58476D1CE4E5B9, 0x94D049BB133111EB)
 
-GETD_BUFFER_SIZE = 22  # 64-bit int + sign + null terminator + 1
+# Linux values of the open, lseek and mmap constants used by the file builtins
+OPEN_FLAGS = (
+    0,  # O_RDONLY
+    0o1 | 0o100 | 0o1000,  # O_WRONLY | O_CREAT | O_TRUNC
+    0o1 | 0o100 | 0o2000,  # O_WRONLY | O_CREAT | O_APPEND
+)
+NEW_FILE_PERMISSIONS = 0o644
+SEEK_SET, SEEK_CUR, SEEK_END = 0, 1, 2
+PROT_READ = 1
+MAP_PRIVATE = 2
+MADV_SEQUENTIAL = 2
+CLOCK_MONOTONIC = 1
 
 
 def wrap_main_function(module: ir.Module) -> None:
@@ -25,39 +59,238 @@ def wrap_main_function(module: ir.Module) -> None:
     builder = ir.IRBuilder()
     builder.position_at_start(start_func.entry_basic_block)
     time_func = get_time_function(module)
-    srand_func = get_srand_function(module)
+    srazd_func = module.get_global(FUNC_PREFIX + "srazd")
 
     # Auto seed random
     time_call = builder.call(time_func, [ir.Constant(VOID_PTR, None)], name="call_time")
-    builder.call(
-        srand_func,
-        [time_call],
-        name="call_srand",
-    )
+    builder.call(srazd_func, [time_call])
 
     func_type = ir.FunctionType(i32, [])
     func = ir.Function(module, func_type, name="main")
     block = func.append_basic_block(name="entry")
     builder.position_at_start(block)
     ret_val = builder.call(start_func, [], name="call_start")
+    builder.call(module.get_global(FUNC_PREFIX + "flush"), [])
     builder.ret(builder.trunc(ret_val, i32))
 
 
-def add_all_predef_functions(module: ir.Module) -> None:
+def add_all_predef_functions(
+    module: ir.Module, stdout_buffer: int = DEFAULT_STDOUT_BUFFER
+) -> None:
+    add_output_buffer(module, stdout_buffer)
+    add_write_all_function(module)
+    add_flush_function(module)
+    add_output_reserve_function(module)
+    add_output_bytes_function(module)
     add_wr1te_function(module)
+    add_wr1tec_function(module)
     add_wr1te1_function(module)
     add_wr1ted_function(module)
     add_wr1teb_function(module)
-    add_wr1tec_function(module)
     add_wr1tea_function(module)
+    add_input_buffer(module)
+    add_input_fill_function(module)
+    add_input_peek_function(module)
     add_getd_function(module)
+    add_rng_state(module)
     add_srazd_function(module)
     add_razdd_function(module)
+    add_f111razd_function(module)
+    add_zsec_function(module)
+    add_rdtsc_function(module)
+    add_barr1er_function(module)
+    add_file_open_function(module)
+    add_file_read_function(module)
+    add_file_write_function(module)
+    add_file_close_function(module)
+    add_file_size_function(module)
+    add_file_view_function(module)
+    add_thread_pool(module)
+    add_pool_work_function(module)
+    add_task_push_function(module)
+    add_task_find_function(module)
+    add_task_run_function(module)
+    add_pool_worker_function(module)
+    add_pool_start_function(module)
+    add_pool_run_function(module)
+    add_task_spawn_function(module)
+    add_wa1t_function(module)
+    add_xadd_function(module)
+    add_cas_function(module)
+
+
+def add_output_buffer(module: ir.Module, size: int) -> None:
+    """
+    Output of the wr1te family is collected here and written to stdout with
+    one write(2) when the buffer fills up, before getd reads and at exit
+    """
+    buffer_type = ir.ArrayType(i8, size)
+    buffer = ir.GlobalVariable(module, buffer_type, name=FUNC_PREFIX + "out.buf")
+    buffer.linkage = "internal"
+    buffer.initializer = ir.Constant(buffer_type, None)  # type: ignore
+    length = ir.GlobalVariable(module, i64, name=FUNC_PREFIX + "out.len")
+    length.linkage = "internal"
+    length.initializer = ir.Constant(i64, 0)  # type: ignore
+
+
+def get_output_buffer(module: ir.Module) -> tuple[ir.GlobalVariable, ir.GlobalVariable]:
+    return (
+        module.get_global(FUNC_PREFIX + "out.buf"),
+        module.get_global(FUNC_PREFIX + "out.len"),
+    )
+
+
+def add_write_all_function(module: ir.Module) -> ir.Function:
+    """Writes bytes to stdout, retrying short writes and giving up on errors"""
+    write_func = get_write_function(module)
+
+    write_all = ir.Function(
+        module,
+        ir.FunctionType(get_llvm_type(VoidType), [i8ptr, i64]),
+        name=FUNC_PREFIX + "out.write_all",
+    )
+    write_all.attributes.add("noinline")
+    entry = write_all.append_basic_block(name="entry")
+    loop = write_all.append_basic_block(name="loop")
+    body = write_all.append_basic_block(name="body")
+    wrote = write_all.append_basic_block(name="wrote")
+    done = write_all.append_basic_block(name="done")
+    builder = ir.IRBuilder(entry)
+    builder.branch(loop)
+
+    builder.position_at_start(loop)
+    data = builder.phi(i8ptr, name="data")
+    remaining = builder.phi(i64, name="remaining")
+    data.add_incoming(write_all.args[0], entry)
+    remaining.add_incoming(write_all.args[1], entry)
+    builder.cbranch(
+        builder.icmp_signed(">", remaining, ir.Constant(i64, 0)), body, done
+    )
+
+    builder.position_at_start(body)
+    written = builder.call(
+        write_func, [ir.Constant(i32, STDOUT_FD), data, remaining]
+    )
+    builder.cbranch(
+        builder.icmp_signed(">", written, ir.Constant(i64, 0)), wrote, done
+    )
+
+    builder.position_at_start(wrote)
+    data.add_incoming(builder.gep(data, [written], inbounds=True), wrote)
+    remaining.add_incoming(builder.sub(remaining, written), wrote)
+    builder.branch(loop)
+
+    builder.position_at_start(done)
+    builder.ret_void()
+    return write_all
+
+
+def add_flush_function(module: ir.Module) -> ir.Function:
+    write_all_func = module.get_global(FUNC_PREFIX + "out.write_all")
+    buffer, length = get_output_buffer(module)
+
+    flush = ir.Function(
+        module,
+        ir.FunctionType(get_llvm_type(VoidType), []),
+        name=FUNC_PREFIX + "flush",
+    )
+    flush.attributes.add("noinline")
+    block = flush.append_basic_block(name="entry")
+    builder = ir.IRBuilder(block)
+    builder.call(
+        write_all_func,
+        [builder.gep(buffer, [ZERO, ZERO], inbounds=True), builder.load(length)],
+    )
+    builder.store(ir.Constant(i64, 0), length)
+    builder.ret_void()
+    return flush
+
+
+def add_output_reserve_function(module: ir.Module) -> ir.Function:
+    """
+    Returns where the next count bytes of output go, flushing first when they
+    don't fit. The caller stores them and advances the length, see
+    advance_output.
+    """
+    flush_func = module.get_global(FUNC_PREFIX + "flush")
+    buffer, length = get_output_buffer(module)
+    size = cast(ir.ArrayType, buffer.value_type).count
+
+    reserve = ir.Function(
+        module,
+        ir.FunctionType(i8ptr, [i64]),
+        name=FUNC_PREFIX + "out.reserve",
+    )
+    reserve.attributes.add("alwaysinline")
+    entry = reserve.append_basic_block(name="entry")
+    full = reserve.append_basic_block(name="full")
+    done = reserve.append_basic_block(name="done")
+    builder = ir.IRBuilder(entry)
+
+    fits = builder.icmp_unsigned(
+        "<=",
+        builder.add(builder.load(length), reserve.args[0]),
+        ir.Constant(i64, size),
+    )
+    branch = builder.cbranch(fits, done, full)
+    # Flushes happen once per buffer size bytes
+    branch.set_weights([size, 1])
+
+    builder.position_at_start(full)
+    builder.call(flush_func, [])
+    builder.branch(done)
+
+    builder.position_at_start(done)
+    builder.ret(builder.gep(buffer, [ZERO, builder.load(length)], inbounds=True))
+    return reserve
+
+
+def advance_output(builder: ir.IRBuilder, count: ir.Value) -> None:
+    _, length = get_output_buffer(builder.module)
+    builder.store(builder.add(builder.load(length), count), length)
+
+
+def add_output_bytes_function(module: ir.Module) -> ir.Function:
+    """Appends bytes to the output buffer, writing ones larger than it directly"""
+    flush_func = module.get_global(FUNC_PREFIX + "flush")
+    write_all_func = module.get_global(FUNC_PREFIX + "out.write_all")
+    reserve_func = module.get_global(FUNC_PREFIX + "out.reserve")
+    memcpy_func = module.declare_intrinsic("llvm.memcpy", [i8ptr, i8ptr, i64])
+    buffer, _ = get_output_buffer(module)
+    size = cast(ir.ArrayType, buffer.value_type).count
+
+    output_bytes = ir.Function(
+        module,
+        ir.FunctionType(get_llvm_type(VoidType), [i8ptr, i64]),
+        name=FUNC_PREFIX + "out.bytes",
+    )
+    entry = output_bytes.append_basic_block(name="entry")
+    copy = output_bytes.append_basic_block(name="copy")
+    large = output_bytes.append_basic_block(name="large")
+    builder = ir.IRBuilder(entry)
+    data, count = output_bytes.args
+
+    branch = builder.cbranch(
+        builder.icmp_unsigned("<=", count, ir.Constant(i64, size)), copy, large
+    )
+    branch.set_weights([size, 1])
+
+    builder.position_at_start(copy)
+    dest = builder.call(reserve_func, [count])
+    builder.call(memcpy_func, [dest, data, count, ir.Constant(i1, 0)])
+    advance_output(builder, count)
+    builder.ret_void()
+
+    builder.position_at_start(large)
+    builder.call(flush_func, [])
+    builder.call(write_all_func, [data, count])
+    builder.ret_void()
+    return output_bytes
 
 
 def add_wr1te_function(module: ir.Module) -> ir.Function:
-    printf_func = get_printf_function(module)
-    fmt_str = create_global_string(module, "%s", name=".fmt.s")
+    strlen_func = get_strlen_function(module)
+    output_bytes_func = module.get_global(FUNC_PREFIX + "out.bytes")
 
     wri1te = ir.Function(
         module,
@@ -66,18 +299,20 @@ def add_wr1te_function(module: ir.Module) -> ir.Function:
         ),
         name=FUNC_PREFIX + "wr1te",
     )
+    wri1te.attributes.add("alwaysinline")
     block = wri1te.append_basic_block(name="entry")
     builder = ir.IRBuilder(block)
 
-    # Get pointer to the first character of the format string
-    fmt_ptr = builder.gep(fmt_str, [ZERO, ZERO], inbounds=True)
-    builder.call(printf_func, [fmt_ptr, wri1te.args[0]])
+    text = wri1te.args[0]
+    builder.call(output_bytes_func, [text, builder.call(strlen_func, [text])])
     builder.ret_void()
     return wri1te
 
 
 def add_wr1te1_function(module: ir.Module) -> ir.Function:
-    puts_func = get_puts_function(module)
+    wr1te_func = module.get_global(FUNC_PREFIX + "wr1te")
+    wr1tec_func = module.get_global(FUNC_PREFIX + "wr1tec")
+
     wri1te1 = ir.Function(
         module,
         ir.FunctionType(
@@ -85,38 +320,143 @@ def add_wr1te1_function(module: ir.Module) -> ir.Function:
         ),
         name=FUNC_PREFIX + "wr1te1",
     )
+    wri1te1.attributes.add("alwaysinline")
     block = wri1te1.append_basic_block(name="entry")
     builder = ir.IRBuilder(block)
-    builder.call(puts_func, [wri1te1.args[0]])
+    builder.call(wr1te_func, [wri1te1.args[0]])
+    builder.call(wr1tec_func, [ir.Constant(i8, ord("\n"))])
     builder.ret_void()
     return wri1te1
 
 
+def add_digit_tables(module: ir.Module) -> None:
+    """
+    Two digit strings "00".."99", and the powers of ten that fit in 64 bits
+    with 0 in place of 1, so zero counts as one digit too
+    """
+    pairs = bytearray("".join(f"{n:02d}" for n in range(100)).encode("ascii"))
+    pairs_const = ir.Constant(ir.ArrayType(i8, len(pairs)), pairs)
+    digit_pairs = ir.GlobalVariable(
+        module, pairs_const.type, name=FUNC_PREFIX + "digit.pairs"
+    )
+    digit_pairs.linkage = "internal"
+    digit_pairs.global_constant = True
+    digit_pairs.initializer = pairs_const  # type: ignore
+
+    powers_type = ir.ArrayType(i64, MAX_DECIMAL_DIGITS)
+    powers = ir.GlobalVariable(module, powers_type, name=FUNC_PREFIX + "digit.powers")
+    powers.linkage = "internal"
+    powers.global_constant = True
+    powers.initializer = ir.Constant(  # type: ignore
+        powers_type,
+        [ir.Constant(i64, 10**n if n > 0 else 0) for n in range(MAX_DECIMAL_DIGITS)],
+    )
+
+
 def add_wr1ted_function(module: ir.Module) -> ir.Function:
-    printf_func = get_printf_function(module)
-    fmt_str = create_global_string(module, "%ld", name=".fmt.d")
+    """
+    Formats straight into the output buffer, two digits per division by 100.
+    The digit count is known up front, so they are written back to front in
+    place.
+    """
+    reserve_func = module.get_global(FUNC_PREFIX + "out.reserve")
+    add_digit_tables(module)
+    digit_pairs = module.get_global(FUNC_PREFIX + "digit.pairs")
+    powers = module.get_global(FUNC_PREFIX + "digit.powers")
+    i16 = ir.IntType(16)
 
     wri1ted = ir.Function(
         module,
         ir.FunctionType(get_llvm_type(VoidType), [get_llvm_type(DecimalType)]),
         name=FUNC_PREFIX + "wr1ted",
     )
-    block = wri1ted.append_basic_block(name="entry")
-    builder = ir.IRBuilder(block)
+    wri1ted.attributes.add("alwaysinline")
+    entry = wri1ted.append_basic_block(name="entry")
+    pairs_loop = wri1ted.append_basic_block(name="pairs")
+    pairs_body = wri1ted.append_basic_block(name="pairs.body")
+    last = wri1ted.append_basic_block(name="last")
+    last_pair = wri1ted.append_basic_block(name="last.pair")
+    last_digit = wri1ted.append_basic_block(name="last.digit")
+    done = wri1ted.append_basic_block(name="done")
+    builder = ir.IRBuilder(entry)
 
-    fmt_ptr = builder.gep(
-        fmt_str,
-        [ZERO, ZERO],
-        inbounds=True,
+    def store_pair(value: ir.Value, end: ir.Value) -> None:
+        pair = builder.gep(digit_pairs, [ZERO, builder.shl(value, ONE_I64)])
+        dest = builder.gep(end, [ir.Constant(i64, -2)], inbounds=True)
+        # Unaligned 16-bit copy of both digits
+        digits = builder.load(builder.bitcast(pair, i16.as_pointer()), align=1)
+        builder.store(digits, builder.bitcast(dest, i16.as_pointer()), align=1)
+
+    # Negating INT64_MIN wraps to itself, which is right as an unsigned number
+    value = wri1ted.args[0]
+    negative = builder.icmp_signed("<", value, ir.Constant(i64, 0))
+    magnitude = builder.select(negative, builder.neg(value), value)
+
+    # Digit count from the bit length, corrected by one power of ten compare
+    bits = builder.sub(
+        ir.Constant(i64, 64),
+        builder.ctlz(builder.or_(magnitude, ONE_I64), ir.Constant(i1, 1)),
+    )
+    guess = builder.lshr(
+        builder.mul(bits, ir.Constant(i64, 1233)), ir.Constant(i64, 12)
     )
-    builder.call(printf_func, [fmt_ptr, wri1ted.args[0]])
+    power = builder.load(builder.gep(powers, [ZERO, guess], inbounds=True))
+    digit_count = builder.sub(
+        builder.add(guess, ONE_I64),
+        builder.zext(builder.icmp_unsigned("<", magnitude, power), i64),
+    )
+    length = builder.add(digit_count, builder.zext(negative, i64))
+
+    dest = builder.call(reserve_func, [ir.Constant(i64, DECIMAL_TEXT_SIZE)])
+    sign = builder.select(negative, ir.Constant(i8, ord("-")), ir.Constant(i8, 0))
+    # Overwritten by the first digit when the value isn't negative
+    builder.store(sign, dest)
+    end = builder.gep(dest, [length], inbounds=True)
+    builder.branch(pairs_loop)
+
+    builder.position_at_start(pairs_loop)
+    rest = builder.phi(i64, name="rest")
+    rest_end = builder.phi(i8ptr, name="end")
+    rest.add_incoming(magnitude, entry)
+    rest_end.add_incoming(end, entry)
+    builder.cbranch(
+        builder.icmp_unsigned(">=", rest, ir.Constant(i64, 100)), pairs_body, last
+    )
+
+    builder.position_at_start(pairs_body)
+    quotient = builder.udiv(rest, ir.Constant(i64, 100))
+    remainder = builder.sub(rest, builder.mul(quotient, ir.Constant(i64, 100)))
+    store_pair(remainder, rest_end)
+    rest.add_incoming(quotient, pairs_body)
+    rest_end.add_incoming(
+        builder.gep(rest_end, [ir.Constant(i64, -2)], inbounds=True), pairs_body
+    )
+    builder.branch(pairs_loop)
+
+    builder.position_at_start(last)
+    builder.cbranch(
+        builder.icmp_unsigned(">=", rest, ir.Constant(i64, 10)), last_pair, last_digit
+    )
+
+    builder.position_at_start(last_pair)
+    store_pair(rest, rest_end)
+    builder.branch(done)
+
+    builder.position_at_start(last_digit)
+    builder.store(
+        builder.add(builder.trunc(rest, i8), ir.Constant(i8, ord("0"))),
+        builder.gep(rest_end, [ir.Constant(i64, -1)], inbounds=True),
+    )
+    builder.branch(done)
+
+    builder.position_at_start(done)
+    advance_output(builder, length)
     builder.ret_void()
     return wri1ted
 
 
 def add_wr1teb_function(module: ir.Module) -> ir.Function:
-    printf_func = get_printf_function(module)
-    fmt_str = module.get_global(".fmt.s")
+    output_bytes_func = module.get_global(FUNC_PREFIX + "out.bytes")
     true_str = create_global_string(module, "true", name=".true")
     false_str = create_global_string(module, "false", name=".false")
 
@@ -125,47 +465,48 @@ def add_wr1teb_function(module: ir.Module) -> ir.Function:
         ir.FunctionType(get_llvm_type(VoidType), [get_llvm_type(BooleanType)]),
         name=FUNC_PREFIX + "wr1teb",
     )
+    wri1teb.attributes.add("alwaysinline")
     block = wri1teb.append_basic_block(name="entry")
     builder = ir.IRBuilder(block)
 
-    fmt_ptr = builder.gep(
-        fmt_str,
-        [ZERO, ZERO],
-        inbounds=True,
-    )
     bool_val = wri1teb.args[0]
     true_ptr = builder.gep(true_str, [ZERO, ZERO], inbounds=True)
     false_ptr = builder.gep(false_str, [ZERO, ZERO], inbounds=True)
-    printf_str = builder.select(bool_val, true_ptr, false_ptr)
-    builder.call(printf_func, [fmt_ptr, printf_str])
+    builder.call(
+        output_bytes_func,
+        [
+            builder.select(bool_val, true_ptr, false_ptr),
+            builder.select(
+                bool_val, ir.Constant(i64, len("true")), ir.Constant(i64, len("false"))
+            ),
+        ],
+    )
     builder.ret_void()
     return wri1teb
 
 
 def add_wr1tec_function(module: ir.Module) -> ir.Function:
-    printf_func = get_printf_function(module)
-    fmt_str = create_global_string(module, "%c", name=".fmt.c")
+    reserve_func = module.get_global(FUNC_PREFIX + "out.reserve")
 
     wri1tec = ir.Function(
         module,
         ir.FunctionType(get_llvm_type(VoidType), [get_llvm_type(CharType)]),
         name=FUNC_PREFIX + "wr1tec",
     )
+    wri1tec.attributes.add("alwaysinline")
     block = wri1tec.append_basic_block(name="entry")
     builder = ir.IRBuilder(block)
 
-    fmt_ptr = builder.gep(
-        fmt_str,
-        [ZERO, ZERO],
-        inbounds=True,
-    )
-    builder.call(printf_func, [fmt_ptr, wri1tec.args[0]])
+    one = ir.Constant(i64, 1)
+    builder.store(wri1tec.args[0], builder.call(reserve_func, [one]))
+    advance_output(builder, one)
     builder.ret_void()
     return wri1tec
 
 
 def add_wr1tea_function(module: ir.Module) -> ir.Function:
-    printf_func = get_printf_function(module)
+    snprintf_func = get_snprintf_function(module)
+    reserve_func = module.get_global(FUNC_PREFIX + "out.reserve")
     fmt_str = create_global_string(module, "%p", name=".fmt.p")
 
     wri1tea = ir.Function(
@@ -173,105 +514,876 @@ def add_wr1tea_function(module: ir.Module) -> ir.Function:
         ir.FunctionType(get_llvm_type(VoidType), [VOID_PTR]),
         name=FUNC_PREFIX + "wr1tea",
     )
+    wri1tea.attributes.add("alwaysinline")
     block = wri1tea.append_basic_block(name="entry")
     builder = ir.IRBuilder(block)
 
-    print(fmt_str)
-
+    text_size = ir.Constant(i64, POINTER_TEXT_SIZE)
+    dest = builder.call(reserve_func, [text_size])
     fmt_ptr = builder.gep(
         fmt_str,
         [ZERO, ZERO],
         inbounds=True,
     )
-
-    print(fmt_ptr)
-    builder.call(printf_func, [fmt_ptr, wri1tea.args[0]])
+    count = builder.call(snprintf_func, [dest, text_size, fmt_ptr, wri1tea.args[0]])
+    advance_output(builder, builder.sext(count, i64))
     builder.ret_void()
-    functions_with_void_ptrs[wri1tea.name] = [0]
     return wri1tea
 
 
+def add_input_buffer(module: ir.Module) -> None:
+    """One reader for the whole process, refilled with large read(2) calls"""
+    buffer_type = ir.ArrayType(i8, STDIN_BUFFER_SIZE)
+    buffer = ir.GlobalVariable(module, buffer_type, name=FUNC_PREFIX + "in.buf")
+    buffer.linkage = "internal"
+    buffer.initializer = ir.Constant(buffer_type, None)  # type: ignore
+    for name in ("in.pos", "in.end"):
+        index = ir.GlobalVariable(module, i64, name=FUNC_PREFIX + name)
+        index.linkage = "internal"
+        index.initializer = ir.Constant(i64, 0)  # type: ignore
+
+
+def get_input_buffer(
+    module: ir.Module,
+) -> tuple[ir.GlobalVariable, ir.GlobalVariable, ir.GlobalVariable]:
+    return (
+        module.get_global(FUNC_PREFIX + "in.buf"),
+        module.get_global(FUNC_PREFIX + "in.pos"),
+        module.get_global(FUNC_PREFIX + "in.end"),
+    )
+
+
+def add_input_fill_function(module: ir.Module) -> ir.Function:
+    """Refills the input buffer, returns false at end of input or on errors"""
+    read_func = get_read_function(module)
+    buffer, pos, end = get_input_buffer(module)
+
+    fill = ir.Function(
+        module,
+        ir.FunctionType(get_llvm_type(BooleanType), []),
+        name=FUNC_PREFIX + "in.fill",
+    )
+    fill.attributes.add("noinline")
+    block = fill.append_basic_block(name="entry")
+    builder = ir.IRBuilder(block)
+
+    count = builder.call(
+        read_func,
+        [
+            ir.Constant(i32, STDIN_FD),
+            builder.gep(buffer, [ZERO, ZERO], inbounds=True),
+            ir.Constant(i64, STDIN_BUFFER_SIZE),
+        ],
+    )
+    filled = builder.icmp_signed(">", count, ir.Constant(i64, 0))
+    builder.store(ir.Constant(i64, 0), pos)
+    builder.store(builder.select(filled, count, ir.Constant(i64, 0)), end)
+    builder.ret(filled)
+    return fill
+
+
+def add_input_peek_function(module: ir.Module) -> ir.Function:
+    """Returns the next input byte without consuming it, or -1 at end of input"""
+    fill_func = module.get_global(FUNC_PREFIX + "in.fill")
+    buffer, pos, end = get_input_buffer(module)
+
+    peek = ir.Function(
+        module,
+        ir.FunctionType(i32, []),
+        name=FUNC_PREFIX + "in.peek",
+    )
+    peek.attributes.add("alwaysinline")
+    entry = peek.append_basic_block(name="entry")
+    empty = peek.append_basic_block(name="empty")
+    load = peek.append_basic_block(name="load")
+    eof = peek.append_basic_block(name="eof")
+    builder = ir.IRBuilder(entry)
+
+    branch = builder.cbranch(
+        builder.icmp_unsigned("<", builder.load(pos), builder.load(end)), load, empty
+    )
+    branch.set_weights([STDIN_BUFFER_SIZE, 1])
+
+    builder.position_at_start(empty)
+    builder.cbranch(builder.call(fill_func, []), load, eof)
+
+    builder.position_at_start(load)
+    char = builder.load(
+        builder.gep(buffer, [ZERO, builder.load(pos)], inbounds=True)
+    )
+    builder.ret(builder.zext(char, i32))
+
+    builder.position_at_start(eof)
+    builder.ret(ir.Constant(i32, -1))
+    return peek
+
+
+def consume_input(builder: ir.IRBuilder) -> None:
+    _, pos, _ = get_input_buffer(builder.module)
+    builder.store(builder.add(builder.load(pos), ONE_I64), pos)
+
+
 def add_getd_function(module: ir.Module) -> ir.Function:
-    fgets_func = get_fgets_function(module)
-    atol_func = get_atol_function(module)
-    fdopen_func = get_fdopen(module)
-    mode_str = create_global_string(module, "r", ".mode.r")
+    """
+    Reads the next whitespace separated decimal from stdin, 0 at end of
+    input. Characters after its digits up to the next whitespace are skipped,
+    like atol ignores them.
+    """
+    flush_func = module.get_global(FUNC_PREFIX + "flush")
+    peek_func = module.get_global(FUNC_PREFIX + "in.peek")
 
     getd = ir.Function(
         module,
         ir.FunctionType(get_llvm_type(DecimalType), []),
         name=FUNC_PREFIX + "getd",
     )
-    block = getd.append_basic_block(name="entry")
-    builder = ir.IRBuilder(block)
+    entry = getd.append_basic_block(name="entry")
+    skip = getd.append_basic_block(name="skip")
+    skip_check = getd.append_basic_block(name="skip.check")
+    skip_next = getd.append_basic_block(name="skip.next")
+    sign = getd.append_basic_block(name="sign")
+    sign_next = getd.append_basic_block(name="sign.next")
+    digits = getd.append_basic_block(name="digits")
+    digit = getd.append_basic_block(name="digit")
+    rest = getd.append_basic_block(name="rest")
+    rest_next = getd.append_basic_block(name="rest.next")
+    done = getd.append_basic_block(name="done")
+    eof = getd.append_basic_block(name="eof")
+    builder = ir.IRBuilder(entry)
 
-    mode_ptr = builder.gep(mode_str, [ZERO, ZERO], inbounds=True)
-    stdin_FILEptr = builder.call(fdopen_func, [ZERO, mode_ptr])
+    def is_space(char: ir.Value) -> ir.Value:
+        # Space, or \t \n \v \f \r which are contiguous
+        return builder.or_(
+            builder.icmp_unsigned("==", char, ir.Constant(i32, ord(" "))),
+            builder.icmp_unsigned(
+                "<", builder.sub(char, ir.Constant(i32, ord("\t"))), ir.Constant(i32, 5)
+            ),
+        )
 
-    buf = builder.alloca(ir.ArrayType(i8, GETD_BUFFER_SIZE), name="getdbuf")
-    buf_ptr = builder.gep(buf, [ZERO, ZERO], inbounds=True)
+    # Show pending output, like a prompt, before blocking on input
+    builder.call(flush_func, [])
+    builder.branch(skip)
 
-    result = builder.call(
-        fgets_func, [buf_ptr, ir.Constant(i32, GETD_BUFFER_SIZE), stdin_FILEptr]
+    builder.position_at_start(skip)
+    char = builder.call(peek_func, [])
+    builder.cbranch(
+        builder.icmp_signed("<", char, ir.Constant(i32, 0)), eof, skip_check
     )
+    builder.position_at_start(skip_check)
+    builder.cbranch(is_space(char), skip_next, sign)
+    builder.position_at_start(skip_next)
+    consume_input(builder)
+    builder.branch(skip)
 
-    cond = builder.icmp_unsigned("!=", result, ir.Constant(i8ptr, None))
-    builder.ret(
-        builder.select(
-            cond,
-            builder.call(atol_func, [buf_ptr]),
-            ir.Constant(get_llvm_type(DecimalType), 0),
-        )
+    builder.position_at_start(sign)
+    negative = builder.icmp_unsigned("==", char, ir.Constant(i32, ord("-")))
+    signed = builder.or_(
+        negative, builder.icmp_unsigned("==", char, ir.Constant(i32, ord("+")))
+    )
+    builder.cbranch(signed, sign_next, digits)
+    builder.position_at_start(sign_next)
+    consume_input(builder)
+    builder.branch(digits)
+
+    # Accumulates with wrapping arithmetic, so INT64_MIN reads back exactly
+    builder.position_at_start(digits)
+    value = builder.phi(i64, name="value")
+    value.add_incoming(ir.Constant(i64, 0), sign)
+    value.add_incoming(ir.Constant(i64, 0), sign_next)
+    digit_value = builder.sub(builder.call(peek_func, []), ir.Constant(i32, ord("0")))
+    builder.cbranch(
+        builder.icmp_unsigned("<", digit_value, ir.Constant(i32, 10)), digit, rest
+    )
+    builder.position_at_start(digit)
+    consume_input(builder)
+    value.add_incoming(
+        builder.add(
+            builder.mul(value, ir.Constant(i64, 10)), builder.zext(digit_value, i64)
+        ),
+        digit,
     )
+    builder.branch(digits)
+
+    builder.position_at_start(rest)
+    char = builder.call(peek_func, [])
+    at_end = builder.or_(
+        builder.icmp_signed("<", char, ir.Constant(i32, 0)), is_space(char)
+    )
+    builder.cbranch(at_end, done, rest_next)
+    builder.position_at_start(rest_next)
+    consume_input(builder)
+    builder.branch(rest)
+
+    builder.position_at_start(done)
+    builder.ret(builder.select(negative, builder.neg(value), value))
+
+    builder.position_at_start(eof)
+    builder.ret(ir.Constant(get_llvm_type(DecimalType), 0))
     return getd
 
 
-def add_srazd_function(module: ir.Module) -> ir.Function:
-    srand_func = get_srand_function(module)
+def splitmix64(seed: int) -> tuple[int, int]:
+    """Python twin of the seeding in add_srazd_function, returns (seed, value)"""
+    seed = (seed + SPLITMIX_INCREMENT) % 2**64
+    z = seed
+    z = ((z ^ (z >> 30)) * SPLITMIX_MULTIPLIERS[0]) % 2**64
+    z = ((z ^ (z >> 27)) * SPLITMIX_MULTIPLIERS[1]) % 2**64
+    return seed, z ^ (z >> 31)
 
+
+def add_rng_state(module: ir.Module) -> None:
+    """
+    xoshiro256** state. Starts out seeded with 0, so the runtime also works
+    without wrap_main_function seeding it
+    """
+    seed, words = 0, []
+    for _ in range(RNG_STATE_WORDS):
+        seed, word = splitmix64(seed)
+        words.append(ir.Constant(i64, word))
+    state_type = ir.ArrayType(i64, RNG_STATE_WORDS)
+    state = ir.GlobalVariable(module, state_type, name=FUNC_PREFIX + "rng.state")
+    state.linkage = "internal"
+    state.initializer = ir.Constant(state_type, words)  # type: ignore
+
+
+def load_rng_state(builder: ir.IRBuilder) -> list[ir.Value]:
+    state = builder.module.get_global(FUNC_PREFIX + "rng.state")
+    return [
+        builder.load(builder.gep(state, [ZERO, ir.Constant(i32, i)], inbounds=True))
+        for i in range(RNG_STATE_WORDS)
+    ]
+
+
+def store_rng_state(builder: ir.IRBuilder, words: list[ir.Value]) -> None:
+    state = builder.module.get_global(FUNC_PREFIX + "rng.state")
+    for i, word in enumerate(words):
+        builder.store(
+            word, builder.gep(state, [ZERO, ir.Constant(i32, i)], inbounds=True)
+        )
+
+
+def rng_step(
+    builder: ir.IRBuilder, words: list[ir.Value]
+) -> tuple[ir.Value, list[ir.Value]]:
+    """One xoshiro256** step, returns the 64-bit output and the next state"""
+
+    # Matched to a rotate instruction by LLVM
+    def rotl(value: ir.Value, bits: int) -> ir.Value:
+        return builder.or_(
+            builder.shl(value, ir.Constant(i64, bits)),
+            builder.lshr(value, ir.Constant(i64, 64 - bits)),
+        )
+
+    s0, s1, s2, s3 = words
+    result = builder.mul(
+        rotl(builder.mul(s1, ir.Constant(i64, 5)), 7), ir.Constant(i64, 9)
+    )
+    t = builder.shl(s1, ir.Constant(i64, 17))
+    s2 = builder.xor(s2, s0)
+    s3 = builder.xor(s3, s1)
+    s1 = builder.xor(s1, s2)
+    s0 = builder.xor(s0, s3)
+    s2 = builder.xor(s2, t)
+    s3 = rotl(s3, 45)
+    return result, [s0, s1, s2, s3]
+
+
+def rng_decimal(builder: ir.IRBuilder, value: ir.Value) -> ir.Value:
+    # razdd returns non-negative decimals, keep the high 63 bits
+    return builder.lshr(value, ONE_I64)
+
+
+def add_srazd_function(module: ir.Module) -> ir.Function:
+    """Expands the full 64-bit seed into the generator state with splitmix64"""
     srazd = ir.Function(
         module,
         ir.FunctionType(get_llvm_type(VoidType), [get_llvm_type(DecimalType)]),
         name=FUNC_PREFIX + "srazd",
     )
+    srazd.attributes.add("alwaysinline")
     block = srazd.append_basic_block(name="entry")
     builder = ir.IRBuilder(block)
-    builder.call(srand_func, [builder.trunc(srazd.args[0], i32)])
+
+    seed = srazd.args[0]
+    words = []
+    for _ in range(RNG_STATE_WORDS):
+        seed = builder.add(seed, ir.Constant(i64, SPLITMIX_INCREMENT))
+        z = seed
+        for shift, multiplier in zip((30, 27), SPLITMIX_MULTIPLIERS):
+            z = builder.xor(z, builder.lshr(z, ir.Constant(i64, shift)))
+            z = builder.mul(z, ir.Constant(i64, multiplier))
+        words.append(builder.xor(z, builder.lshr(z, ir.Constant(i64, 31))))
+    store_rng_state(builder, words)
     builder.ret_void()
     return srazd
 
 
 def add_razdd_function(module: ir.Module) -> ir.Function:
-    rand_func = get_rand_function(module)
-
     razdd = ir.Function(
         module,
         ir.FunctionType(get_llvm_type(DecimalType), []),
         name=FUNC_PREFIX + "razdd",
     )
+    razdd.attributes.add("alwaysinline")
     block = razdd.append_basic_block(name="entry")
     builder = ir.IRBuilder(block)
 
-    rand_block_size = ir.Constant(i32, 0x7FFF)
-    rand_blocks = [
-        builder.zext(builder.and_(builder.call(rand_func, []), rand_block_size), i64)
-        for _ in range(5)
-    ]
+    result, words = rng_step(builder, load_rng_state(builder))
+    store_rng_state(builder, words)
+    builder.ret(rng_decimal(builder, result))
+    return razdd
+
+
+def add_f111razd_function(module: ir.Module) -> ir.Function:
+    """
+    Fills count decimals at a dect# with razdd values. The state stays in
+    registers for the whole loop, the stores can't be assumed not to alias it
+    """
+    f111razd = ir.Function(
+        module,
+        ir.FunctionType(
+            get_llvm_type(VoidType),
+            [
+                get_llvm_type(PointerOf(0, 0, DecimalType(0, 0))),
+                get_llvm_type(DecimalType),
+            ],
+        ),
+        name=FUNC_PREFIX + "f111razd",
+    )
+    entry = f111razd.append_basic_block(name="entry")
+    loop = f111razd.append_basic_block(name="loop")
+    body = f111razd.append_basic_block(name="body")
+    done = f111razd.append_basic_block(name="done")
+    builder = ir.IRBuilder(entry)
+    dest, count = f111razd.args
+
+    initial = load_rng_state(builder)
+    builder.branch(loop)
 
+    builder.position_at_start(loop)
+    index = builder.phi(i64, name="index")
+    words = [builder.phi(i64, name=f"s{i}") for i in range(RNG_STATE_WORDS)]
+    index.add_incoming(ir.Constant(i64, 0), entry)
+    for word, value in zip(words, initial):
+        word.add_incoming(value, entry)
+    builder.cbranch(builder.icmp_signed("<", index, count), body, done)
+
+    builder.position_at_start(body)
+    result, next_words = rng_step(builder, list(words))
+    builder.store(
+        rng_decimal(builder, result), builder.gep(dest, [index], inbounds=True)
+    )
+    index.add_incoming(builder.add(index, ONE_I64), body)
+    for word, value in zip(words, next_words):
+        word.add_incoming(value, body)
+    builder.branch(loop)
+
+    builder.position_at_start(done)
+    store_rng_state(builder, list(words))
+    builder.ret_void()
+    return f111razd
+
+
+def add_zsec_function(module: ir.Module) -> ir.Function:
+    """Nanoseconds of the monotonic clock, for timing code"""
+    clock_gettime_func = get_clock_gettime_function(module)
+
+    zsec = ir.Function(
+        module,
+        ir.FunctionType(get_llvm_type(DecimalType), []),
+        name=FUNC_PREFIX + "zsec",
+    )
+    block = zsec.append_basic_block(name="entry")
+    builder = ir.IRBuilder(block)
+
+    timespec = builder.alloca(ir.LiteralStructType([i64, i64]), name="timespec")
+    builder.call(clock_gettime_func, [ir.Constant(i32, CLOCK_MONOTONIC), timespec])
+    seconds = builder.load(builder.gep(timespec, [ZERO, ZERO], inbounds=True))
+    nanoseconds = builder.load(
+        builder.gep(timespec, [ZERO, ir.Constant(i32, 1)], inbounds=True)
+    )
     builder.ret(
-        builder.or_(
-            builder.shl(rand_blocks[0], ir.Constant(i64, 48)),
-            builder.or_(
-                builder.shl(rand_blocks[1], ir.Constant(i64, 35)),
-                builder.or_(
-                    builder.shl(rand_blocks[2], ir.Constant(i64, 22)),
-                    builder.or_(
-                        builder.shl(rand_blocks[3], ir.Constant(i64, 9)),
-                        builder.lshr(rand_blocks[4], ir.Constant(i64, 4)),
-                    ),
-                ),
-            ),
+        builder.add(builder.mul(seconds, ir.Constant(i64, 10**9)), nanoseconds)
+    )
+    return zsec
+
+
+def add_rdtsc_function(module: ir.Module) -> ir.Function:
+    """CPU cycle counter, rdtsc on x86 and the closest counter elsewhere"""
+    try:
+        counter_func = module.get_global("llvm.readcyclecounter")
+    except KeyError:
+        counter_func = ir.Function(
+            module, ir.FunctionType(i64, []), name="llvm.readcyclecounter"
         )
+
+    rdtsc = ir.Function(
+        module,
+        ir.FunctionType(get_llvm_type(DecimalType), []),
+        name=FUNC_PREFIX + "rdtsc",
     )
+    rdtsc.attributes.add("alwaysinline")
+    block = rdtsc.append_basic_block(name="entry")
+    builder = ir.IRBuilder(block)
+    builder.ret(builder.call(counter_func, []))
+    return rdtsc
 
-    return razdd
+
+def add_barr1er_function(module: ir.Module) -> ir.Function:
+    """
+    Returns its argument through an empty asm statement that LLVM has to
+    assume reads and changes it and memory, like Rust's black_box. Keeps
+    benchmarked code from being computed at compile time or deleted.
+    """
+    barr1er = ir.Function(
+        module,
+        ir.FunctionType(get_llvm_type(DecimalType), [get_llvm_type(DecimalType)]),
+        name=FUNC_PREFIX + "barr1er",
+    )
+    barr1er.attributes.add("alwaysinline")
+    block = barr1er.append_basic_block(name="entry")
+    builder = ir.IRBuilder(block)
+    value = builder.asm(
+        ir.FunctionType(i64, [i64]),
+        "",
+        "=r,0,~{memory}",
+        [barr1er.args[0]],
+        True,
+    )
+    builder.ret(value)
+    return barr1er
+
+
+def add_file_open_function(module: ir.Module) -> ir.Function:
+    """
+    Opens a file for reading (mode 0), writing (1, truncates) or appending
+    (2), returns its file descriptor or -1
+    """
+    open_func = get_open_function(module)
+
+    f_open = ir.Function(
+        module,
+        ir.FunctionType(
+            get_llvm_type(DecimalType),
+            [
+                get_llvm_type(PointerOf(0, 0, CharType(0, 0))),
+                get_llvm_type(DecimalType),
+            ],
+        ),
+        name=FUNC_PREFIX + "f@qez",
+    )
+    block = f_open.append_basic_block(name="entry")
+    builder = ir.IRBuilder(block)
+    path, mode = f_open.args
+
+    flags = ir.Constant(i32, OPEN_FLAGS[0])
+    for file_mode, mode_flags in enumerate(OPEN_FLAGS[1:], start=1):
+        flags = builder.select(
+            builder.icmp_signed("==", mode, ir.Constant(i64, file_mode)),
+            ir.Constant(i32, mode_flags),
+            flags,
+        )
+    fd = builder.call(open_func, [path, flags, ir.Constant(i32, NEW_FILE_PERMISSIONS)])
+    builder.ret(builder.sext(fd, i64))
+    return f_open
+
+
+def build_transfer_loop(
+    builder: ir.IRBuilder,
+    transfer_func: ir.Function,
+    fd: ir.Value,
+    data: ir.Value,
+    count: ir.Value,
+    transferred: ir.Value = ir.Constant(i64, 0),
+) -> None:
+    """
+    Calls read or write until count bytes are transferred, the file ends or
+    an error happens, starting after the transferred bytes already in data.
+    Ends the function returning the bytes transferred, or -1 if an error came
+    first.
+    """
+    func = builder.function
+    entry = builder.block
+    loop = func.append_basic_block(name="loop")
+    body = func.append_basic_block(name="body")
+    moved = func.append_basic_block(name="moved")
+    stopped = func.append_basic_block(name="stopped")
+    done = func.append_basic_block(name="done")
+    builder.branch(loop)
+
+    builder.position_at_start(loop)
+    total = builder.phi(i64, name="total")
+    total.add_incoming(transferred, entry)
+    builder.cbranch(builder.icmp_signed("<", total, count), body, done)
+
+    builder.position_at_start(body)
+    result = builder.call(
+        transfer_func,
+        [
+            builder.trunc(fd, i32),
+            builder.gep(data, [total], inbounds=True),
+            builder.sub(count, total),
+        ],
+    )
+    builder.cbranch(
+        builder.icmp_signed(">", result, ir.Constant(i64, 0)), moved, stopped
+    )
+
+    builder.position_at_start(moved)
+    total.add_incoming(builder.add(total, result), moved)
+    builder.branch(loop)
+
+    # 0 is the end of the file, report an error only when nothing was moved
+    builder.position_at_start(stopped)
+    failed = builder.and_(
+        builder.icmp_signed("<", result, ir.Constant(i64, 0)),
+        builder.icmp_signed("==", total, ir.Constant(i64, 0)),
+    )
+    builder.ret(builder.select(failed, ir.Constant(i64, -1), total))
+
+    builder.position_at_start(done)
+    builder.ret(total)
+
+
+def add_file_read_function(module: ir.Module) -> ir.Function:
+    """Reads up to count bytes into a car#, returns how many, 0 at end of file"""
+    read_func = get_read_function(module)
+    memcpy_func = module.declare_intrinsic("llvm.memcpy", [i8ptr, i8ptr, i64])
+    buffer, pos, end = get_input_buffer(module)
+
+    f_read = ir.Function(
+        module,
+        ir.FunctionType(
+            get_llvm_type(DecimalType),
+            [
+                get_llvm_type(DecimalType),
+                get_llvm_type(PointerOf(0, 0, CharType(0, 0))),
+                get_llvm_type(DecimalType),
+            ],
+        ),
+        name=FUNC_PREFIX + "fread",
+    )
+    entry = f_read.append_basic_block(name="entry")
+    buffered = f_read.append_basic_block(name="buffered")
+    start = f_read.append_basic_block(name="start")
+    builder = ir.IRBuilder(entry)
+
+    # Bytes getd already read from stdin come first, or they would be skipped
+    fd, data, count = f_read.args
+    builder.cbranch(
+        builder.icmp_signed("==", fd, ir.Constant(i64, STDIN_FD)), buffered, start
+    )
+
+    builder.position_at_start(buffered)
+    position = builder.load(pos)
+    available = builder.sub(builder.load(end), position)
+    taken = builder.select(
+        builder.icmp_signed("<", available, count), available, count, name="taken"
+    )
+    taken = builder.select(
+        builder.icmp_signed("<", taken, ir.Constant(i64, 0)),
+        ir.Constant(i64, 0),
+        taken,
+    )
+    source = builder.gep(buffer, [ZERO, position], inbounds=True)
+    builder.call(memcpy_func, [data, source, taken, ir.Constant(i1, 0)])
+    builder.store(builder.add(position, taken), pos)
+    builder.branch(start)
+
+    builder.position_at_start(start)
+    copied = builder.phi(i64, name="copied")
+    copied.add_incoming(ir.Constant(i64, 0), entry)
+    copied.add_incoming(taken, buffered)
+    build_transfer_loop(builder, read_func, fd, data, count, copied)
+    return f_read
+
+
+def add_file_write_function(module: ir.Module) -> ir.Function:
+    """Writes count bytes of a car#, returns how many were written"""
+    write_func = get_write_function(module)
+    flush_func = module.get_global(FUNC_PREFIX + "flush")
+
+    f_write = ir.Function(
+        module,
+        ir.FunctionType(
+            get_llvm_type(DecimalType),
+            [
+                get_llvm_type(DecimalType),
+                get_llvm_type(PointerOf(0, 0, CharType(0, 0))),
+                get_llvm_type(DecimalType),
+            ],
+        ),
+        name=FUNC_PREFIX + "fwr1te",
+    )
+    block = f_write.append_basic_block(name="entry")
+    builder = ir.IRBuilder(block)
+
+    # Keeps the order of output written to stdout both ways
+    fd = f_write.args[0]
+    with builder.if_then(
+        builder.icmp_signed("==", fd, ir.Constant(i64, STDOUT_FD)), likely=False
+    ):
+        builder.call(flush_func, [])
+    build_transfer_loop(builder, write_func, *f_write.args)
+    return f_write
+
+
+def add_file_close_function(module: ir.Module) -> ir.Function:
+    close_func = get_close_function(module)
+
+    f_close = ir.Function(
+        module,
+        ir.FunctionType(get_llvm_type(DecimalType), [get_llvm_type(DecimalType)]),
+        name=FUNC_PREFIX + "fc1@se",
+    )
+    block = f_close.append_basic_block(name="entry")
+    builder = ir.IRBuilder(block)
+    result = builder.call(close_func, [builder.trunc(f_close.args[0], i32)])
+    builder.ret(builder.sext(result, i64))
+    return f_close
+
+
+def add_file_size_function(module: ir.Module) -> ir.Function:
+    """Size of an open file in bytes, keeps the file position"""
+    lseek_func = get_lseek_function(module)
+
+    f_size = ir.Function(
+        module,
+        ir.FunctionType(get_llvm_type(DecimalType), [get_llvm_type(DecimalType)]),
+        name=FUNC_PREFIX + "fs1ze",
+    )
+    block = f_size.append_basic_block(name="entry")
+    builder = ir.IRBuilder(block)
+
+    fd = builder.trunc(f_size.args[0], i32)
+    position = builder.call(
+        lseek_func, [fd, ir.Constant(i64, 0), ir.Constant(i32, SEEK_CUR)]
+    )
+    size = builder.call(
+        lseek_func, [fd, ir.Constant(i64, 0), ir.Constant(i32, SEEK_END)]
+    )
+    builder.call(lseek_func, [fd, position, ir.Constant(i32, SEEK_SET)])
+    builder.ret(size)
+    return f_size
+
+
+def add_file_view_function(module: ir.Module) -> ir.Function:
+    """
+    Maps a whole open file read-only into memory, returns null for empty
+    files and on errors. The mapping lasts until the program exits.
+    """
+    mmap_func = get_mmap_function(module)
+    madvise_func = get_madvise_function(module)
+    size_func = module.get_global(FUNC_PREFIX + "fs1ze")
+
+    f_view = ir.Function(
+        module,
+        ir.FunctionType(
+            get_llvm_type(PointerOf(0, 0, CharType(0, 0))),
+            [get_llvm_type(DecimalType)],
+        ),
+        name=FUNC_PREFIX + "fv1ew",
+    )
+    entry = f_view.append_basic_block(name="entry")
+    do_map = f_view.append_basic_block(name="map")
+    mapped = f_view.append_basic_block(name="mapped")
+    failed = f_view.append_basic_block(name="failed")
+    builder = ir.IRBuilder(entry)
+
+    fd = f_view.args[0]
+    size = builder.call(size_func, [fd])
+    builder.cbranch(
+        builder.icmp_signed(">", size, ir.Constant(i64, 0)), do_map, failed
+    )
+
+    builder.position_at_start(do_map)
+    region = builder.call(
+        mmap_func,
+        [
+            ir.Constant(VOID_PTR, None),
+            size,
+            ir.Constant(i32, PROT_READ),
+            ir.Constant(i32, MAP_PRIVATE),
+            builder.trunc(fd, i32),
+            ir.Constant(i64, 0),
+        ],
+    )
+    map_failed = builder.inttoptr(ir.Constant(i64, -1), VOID_PTR)
+    builder.cbranch(builder.icmp_unsigned("==", region, map_failed), failed, mapped)
+
+    # Files are mostly scanned front to back, read ahead aggressively
+    builder.position_at_start(mapped)
+    builder.call(madvise_func, [region, size, ir.Constant(i32, MADV_SEQUENTIAL)])
+    builder.ret(region)
+
+    builder.position_at_start(failed)
+    builder.ret(ir.Constant(VOID_PTR, None))
+    return f_view
+
+
+def add_overflow_function(module: ir.Module) -> ir.Function:
+    """Reports an integer overflow at a 1eft source position and aborts"""
+    dprintf_func = get_dprintf_function(module)
+    flush_func = module.get_global(FUNC_PREFIX + "flush")
+    abort_func = get_abort_function(module)
+    fmt_str = create_global_string(
+        module, "Error: integer overflow at %ld:%ld\n", name=".fmt.overflow"
+    )
+
+    overflow = ir.Function(
+        module,
+        ir.FunctionType(
+            get_llvm_type(VoidType),
+            [get_llvm_type(DecimalType), get_llvm_type(DecimalType)],
+        ),
+        name=FUNC_PREFIX + "overflow",
+    )
+    overflow.attributes.add("noreturn")
+    overflow.attributes.add("cold")
+    overflow.attributes.add("noinline")
+    block = overflow.append_basic_block(name="entry")
+    builder = ir.IRBuilder(block)
+
+    # Flush what the program printed so far, abort skips the exit handlers
+    builder.call(flush_func, [])
+    fmt_ptr = builder.gep(fmt_str, [ZERO, ZERO], inbounds=True)
+    builder.call(
+        dprintf_func,
+        [ir.Constant(i32, STDERR_FD), fmt_ptr, overflow.args[0], overflow.args[1]],
+    )
+    builder.call(abort_func, [])
+    builder.unreachable()
+    return overflow
+
+
+# CPUID bits required by the x86-64-v3 microarchitecture level
+CPUID_1_ECX_V3 = sum(1 << bit for bit in (0, 9, 12, 13, 19, 20, 22, 23, 27, 28, 29))
+CPUID_7_EBX_V3 = sum(1 << bit for bit in (3, 5, 8))
+CPUID_EXT_ECX_V3 = sum(1 << bit for bit in (0, 5))
+XCR0_AVX_STATE = 0x6
+
+
+def get_cpu_level_global(module: ir.Module) -> ir.GlobalVariable:
+    try:
+        return module.get_global(FUNC_PREFIX + "cpu.level")
+    except KeyError:
+        level = ir.GlobalVariable(module, i1, name=FUNC_PREFIX + "cpu.level")
+        level.linkage = "internal"
+        level.initializer = ir.Constant(i1, 0)  # type: ignore
+        return level
+
+
+def add_cpu_detect_function(module: ir.Module) -> ir.Function:
+    """Returns true when the running CPU supports MULTIVERSION_CPU"""
+    detect = ir.Function(
+        module,
+        ir.FunctionType(get_llvm_type(BooleanType), []),
+        name=FUNC_PREFIX + "cpu.detect",
+    )
+    entry = detect.append_basic_block(name="entry")
+    xsave = detect.append_basic_block(name="xsave")
+    done = detect.append_basic_block(name="done")
+    builder = ir.IRBuilder(entry)
+
+    cpuid_type = ir.FunctionType(ir.LiteralStructType([i32] * 4), [i32, i32])
+
+    def cpuid(leaf: int, reg: int) -> ir.Value:
+        regs = builder.asm(
+            cpuid_type,
+            "cpuid",
+            "={ax},={bx},={cx},={dx},{ax},{cx}",
+            [ir.Constant(i32, leaf), ir.Constant(i32, 0)],
+            True,
+        )
+        return builder.extract_value(regs, reg)
+
+    def has_bits(value: ir.Value, mask: int) -> ir.Value:
+        masked = builder.and_(value, ir.Constant(i32, mask))
+        return builder.icmp_unsigned("==", masked, ir.Constant(i32, mask))
+
+    # cpuid never faults, out of range leaves are masked by the range checks
+    max_leaf = cpuid(0, 0)
+    max_ext_leaf = cpuid(0x80000000, 0)
+    supported = builder.and_(
+        builder.icmp_unsigned(">=", max_leaf, ir.Constant(i32, 7)),
+        builder.icmp_unsigned(">=", max_ext_leaf, ir.Constant(i32, 0x80000001)),
+    )
+    supported = builder.and_(supported, has_bits(cpuid(1, 2), CPUID_1_ECX_V3))
+    supported = builder.and_(supported, has_bits(cpuid(7, 1), CPUID_7_EBX_V3))
+    supported = builder.and_(
+        supported, has_bits(cpuid(0x80000001, 2), CPUID_EXT_ECX_V3)
+    )
+    builder.cbranch(supported, xsave, done)
+
+    # xgetbv is only valid once OSXSAVE is known to be set
+    builder.position_at_start(xsave)
+    xcr0 = builder.extract_value(
+        builder.asm(
+            ir.FunctionType(ir.LiteralStructType([i32, i32]), [i32]),
+            "xgetbv",
+            "={ax},={dx},{cx}",
+            [ir.Constant(i32, 0)],
+            True,
+        ),
+        0,
+    )
+    os_support = has_bits(xcr0, XCR0_AVX_STATE)
+    builder.branch(done)
+
+    builder.position_at_start(done)
+    result = builder.phi(i1)
+    result.add_incoming(ir.Constant(i1, 0), entry)
+    result.add_incoming(os_support, xsave)
+    builder.ret(result)
+    return detect
+
+
+def add_cpu_dispatch_init(module: ir.Module) -> None:
+    detect = add_cpu_detect_function(module)
+    level = get_cpu_level_global(module)
+
+    main_func = module.get_global("main")
+    builder = ir.IRBuilder()
+    builder.position_at_start(main_func.entry_basic_block)
+    builder.store(builder.call(detect, [], name="call_cpu_detect"), level)
+
+
+def add_xadd_function(module: ir.Module) -> ir.Function:
+    """Atomically adds to a dect and returns the value it had before"""
+    xadd = ir.Function(
+        module,
+        ir.FunctionType(
+            get_llvm_type(DecimalType),
+            [get_llvm_type(DecimalType).as_pointer(), get_llvm_type(DecimalType)],
+        ),
+        name=FUNC_PREFIX + "xadd",
+    )
+    xadd.attributes.add("alwaysinline")
+    builder = ir.IRBuilder(xadd.append_basic_block(name="entry"))
+    builder.ret(builder.atomic_rmw("add", xadd.args[0], xadd.args[1], "seq_cst"))
+    return xadd
+
+
+def add_cas_function(module: ir.Module) -> ir.Function:
+    """
+    Atomically replaces a dect with a new value if it still holds the
+    expected one, returns whether it did
+    """
+    cas = ir.Function(
+        module,
+        ir.FunctionType(
+            get_llvm_type(BooleanType),
+            [
+                get_llvm_type(DecimalType).as_pointer(),
+                get_llvm_type(DecimalType),
+                get_llvm_type(DecimalType),
+            ],
+        ),
+        name=FUNC_PREFIX + "cas",
+    )
+    cas.attributes.add("alwaysinline")
+    builder = ir.IRBuilder(cas.append_basic_block(name="entry"))
+    target, expected, desired = cas.args
+    exchange = builder.cmpxchg(target, expected, desired, "seq_cst", "seq_cst")
+    builder.ret(builder.extract_value(exchange, 1))
+    return cas
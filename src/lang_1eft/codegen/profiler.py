@@ -0,0 +1,365 @@
+from pathlib import Path
+from typing import cast
+
+import llvmlite.ir as ir
+
+from lang_1eft.pipeline.ast_definitions import *
+from lang_1eft.codegen.codegen_util import *
+from lang_1eft.codegen.predef_functions import NEW_FILE_PERMISSIONS, OPEN_FLAGS
+
+# Calls nested deeper than this are counted but not timed
+PROFILER_MAX_DEPTH = 4096
+# Caller name of functions called from outside any profiled function
+PROFILER_ROOT = "<root>"
+
+# One shadow stack frame: function index, start cycle, cycles spent in callees
+FRAME_TYPE = ir.LiteralStructType([i64, i64, i64])
+
+
+def add_profiler_state(module: ir.Module, names: list[str]) -> None:
+    """
+    Per function counters, indexed by the position of the function in names,
+    and a shadow stack of the active calls for exclusive time and callers
+    """
+    count = len(names)
+    counters_type = ir.ArrayType(i64, count)
+    for name in ("calls", "inclusive", "exclusive", "active"):
+        counter = ir.GlobalVariable(
+            module, counters_type, name=f"{FUNC_PREFIX}prof.{name}"
+        )
+        counter.linkage = "internal"
+        counter.initializer = ir.Constant(counters_type, None)  # type: ignore
+
+    # The last caller column counts calls from PROFILER_ROOT
+    callers_type = ir.ArrayType(ir.ArrayType(i64, count + 1), count)
+    callers = ir.GlobalVariable(module, callers_type, name=FUNC_PREFIX + "prof.callers")
+    callers.linkage = "internal"
+    callers.initializer = ir.Constant(callers_type, None)  # type: ignore
+
+    stack_type = ir.ArrayType(FRAME_TYPE, PROFILER_MAX_DEPTH)
+    stack = ir.GlobalVariable(module, stack_type, name=FUNC_PREFIX + "prof.stack")
+    stack.linkage = "internal"
+    stack.initializer = ir.Constant(stack_type, None)  # type: ignore
+    depth = ir.GlobalVariable(module, i64, name=FUNC_PREFIX + "prof.depth")
+    depth.linkage = "internal"
+    depth.initializer = ir.Constant(i64, 0)  # type: ignore
+
+    strings = [
+        create_global_string(module, name, name=".prof.name")
+        for name in names + [PROFILER_ROOT]
+    ]
+    names_type = ir.ArrayType(i8ptr, len(strings))
+    names_table = ir.GlobalVariable(
+        module, names_type, name=FUNC_PREFIX + "prof.names"
+    )
+    names_table.linkage = "internal"
+    names_table.global_constant = True
+    names_table.initializer = ir.Constant(  # type: ignore
+        names_type, [s.gep([ZERO, ZERO]) for s in strings]
+    )
+
+
+def get_cycle_counter(module: ir.Module) -> ir.Function:
+    try:
+        return module.get_global("llvm.readcyclecounter")
+    except KeyError:
+        return ir.Function(
+            module, ir.FunctionType(i64, []), name="llvm.readcyclecounter"
+        )
+
+
+def counter_slot(builder: ir.IRBuilder, name: str, index: ir.Value) -> ir.Value:
+    counter = builder.module.get_global(f"{FUNC_PREFIX}prof.{name}")
+    return builder.gep(counter, [ZERO, index], inbounds=True)
+
+
+def frame_slot(builder: ir.IRBuilder, depth: ir.Value, field: int) -> ir.Value:
+    stack = builder.module.get_global(FUNC_PREFIX + "prof.stack")
+    return builder.gep(stack, [ZERO, depth, ir.Constant(i32, field)], inbounds=True)
+
+
+def increment(builder: ir.IRBuilder, ptr: ir.Value, amount: ir.Value) -> ir.Value:
+    value = builder.add(builder.load(ptr), amount)
+    builder.store(value, ptr)
+    return value
+
+
+def add_profiler_enter_function(module: ir.Module) -> ir.Function:
+    counter_func = get_cycle_counter(module)
+    depth_ptr = module.get_global(FUNC_PREFIX + "prof.depth")
+    callers = module.get_global(FUNC_PREFIX + "prof.callers")
+    root = ir.Constant(i64, cast(ir.ArrayType, callers.value_type).count)
+    max_depth = ir.Constant(i64, PROFILER_MAX_DEPTH)
+    one = ir.Constant(i64, 1)
+
+    enter = ir.Function(
+        module,
+        ir.FunctionType(get_llvm_type(VoidType), [i64]),
+        name=FUNC_PREFIX + "prof.enter",
+    )
+    enter.linkage = "internal"
+    entry = enter.append_basic_block(name="entry")
+    nested = enter.append_basic_block(name="nested")
+    counted = enter.append_basic_block(name="counted")
+    timed = enter.append_basic_block(name="timed")
+    done = enter.append_basic_block(name="done")
+    builder = ir.IRBuilder(entry)
+    index = enter.args[0]
+
+    increment(builder, counter_slot(builder, "calls", index), one)
+    increment(builder, counter_slot(builder, "active", index), one)
+    depth = builder.load(depth_ptr)
+    builder.store(builder.add(depth, one), depth_ptr)
+    # The caller is the frame below, when it was recorded
+    has_caller = builder.and_(
+        builder.icmp_unsigned(">", depth, ir.Constant(i64, 0)),
+        builder.icmp_unsigned("<=", depth, max_depth),
+    )
+    builder.cbranch(has_caller, nested, counted)
+
+    builder.position_at_start(nested)
+    caller = builder.load(frame_slot(builder, builder.sub(depth, one), 0))
+    builder.branch(counted)
+
+    builder.position_at_start(counted)
+    caller_index = builder.phi(i64, name="caller")
+    caller_index.add_incoming(root, entry)
+    caller_index.add_incoming(caller, nested)
+    increment(
+        builder, builder.gep(callers, [ZERO, index, caller_index], inbounds=True), one
+    )
+    builder.cbranch(builder.icmp_unsigned("<", depth, max_depth), timed, done)
+
+    # Read the clock last, so the hook itself isn't timed
+    builder.position_at_start(timed)
+    builder.store(index, frame_slot(builder, depth, 0))
+    builder.store(ir.Constant(i64, 0), frame_slot(builder, depth, 2))
+    builder.store(builder.call(counter_func, []), frame_slot(builder, depth, 1))
+    builder.branch(done)
+
+    builder.position_at_start(done)
+    builder.ret_void()
+    return enter
+
+
+def add_profiler_exit_function(module: ir.Module) -> ir.Function:
+    counter_func = get_cycle_counter(module)
+    depth_ptr = module.get_global(FUNC_PREFIX + "prof.depth")
+    one = ir.Constant(i64, 1)
+
+    exit_hook = ir.Function(
+        module,
+        ir.FunctionType(get_llvm_type(VoidType), [i64]),
+        name=FUNC_PREFIX + "prof.exit",
+    )
+    exit_hook.linkage = "internal"
+    entry = exit_hook.append_basic_block(name="entry")
+    timed = exit_hook.append_basic_block(name="timed")
+    outermost = exit_hook.append_basic_block(name="outermost")
+    nested = exit_hook.append_basic_block(name="nested")
+    parent = exit_hook.append_basic_block(name="parent")
+    done = exit_hook.append_basic_block(name="done")
+    builder = ir.IRBuilder(entry)
+    index = exit_hook.args[0]
+
+    now = builder.call(counter_func, [])
+    depth = builder.sub(builder.load(depth_ptr), one)
+    builder.store(depth, depth_ptr)
+    active = increment(
+        builder, counter_slot(builder, "active", index), ir.Constant(i64, -1)
+    )
+    builder.cbranch(
+        builder.icmp_unsigned("<", depth, ir.Constant(i64, PROFILER_MAX_DEPTH)),
+        timed,
+        done,
+    )
+
+    builder.position_at_start(timed)
+    elapsed = builder.sub(now, builder.load(frame_slot(builder, depth, 1)))
+    children = builder.load(frame_slot(builder, depth, 2))
+    exclusive = builder.sub(elapsed, children)
+    increment(builder, counter_slot(builder, "exclusive", index), exclusive)
+    # Recursive calls are already inside the outermost one's inclusive time
+    builder.cbranch(
+        builder.icmp_signed("==", active, ir.Constant(i64, 0)), outermost, nested
+    )
+
+    builder.position_at_start(outermost)
+    increment(builder, counter_slot(builder, "inclusive", index), elapsed)
+    builder.branch(nested)
+
+    builder.position_at_start(nested)
+    builder.cbranch(
+        builder.icmp_unsigned(">", depth, ir.Constant(i64, 0)), parent, done
+    )
+
+    builder.position_at_start(parent)
+    increment(builder, frame_slot(builder, builder.sub(depth, one), 2), elapsed)
+    builder.branch(done)
+
+    builder.position_at_start(done)
+    builder.ret_void()
+    return exit_hook
+
+
+def add_profiler_report_function(
+    module: ir.Module, count: int, output: Path | None
+) -> ir.Function:
+    """
+    Writes calls, inclusive and exclusive cycles of every called function
+    and the calls from each of its callers, to output or stderr
+    """
+    dprintf_func = get_dprintf_function(module)
+    open_func = get_open_function(module)
+    close_func = get_close_function(module)
+    callers = module.get_global(FUNC_PREFIX + "prof.callers")
+    names_table = module.get_global(FUNC_PREFIX + "prof.names")
+    header_str = create_global_string(
+        module,
+        f"{'function':<24} {'calls':>12} {'inclusive':>16} {'exclusive':>16}\n",
+        name=".fmt.prof.header",
+    )
+    row_str = create_global_string(
+        module, "%-24s %12ld %16ld %16ld\n", name=".fmt.prof.row"
+    )
+    caller_str = create_global_string(
+        module, "    <- %-21s %12ld\n", name=".fmt.prof.caller"
+    )
+
+    report = ir.Function(
+        module,
+        ir.FunctionType(get_llvm_type(VoidType), []),
+        name=FUNC_PREFIX + "prof.report",
+    )
+    report.linkage = "internal"
+    entry = report.append_basic_block(name="entry")
+    rows = report.append_basic_block(name="rows")
+    row = report.append_basic_block(name="row")
+    caller_loop = report.append_basic_block(name="callers")
+    caller_check = report.append_basic_block(name="caller.check")
+    caller_row = report.append_basic_block(name="caller.row")
+    caller_next = report.append_basic_block(name="caller.next")
+    next_row = report.append_basic_block(name="next")
+    done = report.append_basic_block(name="done")
+    builder = ir.IRBuilder(entry)
+    zero = ir.Constant(i64, 0)
+    one = ir.Constant(i64, 1)
+
+    fd = ir.Constant(i32, STDERR_FD)
+    if output is not None:
+        path_str = create_global_string(module, str(output), name=".prof.path")
+        opened = builder.call(
+            open_func,
+            [
+                builder.gep(path_str, [ZERO, ZERO], inbounds=True),
+                ir.Constant(i32, OPEN_FLAGS[1]),
+                ir.Constant(i32, NEW_FILE_PERMISSIONS),
+            ],
+        )
+        # Fall back to stderr rather than lose the profile
+        fd = builder.select(
+            builder.icmp_signed("<", opened, ir.Constant(i32, 0)), fd, opened
+        )
+    builder.call(dprintf_func, [fd, builder.gep(header_str, [ZERO, ZERO])])
+    builder.branch(rows)
+
+    def name_of(index: ir.Value) -> ir.Value:
+        return builder.load(builder.gep(names_table, [ZERO, index], inbounds=True))
+
+    builder.position_at_start(rows)
+    index = builder.phi(i64, name="index")
+    index.add_incoming(zero, entry)
+    calls = builder.load(counter_slot(builder, "calls", index))
+    builder.cbranch(builder.icmp_unsigned("==", calls, zero), next_row, row)
+
+    builder.position_at_start(row)
+    builder.call(
+        dprintf_func,
+        [
+            fd,
+            builder.gep(row_str, [ZERO, ZERO]),
+            name_of(index),
+            calls,
+            builder.load(counter_slot(builder, "inclusive", index)),
+            builder.load(counter_slot(builder, "exclusive", index)),
+        ],
+    )
+    builder.branch(caller_loop)
+
+    builder.position_at_start(caller_loop)
+    caller = builder.phi(i64, name="caller")
+    caller.add_incoming(zero, row)
+    builder.cbranch(
+        builder.icmp_unsigned("<=", caller, ir.Constant(i64, count)),
+        caller_check,
+        next_row,
+    )
+
+    builder.position_at_start(caller_check)
+    caller_calls = builder.load(
+        builder.gep(callers, [ZERO, index, caller], inbounds=True)
+    )
+    builder.cbranch(
+        builder.icmp_unsigned("==", caller_calls, zero), caller_next, caller_row
+    )
+
+    builder.position_at_start(caller_row)
+    builder.call(
+        dprintf_func,
+        [fd, builder.gep(caller_str, [ZERO, ZERO]), name_of(caller), caller_calls],
+    )
+    builder.branch(caller_next)
+
+    builder.position_at_start(caller_next)
+    caller.add_incoming(builder.add(caller, one), caller_next)
+    builder.branch(caller_loop)
+
+    builder.position_at_start(next_row)
+    next_index = builder.add(index, one)
+    index.add_incoming(next_index, next_row)
+    builder.cbranch(
+        builder.icmp_unsigned("<", next_index, ir.Constant(i64, count)), rows, done
+    )
+
+    builder.position_at_start(done)
+    if output is not None:
+        builder.call(close_func, [fd])
+    builder.ret_void()
+    return report
+
+
+def add_profiler_report_init(module: ir.Module, report: ir.Function) -> None:
+    atexit_func = get_atexit_function(module)
+
+    main_func = module.get_global("main")
+    builder = ir.IRBuilder()
+    builder.position_at_start(main_func.entry_basic_block)
+    builder.call(atexit_func, [report])
+
+
+def add_exit_hooks(func: ir.Function, exit_hook: ir.Function, index: int) -> None:
+    """
+    Calls the exit hook before every return. A tail call to a user function
+    replaces this call's frame, so the hook goes before the call instead and
+    the callee is attributed to this function's caller.
+    """
+    for block in func.blocks:
+        if not isinstance(block.terminator, ir.Ret):
+            continue
+        before = block.terminator
+        if len(block.instructions) >= 2:
+            call = block.instructions[-2]
+            if (
+                isinstance(call, ir.CallInstr)
+                and call.tail
+                and isinstance(call.callee, ir.Function)
+                and call.callee.calling_convention == USER_CALLING_CONVENTION
+            ):
+                before = call
+
+        builder = ir.IRBuilder(block)
+        builder.position_before(before)
+        # Calls that can be inlined need a location in functions with debug info
+        if "dbg" in before.metadata:
+            builder.debug_metadata = before.metadata["dbg"]
+        builder.call(exit_hook, [ir.Constant(i64, index)])
@@ -0,0 +1,127 @@
+from dataclasses import asdict, dataclass
+import json
+from pathlib import Path
+import re
+
+import rich
+
+from lang_1eft.codegen.codegen_util import FUNC_PREFIX
+
+REMARK_FORMATS = ("text", "json")
+
+_DEBUG_LOC = re.compile(r"Line:\s*(\d+),\s*Column:\s*(\d+)")
+
+
+@dataclass(frozen=True)
+class Remark:
+    """Remark is one LLVM optimization remark, mapped back to 1eft names."""
+
+    kind: str
+    pass_name: str
+    name: str
+    function: str
+    message: str
+    line: int | None = None
+    column: int | None = None
+
+
+def demangle(name: str) -> str:
+    return name.removeprefix(FUNC_PREFIX)
+
+
+def _parse_value(value: str) -> str:
+    value = value.strip()
+    if len(value) >= 2 and value[0] == value[-1] == "'":
+        return value[1:-1].replace("''", "'")
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        return value[1:-1].replace('\\"', '"')
+    return value
+
+
+def parse_remarks(yaml: str) -> list[Remark]:
+    """
+    Parse the YAML remark stream written by LLVM. Only the subset of YAML that
+    LLVM emits is understood, which keeps PyYAML out of the dependencies.
+    """
+    remarks: list[Remark] = []
+    for document in yaml.split("\n--- "):
+        lines = document.strip().removeprefix("--- ").splitlines()
+        if not lines or not lines[0].startswith("!"):
+            continue
+
+        fields: dict[str, str] = {}
+        message = ""
+        in_args = False
+        line = column = None
+        for text in lines[1:]:
+            if text == "...":
+                break
+            if text.startswith("Args:"):
+                in_args = True
+                continue
+
+            if in_args and text.startswith("  - "):
+                key, _, value = text[4:].partition(":")
+                if key == "DebugLoc":
+                    continue
+                value = _parse_value(value)
+                message += demangle(value) if key in ("Callee", "Caller") else value
+            elif not text.startswith(" "):
+                in_args = False
+                key, _, value = text.partition(":")
+                if key == "DebugLoc":
+                    loc = _DEBUG_LOC.search(value)
+                    if loc is not None:
+                        line, column = int(loc.group(1)), int(loc.group(2))
+                else:
+                    fields[key] = _parse_value(value)
+
+        remarks.append(
+            Remark(
+                kind=lines[0][1:].strip().lower(),
+                pass_name=fields.get("Pass", ""),
+                name=fields.get("Name", ""),
+                function=demangle(fields.get("Function", "")),
+                message=message,
+                line=line,
+                column=column,
+            )
+        )
+    return remarks
+
+
+def group_by_function(remarks: list[Remark]) -> dict[str, list[Remark]]:
+    grouped: dict[str, list[Remark]] = {}
+    for remark in remarks:
+        grouped.setdefault(remark.function, []).append(remark)
+    return grouped
+
+
+def write_remarks_report(remarks: list[Remark], output: Path, format: str) -> None:
+    grouped = group_by_function(remarks)
+
+    if format == "json":
+        report = json.dumps(
+            {
+                function: [asdict(r) for r in function_remarks]
+                for function, function_remarks in grouped.items()
+            },
+            indent=2,
+        )
+    else:
+        lines = []
+        for function, function_remarks in grouped.items():
+            counts = {
+                kind: sum(1 for r in function_remarks if r.kind == kind)
+                for kind in ("passed", "missed", "analysis")
+            }
+            summary = ", ".join(f"{n} {kind}" for kind, n in counts.items() if n)
+            lines.append(f"{function} ({summary})")
+            for r in function_remarks:
+                loc = f" at {r.line}:{r.column}" if r.line is not None else ""
+                lines.append(f"  {r.kind:<8} {r.pass_name}/{r.name}{loc}: {r.message}")
+        report = "\n".join(lines) + "\n"
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(report)
+    rich.print(f"[green]Success:[/green] Optimization remarks written to {output}")
@@ -0,0 +1,110 @@
+from hashlib import sha256
+from pathlib import Path
+
+import llvmlite.ir as ir
+
+from lang_1eft.build_cache import DEFAULT_CACHE_DIR, RUNTIME_DIR, compiler_fingerprint
+from lang_1eft.codegen.codegen_util import (
+    DEFAULT_STDOUT_BUFFER,
+    FUNC_PREFIX,
+    VOID_PTR,
+    i1,
+    i8,
+    i32,
+    i64,
+    keep_frame_pointers,
+    place_in_own_sections,
+)
+from lang_1eft.codegen.predef_functions import add_all_predef_functions
+from lang_1eft.codegen.thread_pool import QAR_JOB_TYPE
+
+# inline: predefined functions are generated into every module
+# object: modules declare them and link a prebuilt runtime object file
+# bitcode: the prebuilt runtime bitcode is linked into the module before optimizing
+RUNTIME_MODES = ("inline", "object", "bitcode")
+
+DEFAULT_RUNTIME_DIR = DEFAULT_CACHE_DIR / RUNTIME_DIR
+
+# Signatures of the functions the runtime library defines, so modules can
+# declare them without generating the runtime
+RUNTIME_FUNCTIONS: dict[str, ir.FunctionType] = {
+    "out.write_all": ir.FunctionType(ir.VoidType(), [VOID_PTR, i64]),
+    "flush": ir.FunctionType(ir.VoidType(), []),
+    "out.reserve": ir.FunctionType(VOID_PTR, [i64]),
+    "out.bytes": ir.FunctionType(ir.VoidType(), [VOID_PTR, i64]),
+    "wr1te": ir.FunctionType(ir.VoidType(), [VOID_PTR]),
+    "wr1tec": ir.FunctionType(ir.VoidType(), [i8]),
+    "wr1te1": ir.FunctionType(ir.VoidType(), [VOID_PTR]),
+    "wr1ted": ir.FunctionType(ir.VoidType(), [i64]),
+    "wr1teb": ir.FunctionType(ir.VoidType(), [i1]),
+    "wr1tea": ir.FunctionType(ir.VoidType(), [VOID_PTR]),
+    "in.fill": ir.FunctionType(i1, []),
+    "in.peek": ir.FunctionType(i32, []),
+    "getd": ir.FunctionType(i64, []),
+    "srazd": ir.FunctionType(ir.VoidType(), [i64]),
+    "razdd": ir.FunctionType(i64, []),
+    "f111razd": ir.FunctionType(ir.VoidType(), [i64.as_pointer(), i64]),
+    "zsec": ir.FunctionType(i64, []),
+    "rdtsc": ir.FunctionType(i64, []),
+    "barr1er": ir.FunctionType(i64, [i64]),
+    "f@qez": ir.FunctionType(i64, [VOID_PTR, i64]),
+    "fread": ir.FunctionType(i64, [i64, VOID_PTR, i64]),
+    "fwr1te": ir.FunctionType(i64, [i64, VOID_PTR, i64]),
+    "fc1@se": ir.FunctionType(i64, [i64]),
+    "fs1ze": ir.FunctionType(i64, [i64]),
+    "fv1ew": ir.FunctionType(VOID_PTR, [i64]),
+    "pool.work": ir.FunctionType(ir.VoidType(), []),
+    "task.push": ir.FunctionType(i1, [VOID_PTR]),
+    "task.find": ir.FunctionType(VOID_PTR, []),
+    "task.run": ir.FunctionType(ir.VoidType(), [VOID_PTR]),
+    "pool.worker": ir.FunctionType(VOID_PTR, [VOID_PTR]),
+    "pool.start": ir.FunctionType(ir.VoidType(), []),
+    "pool.run": ir.FunctionType(
+        ir.VoidType(), [QAR_JOB_TYPE.as_pointer(), VOID_PTR, i64, i64]
+    ),
+    "task.spawn": ir.FunctionType(i64, [VOID_PTR]),
+    "wa1t": ir.FunctionType(i64, [i64]),
+    "xadd": ir.FunctionType(i64, [i64.as_pointer(), i64]),
+    "cas": ir.FunctionType(i1, [i64.as_pointer(), i64, i64]),
+}
+
+
+def build_runtime_module(
+    triple: str,
+    data_layout: str,
+    sections: bool = False,
+    frame_pointers: bool = False,
+    stdout_buffer: int = DEFAULT_STDOUT_BUFFER,
+) -> ir.Module:
+    module = ir.Module(name="1eft_runtime")
+    module.triple = triple
+    module.data_layout = data_layout
+    add_all_predef_functions(module, stdout_buffer)
+    if sections:
+        place_in_own_sections(module)
+    if frame_pointers:
+        keep_frame_pointers(module)
+    return module
+
+
+def declare_runtime_functions(module: ir.Module) -> None:
+    for name, func_type in RUNTIME_FUNCTIONS.items():
+        ir.Function(module, func_type, name=FUNC_PREFIX + name)
+
+
+def check_runtime_functions(runtime: ir.Module) -> None:
+    """Asserts RUNTIME_FUNCTIONS still matches what the runtime defines"""
+    defined = {
+        func.name: str(func.function_type)
+        for func in runtime.functions
+        if not func.is_declaration
+    }
+    declared = {FUNC_PREFIX + n: str(t) for n, t in RUNTIME_FUNCTIONS.items()}
+    assert defined == declared, "RUNTIME_FUNCTIONS is out of date"
+
+
+def runtime_library_path(runtime_dir: Path, key_parts: list[str], suffix: str) -> Path:
+    """Path of the prebuilt runtime for a set of codegen settings"""
+    digest = sha256(" ".join(key_parts).encode("utf-8"))
+    digest.update(compiler_fingerprint().encode("utf-8"))
+    return runtime_dir / f"1eft_runtime-{digest.hexdigest()[:16]}{suffix}"
@@ -0,0 +1,761 @@
+import llvmlite.ir as ir
+
+from lang_1eft.pipeline.ast_definitions import *
+from lang_1eft.codegen.codegen_util import *
+
+# Linux value of the sysconf name for the number of online processors
+SC_NPROCESSORS_ONLN = 84
+# Environment variable overriding the number of threads, main included
+THREADS_ENV = "LEFT_THREADS"
+MAX_THREADS = 256
+# A qar range is split into this many chunks per thread, for load balance
+CHUNKS_PER_THREAD = 8
+# Tasks each thread can have queued, a power of two. Spawns beyond it run
+# right away on the spawning thread.
+DEQUE_CAPACITY = 1 << 10
+# Room for a glibc pthread_mutex_t or pthread_cond_t, all zero is the default
+PTHREAD_OBJECT_SIZE = 64
+
+ZERO_I64 = ir.Constant(i64, 0)
+ONE_I64 = ir.Constant(i64, 1)
+NULL = ir.Constant(VOID_PTR, None)
+
+# A qar loop body outlined by codegen: context, first index, end index
+QAR_JOB_TYPE = ir.FunctionType(ir.VoidType(), [VOID_PTR, i64, i64])
+
+# Predefined function that runs a function call as a task, see build_spawn
+SPAWN_FUNCTION = "sqawz"
+# Runs the call a task record describes and returns its result
+TASK_THUNK_TYPE = ir.FunctionType(i64, [VOID_PTR])
+# Start of every task record: thunk, done flag, result. The call's
+# arguments follow.
+TASK_HEADER_TYPE = ir.LiteralStructType([TASK_THUNK_TYPE.as_pointer(), i64, i64])
+TASK_THUNK, TASK_DONE, TASK_RESULT = 0, 1, 2
+# Done flag of a task wa1t has returned, written just before freeing it.
+# Any value but 0 or 1 means the handle was waited on already.
+TASK_WAITED = 2
+# One thread's tasks, guarded by a spin lock: lock, top, bottom, ring. The
+# owner pushes and pops at the bottom, other threads steal from the top.
+DEQUE_TYPE = ir.LiteralStructType(
+    [i64, i64, i64, ir.ArrayType(VOID_PTR, DEQUE_CAPACITY)]
+)
+DEQUE_LOCK, DEQUE_TOP, DEQUE_BOTTOM, DEQUE_TASKS = 0, 1, 2, 3
+
+
+def add_thread_pool(module: ir.Module) -> None:
+    """
+    State shared by the workers. The lock guards the qar job, except for
+    pool.next, which workers claim chunks from atomically. Tasks go through
+    the per thread deques instead.
+    """
+    object_type = ir.ArrayType(i8, PTHREAD_OBJECT_SIZE)
+    for name in ("lock", "wake", "done"):
+        pthread_object = ir.GlobalVariable(
+            module, object_type, name=f"{FUNC_PREFIX}pool.{name}"
+        )
+        pthread_object.linkage = "internal"
+        pthread_object.align = 16
+        pthread_object.initializer = ir.Constant(object_type, None)  # type: ignore
+
+    for name in (
+        "size",
+        "busy",
+        "generation",
+        "pending",
+        "next",
+        "end",
+        "chunk",
+        "queued",
+        "sleeping",
+    ):
+        counter = ir.GlobalVariable(module, i64, name=f"{FUNC_PREFIX}pool.{name}")
+        counter.linkage = "internal"
+        counter.initializer = ir.Constant(i64, 0)  # type: ignore
+
+    job = ir.GlobalVariable(
+        module, QAR_JOB_TYPE.as_pointer(), name=FUNC_PREFIX + "pool.job"
+    )
+    job.linkage = "internal"
+    job.initializer = ir.Constant(QAR_JOB_TYPE.as_pointer(), None)  # type: ignore
+    context = ir.GlobalVariable(module, VOID_PTR, name=FUNC_PREFIX + "pool.context")
+    context.linkage = "internal"
+    context.initializer = ir.Constant(VOID_PTR, None)  # type: ignore
+
+    deques_type = ir.ArrayType(DEQUE_TYPE, MAX_THREADS)
+    deques = ir.GlobalVariable(module, deques_type, name=FUNC_PREFIX + "pool.deques")
+    deques.linkage = "internal"
+    deques.initializer = ir.Constant(deques_type, None)  # type: ignore
+    # Index of the running thread in the pool, 0 on the main thread
+    index = ir.GlobalVariable(module, i64, name=FUNC_PREFIX + "pool.self")
+    index.linkage = "internal"
+    index.storage_class = "thread_local"
+    index.initializer = ir.Constant(i64, 0)  # type: ignore
+    # Number of tasks the running thread is inside of
+    depth = ir.GlobalVariable(module, i64, name=FUNC_PREFIX + "pool.tasks")
+    depth.linkage = "internal"
+    depth.storage_class = "thread_local"
+    depth.initializer = ir.Constant(i64, 0)  # type: ignore
+
+
+def get_pool_global(module: ir.Module, name: str) -> ir.GlobalVariable:
+    return module.get_global(f"{FUNC_PREFIX}pool.{name}")
+
+
+def call_pthread(builder: ir.IRBuilder, name: str, *objects: str) -> None:
+    """Calls a pthread mutex or condition function on pool globals"""
+    module = builder.module
+    func = get_pthread_function(module, name, len(objects))
+    builder.call(
+        func,
+        [
+            builder.gep(get_pool_global(module, o), [ZERO, ZERO], inbounds=True)
+            for o in objects
+        ],
+    )
+
+
+def add_pool_work_function(module: ir.Module) -> ir.Function:
+    """Runs chunks of the current job until none are left"""
+    next_index = get_pool_global(module, "next")
+
+    work = ir.Function(
+        module, ir.FunctionType(ir.VoidType(), []), name=FUNC_PREFIX + "pool.work"
+    )
+    entry = work.append_basic_block(name="entry")
+    loop = work.append_basic_block(name="loop")
+    body = work.append_basic_block(name="body")
+    done = work.append_basic_block(name="done")
+    builder = ir.IRBuilder(entry)
+    job = builder.load(get_pool_global(module, "job"), name="job")
+    context = builder.load(get_pool_global(module, "context"), name="context")
+    end = builder.load(get_pool_global(module, "end"), name="end")
+    chunk = builder.load(get_pool_global(module, "chunk"), name="chunk")
+    builder.branch(loop)
+
+    builder.position_at_start(loop)
+    first = builder.atomic_rmw("add", next_index, chunk, "monotonic", name="first")
+    builder.cbranch(builder.icmp_signed("<", first, end), body, done)
+
+    builder.position_at_start(body)
+    remaining = builder.sub(end, first, name="remaining")
+    size = builder.select(
+        builder.icmp_signed("<", chunk, remaining), chunk, remaining, name="size"
+    )
+    builder.call(job, [context, first, builder.add(first, size, name="last")])
+    builder.branch(loop)
+
+    builder.position_at_start(done)
+    builder.ret_void()
+    return work
+
+
+def lock_deque(builder: ir.IRBuilder, deque: ir.Value) -> None:
+    """Spins until it holds the lock of deque, yielding between attempts"""
+    func = builder.function
+    spin = func.append_basic_block(name="spin")
+    retry = func.append_basic_block(name="retry")
+    locked = func.append_basic_block(name="locked")
+    lock = builder.gep(deque, [ZERO, ir.Constant(i32, DEQUE_LOCK)], inbounds=True)
+    builder.branch(spin)
+
+    builder.position_at_start(spin)
+    exchange = builder.cmpxchg(lock, ZERO_I64, ONE_I64, "acquire", "monotonic")
+    builder.cbranch(builder.extract_value(exchange, 1), locked, retry)
+
+    builder.position_at_start(retry)
+    builder.call(get_sched_yield_function(builder.module), [])
+    builder.branch(spin)
+
+    builder.position_at_start(locked)
+
+
+def unlock_deque(builder: ir.IRBuilder, deque: ir.Value) -> None:
+    lock = builder.gep(deque, [ZERO, ir.Constant(i32, DEQUE_LOCK)], inbounds=True)
+    builder.store_atomic(ZERO_I64, lock, "release", 8)
+
+
+def deque_field(builder: ir.IRBuilder, deque: ir.Value, field: int) -> ir.Value:
+    return builder.gep(deque, [ZERO, ir.Constant(i32, field)], inbounds=True)
+
+
+def deque_slot(builder: ir.IRBuilder, deque: ir.Value, position: ir.Value) -> ir.Value:
+    index = builder.and_(position, ir.Constant(i64, DEQUE_CAPACITY - 1))
+    return builder.gep(
+        deque, [ZERO, ir.Constant(i32, DEQUE_TASKS), index], inbounds=True
+    )
+
+
+def own_deque(builder: ir.IRBuilder) -> ir.Value:
+    module = builder.module
+    index = builder.load(get_pool_global(module, "self"), name="self")
+    return builder.gep(get_pool_global(module, "deques"), [ZERO, index], inbounds=True)
+
+
+def task_field(builder: ir.IRBuilder, task: ir.Value, field: int) -> ir.Value:
+    header = builder.bitcast(task, TASK_HEADER_TYPE.as_pointer())
+    return builder.gep(header, [ZERO, ir.Constant(i32, field)], inbounds=True)
+
+
+def add_task_push_function(module: ir.Module) -> ir.Function:
+    """Queues a task on the deque of this thread, false when it is full"""
+    queued = get_pool_global(module, "queued")
+
+    push = ir.Function(
+        module,
+        ir.FunctionType(get_llvm_type(BooleanType), [VOID_PTR]),
+        name=FUNC_PREFIX + "task.push",
+    )
+    entry = push.append_basic_block(name="entry")
+    builder = ir.IRBuilder(entry)
+    deque = own_deque(builder)
+    lock_deque(builder, deque)
+    full = push.append_basic_block(name="full")
+    room = push.append_basic_block(name="room")
+    top = builder.load(deque_field(builder, deque, DEQUE_TOP), name="top")
+    bottom_ptr = deque_field(builder, deque, DEQUE_BOTTOM)
+    bottom = builder.load(bottom_ptr, name="bottom")
+    count = builder.sub(bottom, top, name="count")
+    limit = ir.Constant(i64, DEQUE_CAPACITY)
+    builder.cbranch(builder.icmp_unsigned(">=", count, limit), full, room)
+
+    builder.position_at_start(full)
+    unlock_deque(builder, deque)
+    builder.ret(ir.Constant(i1, False))
+
+    builder.position_at_start(room)
+    builder.store(push.args[0], deque_slot(builder, deque, bottom))
+    builder.store(builder.add(bottom, ONE_I64), bottom_ptr)
+    unlock_deque(builder, deque)
+    builder.atomic_rmw("add", queued, ONE_I64, "seq_cst")
+    builder.ret(ir.Constant(i1, True))
+    return push
+
+
+def add_task_find_function(module: ir.Module) -> ir.Function:
+    """
+    Takes the newest task of this thread, or steals the oldest task of
+    another, trying them in turn. Returns null when every deque is empty.
+    """
+    queued = get_pool_global(module, "queued")
+    deques = get_pool_global(module, "deques")
+
+    find = ir.Function(
+        module, ir.FunctionType(VOID_PTR, []), name=FUNC_PREFIX + "task.find"
+    )
+    entry = find.append_basic_block(name="entry")
+    own = find.append_basic_block(name="own")
+    builder = ir.IRBuilder(entry)
+    # Idle threads poll, so skip the locks when nothing is queued anywhere
+    waiting = builder.load_atomic(queued, "monotonic", 8, name="waiting")
+    nothing = find.append_basic_block(name="nothing")
+    builder.cbranch(builder.icmp_unsigned("==", waiting, ZERO_I64), nothing, own)
+
+    builder.position_at_start(own)
+    index = builder.load(get_pool_global(module, "self"), name="self")
+    deque = builder.gep(deques, [ZERO, index], inbounds=True)
+    lock_deque(builder, deque)
+    popped = find.append_basic_block(name="popped")
+    empty = find.append_basic_block(name="empty")
+    top = builder.load(deque_field(builder, deque, DEQUE_TOP), name="top")
+    bottom_ptr = deque_field(builder, deque, DEQUE_BOTTOM)
+    bottom = builder.load(bottom_ptr, name="bottom")
+    builder.cbranch(builder.icmp_unsigned("<", top, bottom), popped, empty)
+
+    builder.position_at_start(popped)
+    last = builder.sub(bottom, ONE_I64, name="last")
+    newest = builder.load(deque_slot(builder, deque, last), name="newest")
+    builder.store(last, bottom_ptr)
+    unlock_deque(builder, deque)
+    found = find.append_basic_block(name="found")
+    popped_end = builder.block
+    builder.branch(found)
+
+    builder.position_at_start(empty)
+    unlock_deque(builder, deque)
+    size = builder.load(get_pool_global(module, "size"), name="size")
+    victims = find.append_basic_block(name="victims")
+    builder.branch(victims)
+
+    builder.position_at_start(victims)
+    offset = builder.phi(i64, name="offset")
+    offset.add_incoming(ONE_I64, empty)
+    visit = find.append_basic_block(name="visit")
+    builder.cbranch(builder.icmp_signed("<", offset, size), visit, nothing)
+
+    builder.position_at_start(visit)
+    victim_index = builder.urem(builder.add(index, offset), size, name="victim")
+    victim = builder.gep(deques, [ZERO, victim_index], inbounds=True)
+    lock_deque(builder, victim)
+    stolen = find.append_basic_block(name="stolen")
+    bare = find.append_basic_block(name="bare")
+    victim_top_ptr = deque_field(builder, victim, DEQUE_TOP)
+    victim_top = builder.load(victim_top_ptr, name="victim_top")
+    victim_bottom = builder.load(deque_field(builder, victim, DEQUE_BOTTOM))
+    builder.cbranch(
+        builder.icmp_unsigned("<", victim_top, victim_bottom), stolen, bare
+    )
+
+    builder.position_at_start(stolen)
+    oldest = builder.load(deque_slot(builder, victim, victim_top), name="oldest")
+    builder.store(builder.add(victim_top, ONE_I64), victim_top_ptr)
+    unlock_deque(builder, victim)
+    stolen_end = builder.block
+    builder.branch(found)
+
+    builder.position_at_start(bare)
+    unlock_deque(builder, victim)
+    offset.add_incoming(builder.add(offset, ONE_I64), bare)
+    builder.branch(victims)
+
+    builder.position_at_start(found)
+    task = builder.phi(VOID_PTR, name="task")
+    task.add_incoming(newest, popped_end)
+    task.add_incoming(oldest, stolen_end)
+    builder.atomic_rmw("sub", queued, ONE_I64, "seq_cst")
+    builder.ret(task)
+
+    builder.position_at_start(nothing)
+    builder.ret(NULL)
+    return find
+
+
+def add_task_run_function(module: ir.Module) -> ir.Function:
+    """Runs a task and publishes its result to whoever waits on it"""
+    depth = get_pool_global(module, "tasks")
+    run = ir.Function(
+        module,
+        ir.FunctionType(ir.VoidType(), [VOID_PTR]),
+        name=FUNC_PREFIX + "task.run",
+    )
+    builder = ir.IRBuilder(run.append_basic_block(name="entry"))
+    task = run.args[0]
+    thunk = builder.load(task_field(builder, task, TASK_THUNK), name="thunk")
+    builder.store(builder.add(builder.load(depth), ONE_I64), depth)
+    result = builder.call(thunk, [task], name="result")
+    builder.store(builder.sub(builder.load(depth), ONE_I64), depth)
+    builder.store(result, task_field(builder, task, TASK_RESULT))
+    builder.store_atomic(ONE_I64, task_field(builder, task, TASK_DONE), "release", 8)
+    builder.ret_void()
+    return run
+
+
+def add_pool_worker_function(module: ir.Module) -> ir.Function:
+    """
+    Thread start routine. Runs queued tasks while there are any, then sleeps
+    until a task is queued or the generation changes. A new generation is a
+    qar job to help with and report back on.
+    """
+    work_func = module.get_global(FUNC_PREFIX + "pool.work")
+    find_func = module.get_global(FUNC_PREFIX + "task.find")
+    run_func = module.get_global(FUNC_PREFIX + "task.run")
+    generation = get_pool_global(module, "generation")
+    pending = get_pool_global(module, "pending")
+    queued = get_pool_global(module, "queued")
+    sleeping = get_pool_global(module, "sleeping")
+
+    worker = ir.Function(
+        module,
+        ir.FunctionType(VOID_PTR, [VOID_PTR]),
+        name=FUNC_PREFIX + "pool.worker",
+    )
+    worker.attributes.add("noinline")
+    entry = worker.append_basic_block(name="entry")
+    loop = worker.append_basic_block(name="loop")
+    task = worker.append_basic_block(name="task")
+    idle = worker.append_basic_block(name="idle")
+    check = worker.append_basic_block(name="check")
+    drowsy = worker.append_basic_block(name="drowsy")
+    wake = worker.append_basic_block(name="wake")
+    wait = worker.append_basic_block(name="wait")
+    run = worker.append_basic_block(name="run")
+    last = worker.append_basic_block(name="last")
+    finish = worker.append_basic_block(name="finish")
+    builder = ir.IRBuilder(entry)
+    index = builder.ptrtoint(worker.args[0], i64, name="index")
+    builder.store(index, get_pool_global(module, "self"))
+    builder.branch(loop)
+
+    builder.position_at_start(loop)
+    seen = builder.phi(i64, name="seen")
+    seen.add_incoming(ZERO_I64, entry)
+    found = builder.call(find_func, [], name="found")
+    builder.cbranch(builder.icmp_unsigned("==", found, NULL), idle, task)
+
+    builder.position_at_start(task)
+    builder.call(run_func, [found])
+    seen.add_incoming(seen, task)
+    builder.branch(loop)
+
+    builder.position_at_start(idle)
+    call_pthread(builder, "pthread_mutex_lock", "lock")
+    builder.branch(check)
+
+    builder.position_at_start(check)
+    current = builder.load(generation, name="current")
+    builder.cbranch(builder.icmp_unsigned("==", current, seen), drowsy, run)
+
+    # Spawns check for sleepers after queueing, so one of the two sees the
+    # other's update and no task is left behind
+    builder.position_at_start(drowsy)
+    builder.atomic_rmw("add", sleeping, ONE_I64, "seq_cst")
+    waiting = builder.load_atomic(queued, "seq_cst", 8, name="waiting")
+    builder.cbranch(builder.icmp_unsigned("==", waiting, ZERO_I64), wait, wake)
+
+    builder.position_at_start(wake)
+    builder.atomic_rmw("sub", sleeping, ONE_I64, "seq_cst")
+    call_pthread(builder, "pthread_mutex_unlock", "lock")
+    seen.add_incoming(seen, wake)
+    builder.branch(loop)
+
+    builder.position_at_start(wait)
+    call_pthread(builder, "pthread_cond_wait", "wake", "lock")
+    builder.atomic_rmw("sub", sleeping, ONE_I64, "seq_cst")
+    builder.branch(check)
+
+    builder.position_at_start(run)
+    call_pthread(builder, "pthread_mutex_unlock", "lock")
+    builder.call(work_func, [])
+    call_pthread(builder, "pthread_mutex_lock", "lock")
+    left = builder.sub(builder.load(pending), ONE_I64, name="left")
+    builder.store(left, pending)
+    builder.cbranch(builder.icmp_unsigned("==", left, ZERO_I64), last, finish)
+
+    builder.position_at_start(last)
+    call_pthread(builder, "pthread_cond_broadcast", "done")
+    builder.branch(finish)
+
+    builder.position_at_start(finish)
+    call_pthread(builder, "pthread_mutex_unlock", "lock")
+    seen.add_incoming(current, finish)
+    builder.branch(loop)
+    return worker
+
+
+def add_pool_start_function(module: ir.Module) -> ir.Function:
+    """
+    Sizes the pool to the online processors, or to LEFT_THREADS when it is a
+    positive number, and starts a worker for every thread but the caller
+    """
+    worker_func = module.get_global(FUNC_PREFIX + "pool.worker")
+    create_func = get_pthread_create_function(module)
+
+    start = ir.Function(
+        module, ir.FunctionType(ir.VoidType(), []), name=FUNC_PREFIX + "pool.start"
+    )
+    start.attributes.add("noinline")
+    start.attributes.add("cold")
+    entry = start.append_basic_block(name="entry")
+    parse = start.append_basic_block(name="parse")
+    clamp = start.append_basic_block(name="clamp")
+    loop = start.append_basic_block(name="loop")
+    spawn = start.append_basic_block(name="spawn")
+    failed = start.append_basic_block(name="failed")
+    done = start.append_basic_block(name="done")
+    builder = ir.IRBuilder(entry)
+    thread = builder.alloca(i64, name="thread")
+    online = builder.call(
+        get_sysconf_function(module),
+        [ir.Constant(i32, SC_NPROCESSORS_ONLN)],
+        name="online",
+    )
+    name = create_global_string(module, THREADS_ENV, name=".pool.env")
+    text = builder.call(
+        get_getenv_function(module),
+        [builder.gep(name, [ZERO, ZERO], inbounds=True)],
+        name="text",
+    )
+    builder.cbranch(builder.icmp_unsigned("==", text, NULL), clamp, parse)
+
+    builder.position_at_start(parse)
+    requested = builder.call(
+        get_strtol_function(module),
+        [text, ir.Constant(i8ptr.as_pointer(), None), ir.Constant(i32, 10)],
+        name="requested",
+    )
+    builder.branch(clamp)
+
+    builder.position_at_start(clamp)
+    asked = builder.phi(i64, name="asked")
+    asked.add_incoming(online, entry)
+    asked.add_incoming(requested, parse)
+    positive = builder.icmp_signed(">", asked, ZERO_I64)
+    size = builder.select(positive, asked, online)
+    size = builder.select(builder.icmp_signed(">", size, ZERO_I64), size, ONE_I64)
+    limit = ir.Constant(i64, MAX_THREADS)
+    size = builder.select(builder.icmp_signed(">", size, limit), limit, size)
+    builder.branch(loop)
+
+    builder.position_at_start(loop)
+    index = builder.phi(i64, name="index")
+    index.add_incoming(ONE_I64, clamp)
+    builder.cbranch(builder.icmp_signed("<", index, size), spawn, done)
+
+    builder.position_at_start(spawn)
+    # Workers learn their index, and so their deque, from their argument
+    worker_index = builder.inttoptr(index, VOID_PTR, name="worker_index")
+    status = builder.call(create_func, [thread, NULL, worker_func, worker_index])
+    index.add_incoming(builder.add(index, ONE_I64), spawn)
+    builder.cbranch(builder.icmp_unsigned("==", status, ZERO), loop, failed)
+
+    # Make do with the workers that did start
+    builder.position_at_start(failed)
+    builder.branch(done)
+
+    builder.position_at_start(done)
+    started = builder.phi(i64, name="started")
+    started.add_incoming(size, loop)
+    started.add_incoming(index, failed)
+    builder.store(started, get_pool_global(module, "size"))
+    builder.ret_void()
+    return start
+
+
+def add_pool_run_function(module: ir.Module) -> ir.Function:
+    """
+    Runs job over [first, end) on every thread of the pool and returns once
+    the whole range is done. Calls made while the pool is busy, from inside
+    another qar loop, run the range on the calling thread instead. So do
+    calls from a worker or from inside a task: the workers they would wait on
+    may themselves be waiting on the caller.
+    """
+    work_func = module.get_global(FUNC_PREFIX + "pool.work")
+    start_func = module.get_global(FUNC_PREFIX + "pool.start")
+    busy = get_pool_global(module, "busy")
+    pool_size = get_pool_global(module, "size")
+    pending = get_pool_global(module, "pending")
+    generation = get_pool_global(module, "generation")
+
+    run = ir.Function(
+        module,
+        ir.FunctionType(
+            ir.VoidType(), [QAR_JOB_TYPE.as_pointer(), VOID_PTR, i64, i64]
+        ),
+        name=FUNC_PREFIX + "pool.run",
+    )
+    run.attributes.add("noinline")
+    job, context, first, end = run.args
+    entry = run.append_basic_block(name="entry")
+    nested = run.append_basic_block(name="nested")
+    claim = run.append_basic_block(name="claim")
+    serial = run.append_basic_block(name="serial")
+    claimed = run.append_basic_block(name="claimed")
+    starting = run.append_basic_block(name="starting")
+    ready = run.append_basic_block(name="ready")
+    alone = run.append_basic_block(name="alone")
+    share = run.append_basic_block(name="share")
+    check = run.append_basic_block(name="check")
+    wait = run.append_basic_block(name="wait")
+    release = run.append_basic_block(name="release")
+    finished = run.append_basic_block(name="finished")
+    empty = run.append_basic_block(name="empty")
+    builder = ir.IRBuilder(entry)
+    builder.cbranch(builder.icmp_signed("<", first, end), nested, empty)
+
+    builder.position_at_start(nested)
+    inside = builder.or_(
+        builder.load(get_pool_global(module, "self")),
+        builder.load(get_pool_global(module, "tasks")),
+    )
+    builder.cbranch(builder.icmp_unsigned("==", inside, ZERO_I64), claim, serial)
+
+    builder.position_at_start(claim)
+    exchange = builder.cmpxchg(busy, ZERO_I64, ONE_I64, "acquire", "monotonic")
+    builder.cbranch(builder.extract_value(exchange, 1), claimed, serial)
+
+    builder.position_at_start(serial)
+    builder.call(job, [context, first, end])
+    builder.ret_void()
+
+    builder.position_at_start(claimed)
+    builder.cbranch(
+        builder.icmp_unsigned("==", builder.load(pool_size), ZERO_I64),
+        starting,
+        ready,
+    )
+
+    builder.position_at_start(starting)
+    builder.call(start_func, [])
+    builder.branch(ready)
+
+    builder.position_at_start(ready)
+    size = builder.load(pool_size, name="size")
+    builder.cbranch(builder.icmp_unsigned("==", size, ONE_I64), alone, share)
+
+    builder.position_at_start(alone)
+    builder.call(job, [context, first, end])
+    builder.branch(finished)
+
+    builder.position_at_start(share)
+    chunks = builder.mul(size, ir.Constant(i64, CHUNKS_PER_THREAD), name="chunks")
+    chunk = builder.udiv(builder.sub(end, first), chunks, name="chunk")
+    chunk = builder.select(builder.icmp_unsigned("==", chunk, ZERO_I64), ONE_I64, chunk)
+    call_pthread(builder, "pthread_mutex_lock", "lock")
+    builder.store(job, get_pool_global(module, "job"))
+    builder.store(context, get_pool_global(module, "context"))
+    builder.store(first, get_pool_global(module, "next"))
+    builder.store(end, get_pool_global(module, "end"))
+    builder.store(chunk, get_pool_global(module, "chunk"))
+    builder.store(builder.sub(size, ONE_I64), pending)
+    builder.store(builder.add(builder.load(generation), ONE_I64), generation)
+    call_pthread(builder, "pthread_cond_broadcast", "wake")
+    call_pthread(builder, "pthread_mutex_unlock", "lock")
+    builder.call(work_func, [])
+    call_pthread(builder, "pthread_mutex_lock", "lock")
+    builder.branch(check)
+
+    builder.position_at_start(check)
+    builder.cbranch(
+        builder.icmp_unsigned("==", builder.load(pending), ZERO_I64), release, wait
+    )
+
+    builder.position_at_start(wait)
+    call_pthread(builder, "pthread_cond_wait", "done", "lock")
+    builder.branch(check)
+
+    builder.position_at_start(release)
+    call_pthread(builder, "pthread_mutex_unlock", "lock")
+    builder.branch(finished)
+
+    builder.position_at_start(finished)
+    builder.store_atomic(ZERO_I64, busy, "release", 8)
+    builder.ret_void()
+
+    builder.position_at_start(empty)
+    builder.ret_void()
+    return run
+
+
+def add_task_spawn_function(module: ir.Module) -> ir.Function:
+    """
+    Queues a task record built by a sqawz call and returns its handle. The
+    task runs right away when the deque of this thread is full.
+    """
+    push_func = module.get_global(FUNC_PREFIX + "task.push")
+    run_func = module.get_global(FUNC_PREFIX + "task.run")
+    start_func = module.get_global(FUNC_PREFIX + "pool.start")
+    pool_size = get_pool_global(module, "size")
+
+    spawn = ir.Function(
+        module,
+        ir.FunctionType(get_llvm_type(DecimalType), [VOID_PTR]),
+        name=FUNC_PREFIX + "task.spawn",
+    )
+    task = spawn.args[0]
+    entry = spawn.append_basic_block(name="entry")
+    starting = spawn.append_basic_block(name="starting")
+    ready = spawn.append_basic_block(name="ready")
+    inline = spawn.append_basic_block(name="inline")
+    queued = spawn.append_basic_block(name="queued")
+    rouse = spawn.append_basic_block(name="rouse")
+    done = spawn.append_basic_block(name="done")
+    builder = ir.IRBuilder(entry)
+    builder.cbranch(
+        builder.icmp_unsigned("==", builder.load(pool_size), ZERO_I64),
+        starting,
+        ready,
+    )
+
+    builder.position_at_start(starting)
+    builder.call(start_func, [])
+    builder.branch(ready)
+
+    builder.position_at_start(ready)
+    pushed = builder.call(push_func, [task], name="pushed")
+    builder.cbranch(pushed, queued, inline)
+
+    builder.position_at_start(inline)
+    builder.call(run_func, [task])
+    builder.branch(done)
+
+    builder.position_at_start(queued)
+    sleepers = builder.load_atomic(
+        get_pool_global(module, "sleeping"), "seq_cst", 8, name="sleepers"
+    )
+    builder.cbranch(builder.icmp_unsigned("==", sleepers, ZERO_I64), done, rouse)
+
+    builder.position_at_start(rouse)
+    call_pthread(builder, "pthread_mutex_lock", "lock")
+    call_pthread(builder, "pthread_cond_broadcast", "wake")
+    call_pthread(builder, "pthread_mutex_unlock", "lock")
+    builder.branch(done)
+
+    builder.position_at_start(done)
+    builder.ret(builder.ptrtoint(task, i64, name="handle"))
+    return spawn
+
+
+def add_wa1t_function(module: ir.Module) -> ir.Function:
+    """
+    Returns the result of the task a handle from sqawz names, then frees it.
+    Runs other tasks while the task is not done, so waiting on a task that is
+    still queued can't deadlock. Aborts on a handle that was waited on
+    before, as far as the freed record still shows it.
+    """
+    find_func = module.get_global(FUNC_PREFIX + "task.find")
+    run_func = module.get_global(FUNC_PREFIX + "task.run")
+    flush_func = module.get_global(FUNC_PREFIX + "flush")
+    fmt_str = create_global_string(
+        module,
+        "Error: wa1t on a handle that was already waited on\n",
+        name=".fmt.waited",
+    )
+
+    wa1t = ir.Function(
+        module,
+        ir.FunctionType(get_llvm_type(DecimalType), [get_llvm_type(DecimalType)]),
+        name=FUNC_PREFIX + "wa1t",
+    )
+    entry = wa1t.append_basic_block(name="entry")
+    poll = wa1t.append_basic_block(name="poll")
+    assist = wa1t.append_basic_block(name="assist")
+    other = wa1t.append_basic_block(name="other")
+    idle = wa1t.append_basic_block(name="idle")
+    check = wa1t.append_basic_block(name="check")
+    done = wa1t.append_basic_block(name="done")
+    waited = wa1t.append_basic_block(name="waited")
+    builder = ir.IRBuilder(entry)
+    task = builder.inttoptr(wa1t.args[0], VOID_PTR, name="task")
+    done_ptr = task_field(builder, task, TASK_DONE)
+    builder.branch(poll)
+
+    builder.position_at_start(poll)
+    finished = builder.load_atomic(done_ptr, "acquire", 8, name="finished")
+    builder.cbranch(builder.icmp_unsigned("==", finished, ZERO_I64), assist, check)
+
+    builder.position_at_start(check)
+    branch = builder.cbranch(
+        builder.icmp_unsigned("==", finished, ONE_I64), done, waited
+    )
+    branch.set_weights([1 << 20, 1])
+
+    builder.position_at_start(assist)
+    found = builder.call(find_func, [], name="found")
+    builder.cbranch(builder.icmp_unsigned("==", found, NULL), idle, other)
+
+    builder.position_at_start(other)
+    builder.call(run_func, [found])
+    builder.branch(poll)
+
+    # Another thread is running it
+    builder.position_at_start(idle)
+    builder.call(get_sched_yield_function(module), [])
+    builder.branch(poll)
+
+    builder.position_at_start(done)
+    result = builder.load(task_field(builder, task, TASK_RESULT), name="result")
+    builder.store(ir.Constant(i64, TASK_WAITED), done_ptr)
+    builder.call(get_free_function(module), [task])
+    builder.ret(result)
+
+    builder.position_at_start(waited)
+    builder.call(flush_func, [])
+    builder.call(
+        get_dprintf_function(module),
+        [
+            ir.Constant(i32, STDERR_FD),
+            builder.gep(fmt_str, [ZERO, ZERO], inbounds=True),
+        ],
+    )
+    builder.call(get_abort_function(module), [])
+    builder.unreachable()
+    return wa1t
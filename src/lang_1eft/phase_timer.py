@@ -0,0 +1,34 @@
+from contextlib import contextmanager
+import time
+from typing import Iterator
+
+import rich
+from rich.table import Table
+
+
+class PhaseTimer:
+    """Wall clock time spent in each compiler phase, in the order they ran."""
+
+    def __init__(self) -> None:
+        self.phases: dict[str, float] = {}
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def report(self) -> None:
+        total = sum(self.phases.values())
+        table = Table(title="Compile phases")
+        table.add_column("Phase")
+        table.add_column("Time (s)", justify="right")
+        table.add_column("Share", justify="right")
+        for name, elapsed in self.phases.items():
+            share = elapsed / total if total > 0 else 0.0
+            table.add_row(name, f"{elapsed:.3f}", f"{share:.0%}")
+        table.add_row("total", f"{total:.3f}", "", style="bold")
+        rich.print(table)
@@ -126,6 +126,22 @@ class ASTConstructor(Transformer):
         assert isinstance(items[0], Identifier)
         return IdentifierExpr(items[0].line, items[0].column, items[0])
 
+    def index_expr(self, items: list[Any]) -> IndexExpr:
+        assert len(items) == 3
+        assert isinstance(items[0], Identifier)
+        assert isinstance(items[2], Expression)
+        return IndexExpr(items[0].line, items[0].column, items[0], items[2])
+
+    def address_of_index_expr(self, items: list[Any]) -> AddressOfIndexExpr:
+        assert len(items) == 4
+        assert isinstance(items[0], Token)
+        assert items[0].value == ADDRESS_OF_SYMBOL
+        assert isinstance(items[1], Identifier)
+        assert isinstance(items[3], Expression)
+        return AddressOfIndexExpr(
+            items[0].line or 0, items[0].column or 0, items[1], items[3]
+        )
+
     def deref_expr(self, items: list[Any]) -> DerefExpr:
         assert len(items) == 2
         assert isinstance(items[0], Token)
@@ -298,15 +314,19 @@ class ASTConstructor(Transformer):
         )
 
     def var_decl_stmt(self, items: list[Any]) -> VarDeclStatement:
-        assert len(items) == 2
+        assert len(items) == 2 or len(items) == 3
         assert isinstance(items[0], Type)
         assert not isinstance(items[0], VoidType)
         assert isinstance(items[1], Identifier)
-        return VarDeclStatement(items[0].line, items[0].column, items[0], items[1])
+        var_type = items[0]
+        if len(items) == 3:
+            assert isinstance(items[2], DecimalLiteral)
+            var_type = ArrayOf(items[2].line, items[2].column, var_type, items[2].value)
+        return VarDeclStatement(items[0].line, items[0].column, var_type, items[1])
 
     def var_ass_stmt(self, items: list[Any]) -> VarAssStatement:
         assert len(items) == 2
-        assert isinstance(items[0], Identifier | DerefExpr)
+        assert isinstance(items[0], Identifier | DerefExpr | IndexExpr)
         assert isinstance(items[1], Expression)
         return VarAssStatement(items[0].line, items[0].column, items[0], items[1])
 
@@ -376,27 +396,68 @@ class ASTConstructor(Transformer):
             items[-1],
         )
 
+    def hint(self, items: list[Any]) -> Hint:
+        assert len(items) == 1 or len(items) == 2
+        assert isinstance(items[0], Token)
+        value = None
+        if len(items) == 2:
+            assert isinstance(items[1], DecimalLiteral)
+            value = items[1].value
+        return Hint(items[0].line or 0, items[0].column or 0, items[0].value, value)
+
+    def hints(self, items: list[Any]) -> list[Hint]:
+        assert all(isinstance(i, Hint) for i in items)
+        return items
+
     def as_stmt(self, items: list[Any]) -> AsStatement:
-        assert len(items) == 2
-        assert isinstance(items[0], Expression)
-        assert isinstance(items[1], Block)
-        return AsStatement(items[0].line, items[0].column, items[0], items[1])
+        assert len(items) == 2 or len(items) == 3
+        hints = items[0] if len(items) == 3 else []
+        assert isinstance(hints, list)
+        assert isinstance(items[-2], Expression)
+        assert isinstance(items[-1], Block)
+        return AsStatement(
+            items[-2].line, items[-2].column, items[-2], items[-1], hints
+        )
+
+    def qar_stmt(self, items: list[Any]) -> QarStatement:
+        assert len(items) == 4 or len(items) == 6
+        assert isinstance(items[0], Identifier)
+        assert isinstance(items[1], Expression)
+        assert isinstance(items[2], Expression)
+        assert isinstance(items[-1], Block)
+        reduction = None
+        if len(items) == 6:
+            assert isinstance(items[3], Token) and items[3].value == ADD_SYMBOL
+            assert isinstance(items[4], Identifier)
+            reduction = items[4]
+        return QarStatement(
+            items[0].line,
+            items[0].column,
+            items[0],
+            items[1],
+            items[2],
+            items[-1],
+            reduction,
+        )
 
     def function_def(self, items: list[Any]) -> FunctionDef:
-        assert len(items) == 5
+        assert len(items) == 5 or len(items) == 6
         assert isinstance(items[0], Token)
-        assert isinstance(items[1], Type)
-        assert isinstance(items[2], Identifier)
-        assert isinstance(items[3], list)
-        assert all(isinstance(p, Param) for p in items[3])
-        assert isinstance(items[4], Block)
+        hints = items[1] if len(items) == 6 else []
+        assert all(isinstance(h, Hint) for h in hints)
+        assert isinstance(items[-4], Type)
+        assert isinstance(items[-3], Identifier)
+        assert isinstance(items[-2], list)
+        assert all(isinstance(p, Param) for p in items[-2])
+        assert isinstance(items[-1], Block)
         return FunctionDef(
             items[0].line or 0,
             items[0].column or 0,
-            items[1],
-            items[2],
-            items[3],
-            items[4],
+            items[-4],
+            items[-3],
+            items[-2],
+            items[-1],
+            hints,
         )
 
     def start(self, items: list[Any]) -> Program:
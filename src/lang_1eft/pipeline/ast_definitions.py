@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 
 @dataclass(frozen=True)
@@ -71,6 +71,14 @@ class PointerOf(Type):
     base_type: Type
 
 
+@dataclass(frozen=True)
+class ArrayOf(Type):
+    """ArrayOf represents a fixed-size array type."""
+
+    base_type: Type
+    size: int
+
+
 @dataclass(frozen=True)
 class StringLiteral(Expression):
     """StringLiteral represents a string literal value."""
@@ -241,6 +249,22 @@ class AddressOfExpr(Expression):
     identifier: Identifier
 
 
+@dataclass(frozen=True)
+class IndexExpr(Expression):
+    """IndexExpr represents an array element expression."""
+
+    identifier: Identifier
+    index: Expression
+
+
+@dataclass(frozen=True)
+class AddressOfIndexExpr(Expression):
+    """AddressOfIndexExpr represents the address of an array element."""
+
+    identifier: Identifier
+    index: Expression
+
+
 @dataclass(frozen=True)
 class DerefExpr(Expression):
     """DerefExpr represents a dereference expression."""
@@ -268,7 +292,7 @@ class VarDeclStatement(Statement):
 class VarAssStatement(Statement):
     """VarAssStatement represents a variable assignment statement."""
 
-    lhs: Identifier | DerefExpr
+    lhs: Identifier | DerefExpr | IndexExpr
     rhs: Expression
 
 
@@ -287,6 +311,14 @@ class Block(ASTNode):
     statements: list[Statement]
 
 
+@dataclass(frozen=True)
+class Hint(ASTNode):
+    """Hint represents an optimization hint on a function or loop."""
+
+    name: str
+    value: int | None = None
+
+
 @dataclass(frozen=True)
 class ElseIf(ASTNode):
     """ElseIf represents an else-if statement."""
@@ -311,6 +343,18 @@ class AsStatement(Statement):
 
     condition: Expression
     body: Block
+    hints: list[Hint] = field(default_factory=list)
+
+
+@dataclass(frozen=True)
+class QarStatement(Statement):
+    """QarStatement represents a loop over an index range run in parallel."""
+
+    index: Identifier
+    start: Expression
+    end: Expression
+    body: Block
+    reduction: Identifier | None = None
 
 
 @dataclass(frozen=True)
@@ -321,6 +365,7 @@ class FunctionDef(ASTNode):
     identifier: Identifier
     parameters: list[Param]
     body: Block
+    hints: list[Hint] = field(default_factory=list)
 
 
 @dataclass(frozen=True)
@@ -1,3 +1,8 @@
+from dataclasses import fields
+
+from lang_1eft.pipeline.ast_definitions import *
+
+
 def translate_integer(value: str) -> int:
     return int(
         value[2:-2]
@@ -7,3 +12,100 @@ def translate_integer(value: str) -> int:
         .replace("c", "8")
         .replace("d", "9")
     )
+
+
+def contains_statement(block: Block, kind: type[Statement]) -> bool:
+    for stmt in block.statements:
+        if isinstance(stmt, kind):
+            return True
+        if isinstance(stmt, IfStatement):
+            blocks = [stmt.body] + [e.body for e in stmt.else_ifs]
+            if stmt.else_body is not None:
+                blocks.append(stmt.else_body)
+            if any(contains_statement(b, kind) for b in blocks):
+                return True
+        if isinstance(stmt, AsStatement | QarStatement) and contains_statement(
+            stmt.body, kind
+        ):
+            return True
+    return False
+
+
+def same_expression(a: object, b: object) -> bool:
+    """Structural equality of two AST nodes, ignoring their source positions."""
+    if isinstance(a, ASTNode) and isinstance(b, ASTNode):
+        if type(a) is not type(b):
+            return False
+        return all(
+            same_expression(getattr(a, f.name), getattr(b, f.name))
+            for f in fields(a)
+            if f.name not in ("line", "column")
+        )
+    if isinstance(a, list) and isinstance(b, list):
+        return len(a) == len(b) and all(map(same_expression, a, b))
+    return a == b
+
+
+def contains_expression(node: object, kind: type[Expression]) -> bool:
+    if isinstance(node, kind):
+        return True
+    if isinstance(node, ASTNode):
+        return any(contains_expression(getattr(node, f.name), kind) for f in fields(node))
+    if isinstance(node, list):
+        return any(contains_expression(item, kind) for item in node)
+    return False
+
+
+def called_functions(node: object) -> set[str]:
+    """Names of the functions an AST node calls with exec"""
+    if isinstance(node, ExecExpr):
+        return {node.identifier.name} | called_functions(node.arguments)
+    if isinstance(node, ASTNode):
+        return set().union(
+            *(called_functions(getattr(node, f.name)) for f in fields(node))
+        )
+    if isinstance(node, list):
+        return set().union(*(called_functions(item) for item in node))
+    return set()
+
+
+def identifier_names(node: object) -> set[str]:
+    """Names of every identifier in an AST node, variables and functions alike"""
+    if isinstance(node, Identifier):
+        return {node.name}
+    if isinstance(node, ASTNode):
+        return set().union(
+            *(identifier_names(getattr(node, f.name)) for f in fields(node))
+        )
+    if isinstance(node, list):
+        return set().union(*(identifier_names(item) for item in node))
+    return set()
+
+
+def constant_value(expr: Expression) -> int | None:
+    """
+    Value of an arithmetic expression over decimal literals, wrapped to 64
+    bits like the generated code, or None if it isn't one
+    """
+    if isinstance(expr, DecimalLiteral):
+        value = expr.value
+    elif isinstance(expr, AddExpr | SubExpr | MulExpr | DivExpr | ModExpr):
+        lhs = constant_value(expr.lhs)
+        rhs = constant_value(expr.rhs)
+        if lhs is None or rhs is None:
+            return None
+        if isinstance(expr, AddExpr):
+            value = lhs + rhs
+        elif isinstance(expr, SubExpr):
+            value = lhs - rhs
+        elif isinstance(expr, MulExpr):
+            value = lhs * rhs
+        elif rhs == 0:
+            return None
+        else:
+            # sdiv and srem round toward zero
+            quotient = abs(lhs) // abs(rhs) * (1 if (lhs < 0) == (rhs < 0) else -1)
+            value = quotient if isinstance(expr, DivExpr) else lhs - quotient * rhs
+    else:
+        return None
+    return (value + 2**63) % 2**64 - 2**63
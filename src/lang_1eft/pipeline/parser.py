@@ -21,10 +21,10 @@ class Parser:
         parsed = None
         try:
             parsed = self.lark.parse(code)
-            if str(parsed).count("_ambig") > 0:
-                rich.print(
-                    f"[red]Ambiguities found in code:[/red] {str(parsed).count('_ambig')}"
-                )
+            # Walk the tree rather than rendering it, which is slow for big programs
+            ambiguities = sum(1 for t in parsed.iter_subtrees() if t.data == "_ambig")
+            if ambiguities > 0:
+                rich.print(f"[red]Ambiguities found in code:[/red] {ambiguities}")
                 exit(1)
         except lark.exceptions.LarkError as e:
             rich.print(f"[red]Error parsing code:[/red] {e}")
@@ -0,0 +1,36 @@
+import os
+from pathlib import Path
+import subprocess
+import sys
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+SOURCES = ROOT / "1eft~srcs"
+
+
+def compile_and_run(source: Path, out_dir: Path, *flags: str) -> str:
+    exe = out_dir / "program"
+    env = dict(os.environ, PYTHONPATH=str(ROOT / "src"))
+    subprocess.run(
+        [sys.executable, "1eft.py", "compile", str(source), str(exe)]
+        + ["--no-cache", "--cache-dir", str(out_dir / "cache"), *flags],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        check=True,
+    )
+    return subprocess.run(
+        [str(exe)], capture_output=True, text=True, check=True
+    ).stdout
+
+
+@pytest.mark.parametrize("flags", [(), ("--opt", "0"), ("--runtime", "object")])
+def test_int64_boundaries(tmp_path: Path, flags: tuple[str, ...]) -> None:
+    expected = [str(2**63 - 1), str(-(2**63)), "0"]
+    for n in range(1, 19):
+        power = 10**n
+        expected += [str(power - 1), str(power), str(-(power - 1)), str(-power)]
+
+    output = compile_and_run(SOURCES / "1zt64!1eft", tmp_path, *flags)
+    assert output.splitlines() == expected